@@ -5,11 +5,13 @@ import sys
 import json
 import random
 import string
+import asyncio
 import argparse
+from typing import List, Optional
 
 import Crypto.PublicKey.RSA
 
-from . import config, entrypoint, utils
+from . import benchmark, config, entrypoint, loadtest, nse, proof_of_work, utils
 
 
 def _run(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
@@ -88,6 +90,128 @@ def _generate(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
     return 0
 
 
+def _bench(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    baseline = None
+    if args.baseline:
+        if not os.path.exists(args.baseline):
+            parser.error(f"baseline file {args.baseline!r} not found")
+            return 2
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    private_key = None
+    if args.private_key:
+        with open(args.private_key) as f:
+            private_key = Crypto.PublicKey.RSA.import_key(f.read())
+
+    report = benchmark.make_report(benchmark.run_suite(private_key, args.quick))
+    _write_report(report, args.output)
+
+    if baseline is None:
+        return 0
+    regressions = benchmark.compare(report["results"], baseline, args.threshold)
+    for regression in regressions:
+        print(
+            f"REGRESSION: {regression.benchmark}.{regression.metric} changed from {regression.baseline:.6g} "
+            f"to {regression.current:.6g} ({regression.change:+.1%} worse)",
+            file=sys.stderr
+        )
+    return 1 if regressions else 0
+
+
+def _load_keys(paths: List[str]) -> List[Crypto.PublicKey.RSA.RsaKey]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".pem")))
+        else:
+            files.append(path)
+    keys = []
+    for file in files:
+        with open(file) as f:
+            keys.append(Crypto.PublicKey.RSA.import_key(f.read()))
+    return keys
+
+
+def _write_report(report: dict, output: Optional[str]) -> None:
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=4, sort_keys=True))
+
+
+def _gossip_load(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    if not os.path.exists(args.config):
+        parser.error(f"config file {args.config!r} not found, please use command 'config' to create one")
+        return 2
+    conf = config.load([args.config])
+
+    if args.keys:
+        keys = _load_keys(args.keys)
+    else:
+        print(f"Generating {args.generate} RSA 4096-bit keys... ", end="", file=sys.stderr, flush=True)
+        keys = [Crypto.PublicKey.RSA.generate(4096) for _ in range(args.generate)]
+        print("Done!", file=sys.stderr)
+    if not keys:
+        parser.error("no RSA private keys found")
+        return 2
+
+    async def run() -> dict:
+        # Every round accepted by the instance right now gets messages of all keys,
+        # while outdated notifications are valid messages of the previous round
+        start = nse.get_start_time(conf)
+        round_times = [start + i * conf.nse.frequency for i in range(conf.nse.max_backlog_rounds + 1)]
+        print(f"Building {len(keys) * (len(round_times) + 1)} messages... ", end="", file=sys.stderr, flush=True)
+        engine = proof_of_work.get_engine(conf)
+        try:
+            messages = await loadtest.build_messages(keys, round_times, conf.nse.proof_of_work_bits, engine)
+            outdated = await loadtest.build_messages(
+                keys, [start - conf.nse.frequency], conf.nse.proof_of_work_bits, engine
+            )
+        finally:
+            engine.close()
+        print("Done!", file=sys.stderr)
+        corpus = loadtest.make_corpus(messages, args.count, args.duplicates, args.invalid, outdated=outdated)
+        generator = loadtest.GossipLoadGenerator(corpus, args.rate, conf.nse.data_type)
+        await generator.start(args.address or conf.gossip.api_addresses[0])
+        print("Waiting for the NSE instance to connect...", file=sys.stderr, flush=True)
+        return await generator.run(None)
+
+    try:
+        report = asyncio.run(run())
+    except ValueError as exc:
+        parser.error(str(exc))
+        return 2
+    _write_report(report, args.output)
+    return 0
+
+
+def _query_load(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    address = args.address
+    if not address:
+        if not os.path.exists(args.config):
+            parser.error(f"config file {args.config!r} not found, please use option '-a' or command 'config'")
+            return 2
+        address = config.load([args.config]).nse.api_address
+
+    async def run() -> dict:
+        generator = loadtest.QueryLoadGenerator(address, args.connections, args.timeout)
+        results = []
+        for rate in args.rates or [1000.0]:
+            print(f"Sending {rate} queries per second for {args.duration} seconds...", file=sys.stderr, flush=True)
+            results.append(await generator.run(rate, args.duration))
+        return {"address": address, "connections": args.connections, "results": results}
+
+    try:
+        report = asyncio.run(run())
+    except ValueError as exc:
+        parser.error(str(exc))
+        return 2
+    _write_report(report, args.output)
+    return 0
+
+
 def main() -> int:
     parser = utils.get_cli_parser()
     args = parser.parse_args()
@@ -96,7 +220,10 @@ def main() -> int:
         "run": _run,
         "validate": _validate,
         "new": _new,
-        "generate": _generate
+        "generate": _generate,
+        "bench": _bench,
+        "gossip-load": _gossip_load,
+        "query-load": _query_load
     }[args.command](parser, args)
 
 
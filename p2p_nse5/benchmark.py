@@ -0,0 +1,360 @@
+"""
+Module containing micro-benchmarks of performance-critical parts of the package
+
+Run it via ``python -m p2p_nse5.benchmark`` to print the comparisons with the
+legacy implementations. The suite of :func:`run_suite` is run by the command
+``python -m p2p_nse5 bench``, which writes its results in JSON format and may
+compare them against the results of a previous run (see :func:`compare`).
+"""
+
+import os
+import sys
+import time
+import struct
+import hashlib
+import platform
+import tempfile
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Union
+
+import sqlalchemy.orm
+from Crypto.PublicKey import RSA
+
+from . import nse, persistence
+from .protocols import api, p2p
+
+
+DER_KEY_LENGTH = 550
+"""Typical length of a 4096 bit RSA public key in DER format"""
+
+RESULTS_VERSION = 1
+"""Version of the layout of the results of :func:`run_suite`"""
+
+
+def _legacy_search_nonce(body: bytes, proof_of_work_bits: int, start: int, stop: int):
+    # The nonce search as it was implemented in p2p.build_message before
+    # the preallocated buffer was introduced, kept for comparison only
+    proximity, key_length, round_time, _ = p2p.HASHED_HEADER.unpack(body[:p2p.HASHED_HEADER.size])
+    exported_public_key = body[p2p.HASHED_HEADER.size:]
+    for sample in range(start, stop):
+        hashed_header = p2p.HASHED_HEADER.pack(proximity, key_length, round_time, sample) + exported_public_key
+        if p2p._check_proof_of_work(proof_of_work_bits, hashed_header):  # noqa
+            return sample
+    return None
+
+
+def _legacy_calculate_proximity(rsa_key: RSA.RsaKey, value: Union[int, bytes]) -> int:
+    # The string-based implementation of p2p.calculate_proximity
+    # before integer arithmetic was used, kept for comparison only
+    if isinstance(value, int):
+        ba = bytearray()
+        while value > 255:
+            ba.append(value % 256)
+            value = value >> 8
+        ba.append(value)
+        value = bytes(ba)
+    n = bin(rsa_key.public_key().n)[2:]
+    h = bin(int.from_bytes(hashlib.sha256(value).digest(), p2p.HASH_ENDIAN))[2:]
+    for c in range(256-len(h)):
+        h = "0" + h
+    proximity = 0
+    while proximity < 256 and h[proximity] == n[proximity]:
+        proximity += 1
+    return proximity
+
+
+def _legacy_select_rounds(session: sqlalchemy.orm.Session, current_round: int, limit: int):
+    # The unordered query of the NSE_QUERY path before persistence.get_recent_rounds
+    # was introduced, kept for comparison only (it returns an arbitrary subset)
+    rounds = session.query(persistence.Round).filter(persistence.Round.round <= current_round).limit(limit).all()
+    return [(r.round, r.proximity) for r in rounds]
+
+
+def _measure(func: Callable[[], None], repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_nonce_search(attempts: int = 200000) -> Dict[str, float]:
+    """
+    Measure the attempts per second of the proof of work nonce search
+
+    A proof of work of 256 bits is requested, so that no nonce in the
+    range is valid and exactly ``attempts`` hashes are calculated.
+
+    :param attempts: number of nonces checked per measurement
+    :return: attempts per second of the legacy and the current implementation and the speedup
+    """
+
+    body = p2p.pack_hashed_body(42, int(time.time()), os.urandom(DER_KEY_LENGTH))
+    legacy = attempts / _measure(lambda: _legacy_search_nonce(body, 256, 0, attempts))
+    current = attempts / _measure(lambda: p2p.search_nonce(body, 256, 0, attempts))
+    return {"legacy": legacy, "current": current, "speedup": current / legacy}
+
+
+def bench_proximity(calls: int = 20000, keys: int = 8) -> Dict[str, float]:
+    """
+    Measure the calls per second of the proximity calculation
+
+    :param calls: number of proximities calculated per measurement
+    :param keys: number of different (random, unchecked) 4096 bit public keys
+    :return: calls per second of the legacy, the current and the batch implementation and the speedups
+    """
+
+    rsa_keys = [RSA.construct((int.from_bytes(os.urandom(512), "big") | (1 << 4095) | 1, 65537)) for _ in range(keys)]
+    values = list(range(1_600_000_000, 1_600_000_000 + 1800 * calls // keys, 1800))
+    pairs = [(k, v) for v in values for k in rsa_keys]
+
+    legacy = calls / _measure(lambda: [_legacy_calculate_proximity(k, v) for k, v in pairs])
+    current = calls / _measure(lambda: [p2p.calculate_proximity(k, v) for k, v in pairs])
+    batch = calls / _measure(lambda: p2p.calculate_proximities(rsa_keys, values))
+    return {
+        "legacy": legacy,
+        "current": current,
+        "batch": batch,
+        "speedup": current / legacy,
+        "batch_speedup": batch / legacy
+    }
+
+
+def bench_round_window(
+        sizes: Iterable[int] = (10_000, 100_000, 1_000_000),
+        queries: int = 1000,
+        limit: int = 8
+) -> Dict[int, Dict[str, float]]:
+    """
+    Measure the latency of the round window query for growing histories of rounds
+
+    A temporary SQLite database is filled with the given numbers of historical
+    rounds. For every size, the window of the ``limit`` most recent rounds is
+    queried ``queries`` times, while the current round is the newest round.
+
+    :param sizes: numbers of historical rounds in the database (in ascending order)
+    :param queries: number of queries per measurement
+    :param limit: number of rounds in the window (see ``respected_rounds``)
+    :return: mapping of the number of rounds to the average latency of the
+        legacy and the current query and of the whole estimate in seconds
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(directory, 'rounds.db')}")
+        persistence.Base.metadata.create_all(bind=engine)
+        with sqlalchemy.orm.Session(engine) as session:
+            session.add(persistence.Peer(public_key=b"benchmark", interactions=0))
+            session.commit()
+            stored = 0
+            for size in sizes:
+                session.execute(persistence.Round.__table__.insert(), [
+                    {"round": r, "proximity": r % 32, "max_hops": 1, "peer_id": 1}
+                    for r in range(stored, size)
+                ])
+                session.commit()
+                stored = size
+
+                legacy = _measure(lambda: [_legacy_select_rounds(session, size - 1, limit) for _ in range(queries)])
+                current = _measure(lambda: [
+                    persistence.get_recent_rounds(session, size - 1, limit) for _ in range(queries)
+                ])
+                estimate = _measure(lambda: [
+                    nse.calculate_estimate([p for _, p in persistence.get_recent_rounds(session, size - 1, limit)])
+                    for _ in range(queries)
+                ])
+                results[size] = {
+                    "legacy": legacy / queries,
+                    "current": current / queries,
+                    "estimate": estimate / queries
+                }
+        engine.dispose()
+    return results
+
+
+def bench_build_message(rsa_key: RSA.RsaKey, bits: Iterable[int] = (8, 12, 16), messages: int = 5) -> Dict[int, float]:
+    """
+    Measure the duration of building a complete message for different proof of work bit levels
+
+    The round time is different for every message, so that
+    the proof of work needs to be calculated for every message.
+
+    :param rsa_key: RSA 4096 bit private key used to sign the messages
+    :param bits: bit levels of the proof of work
+    :param messages: number of messages built per bit level
+    :return: mapping of the bit level to the average duration in seconds
+    """
+
+    results = {}
+    for b in bits:
+        start = time.perf_counter()
+        for i in range(messages):
+            p2p.build_message(rsa_key, 1_600_000_000 + i * 3600, proof_of_work_bits=b)
+        results[b] = (time.perf_counter() - start) / messages
+    return results
+
+
+def bench_unpack_message(rsa_key: RSA.RsaKey, calls: int = 200, proof_of_work_bits: int = 8) -> Dict[str, float]:
+    """
+    Measure the calls per second of the full verification of incoming messages
+
+    :param rsa_key: RSA 4096 bit private key used to sign the message
+    :param calls: number of verifications per measurement
+    :param proof_of_work_bits: bit level of the proof of work of the message
+    :return: calls per second with parsing the public key every time (``cold``)
+        and with the public key in the cache of parsed keys (``warm``)
+    """
+
+    msg = p2p.build_message(rsa_key, 1_600_000_000, proof_of_work_bits=proof_of_work_bits)
+    warm_keys = p2p.KeyCache()
+    cold = calls / _measure(lambda: [
+        p2p.unpack_message(msg, proof_of_work_bits=proof_of_work_bits, keys=p2p.KeyCache(0)) for _ in range(calls)
+    ])
+    warm = calls / _measure(lambda: [
+        p2p.unpack_message(msg, proof_of_work_bits=proof_of_work_bits, keys=warm_keys) for _ in range(calls)
+    ])
+    return {"cold": cold, "warm": warm}
+
+
+def bench_unpack_incoming_message(calls: int = 200000) -> Dict[str, float]:
+    """
+    Measure the calls per second of parsing incoming API messages
+
+    :param calls: number of parsed messages per measurement
+    :return: calls per second for ``NSE_QUERY`` and ``GOSSIP_NOTIFICATION`` messages
+    """
+
+    query = memoryview(struct.pack("!HH", 4, api.MessageType.NSE_QUERY))
+    payload = os.urandom(p2p.HASHED_HEADER.size + DER_KEY_LENGTH + 512)
+    notification = memoryview(struct.pack(
+        "!HHHH", 8 + len(payload), api.MessageType.GOSSIP_NOTIFICATION, 1, 31337
+    ) + payload)
+    query_types = [api.MessageType.NSE_QUERY]
+    notification_types = [api.MessageType.GOSSIP_NOTIFICATION]
+    return {
+        "nse_query": calls / _measure(lambda: [
+            api.unpack_incoming_message(query, query_types) for _ in range(calls)
+        ]),
+        "gossip_notification": calls / _measure(lambda: [
+            api.unpack_incoming_message(notification, notification_types) for _ in range(calls)
+        ])
+    }
+
+
+def run_suite(rsa_key: Optional[RSA.RsaKey] = None, quick: bool = False) -> Dict[str, Dict[str, float]]:
+    """
+    Run all micro-benchmarks with results which can be compared across runs
+
+    The name of every metric ends with its unit. Metrics ending with
+    ``_seconds`` are durations, all other metrics are rates.
+
+    :param rsa_key: RSA 4096 bit private key used to sign messages (a new key is generated by default)
+    :param quick: switch to use smaller workloads, which gives less stable results
+    :return: mapping of the benchmark names to their metrics
+    """
+
+    rsa_key = RSA.generate(4096) if rsa_key is None else rsa_key
+    scale = 10 if quick else 1
+    bits = (8, 12) if quick else (8, 12, 16)
+    results = {
+        "nonce_search": {"attempts_per_second": bench_nonce_search(200000 // scale)["current"]},
+        "calculate_proximity": {
+            f"{k}_per_second": v for k, v in bench_proximity(20000 // scale).items() if k in ("current", "batch")
+        },
+        "build_message": {
+            f"{b}_bits_seconds": v for b, v in bench_build_message(rsa_key, bits, 2 if quick else 5).items()
+        },
+        "unpack_message": {f"{k}_per_second": v for k, v in bench_unpack_message(rsa_key, 200 // scale).items()},
+        "unpack_incoming_message": {
+            f"{k}_per_second": v for k, v in bench_unpack_incoming_message(200000 // scale).items()
+        },
+        "estimate_query": {}
+    }
+    sizes = (1_000, 10_000) if quick else (10_000, 100_000, 1_000_000)
+    for size, result in bench_round_window(sizes, 1000 // scale).items():
+        results["estimate_query"][f"{size}_rounds_seconds"] = result["estimate"]
+    return results
+
+
+def make_report(results: Dict[str, Dict[str, float]]) -> Dict:
+    """
+    Wrap the results of :func:`run_suite` with information about the environment
+
+    :param results: results of the benchmark suite
+    :return: JSON-serializable report
+    """
+
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": int(time.time()),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results
+    }
+
+
+class Regression(NamedTuple):
+    """
+    Metric which is worse than its baseline by more than the threshold
+    """
+
+    benchmark: str
+    metric: str
+    baseline: float
+    current: float
+
+    @property
+    def change(self) -> float:
+        """Relative change of the metric, positive values are worse than the baseline"""
+        if self.metric.endswith("_seconds"):
+            return self.current / self.baseline - 1
+        return self.baseline / self.current - 1
+
+
+def compare(
+        results: Dict[str, Dict[str, float]],
+        baseline: Dict[str, Dict[str, float]],
+        threshold: float = 0.1
+) -> List[Regression]:
+    """
+    Compare the results of :func:`run_suite` against the results of a previous run
+
+    Metrics which are missing in either results are ignored. Durations (metrics
+    ending with ``_seconds``) regress when they grow, all other metrics (rates)
+    regress when they shrink.
+
+    :param results: current results of the benchmark suite
+    :param baseline: previous results of the benchmark suite
+    :param threshold: tolerated relative change, e.g. ``0.1`` for 10 percent
+    :return: list of all metrics which regressed by more than the threshold
+    """
+
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(name, {}).get(metric)
+            if previous is None or previous <= 0 or value <= 0:
+                continue
+            regression = Regression(name, metric, previous, value)
+            if regression.change > threshold:
+                regressions.append(regression)
+    return regressions
+
+
+if __name__ == "__main__":
+    result = bench_nonce_search()
+    print(
+        f"Nonce search: {result['legacy']:,.0f} -> {result['current']:,.0f} "
+        f"attempts/s (speedup {result['speedup']:.2f}x)"
+    )
+    result = bench_proximity()
+    print(
+        f"Proximity: {result['legacy']:,.0f} -> {result['current']:,.0f} calls/s "
+        f"(speedup {result['speedup']:.2f}x), batch {result['batch']:,.0f} calls/s "
+        f"(speedup {result['batch_speedup']:.2f}x)"
+    )
+    for rows, result in bench_round_window().items():
+        print(
+            f"Round window ({rows:,} rounds): legacy {result['legacy'] * 1e6:,.0f} us, "
+            f"current {result['current'] * 1e6:,.0f} us per query"
+        )
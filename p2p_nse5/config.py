@@ -8,7 +8,7 @@ import configparser
 import pydantic
 import Crypto.PublicKey.RSA
 
-from . import persistence, utils
+from . import metrics, persistence, utils
 from .protocols import p2p
 
 
@@ -16,6 +16,10 @@ DEFAULT_SECTION = "_default"
 GLOBAL_SECTION = "global"
 DEFAULT_CONFIG_FILE = "default_configuration.ini"
 DEFAULT_CONFIG_INI_PATH = os.path.join(".", "default_configuration.ini")
+PROOF_OF_WORK_ENGINES = ("process", "thread")
+VACUUM_MODES = ("none", "incremental", "full")
+STORAGE_BACKENDS = ("database", "memory")
+ANNOUNCE_MODES = ("failover", "fanout")
 
 
 class GossipConfiguration(pydantic.BaseModel):
@@ -24,17 +28,55 @@ class GossipConfiguration(pydantic.BaseModel):
     """
 
     api_address: str
-    """API address of the Gossip server (usually localhost)"""
+    """API address of the Gossip server (usually localhost) or a comma-separated list of API addresses"""
+    announce_mode: str = "failover"
+    """Distribution of announcements across multiple Gossip servers (one of :const:`ANNOUNCE_MODES`)"""
+    reconnect_max_delay: float = 60.0
+    """Maximum number of seconds between two attempts to re-connect to a Gossip server"""
+
+    @property
+    def api_addresses(self) -> list[str]:
+        """List of the API addresses of all Gossip servers in the configured order"""
+        return [address.strip() for address in self.api_address.split(",")]
 
     @pydantic.validator("api_address")
     def is_valid_address_and_port(value: str):  # noqa
         """
-        Checks :attr:`api_address` for conformance with :func:`p2p_nse5.utils.split_ip_address_and_port`
+        Checks every address in :attr:`api_address` for conformance
+        with :func:`p2p_nse5.utils.split_ip_address_and_port`
 
         :raise ValueError: if it's not valid
         """
 
-        utils.split_ip_address_and_port(value, True)
+        addresses = [address.strip() for address in value.split(",")]
+        for address in addresses:
+            utils.split_ip_address_and_port(address, True)
+        if len(set(addresses)) != len(addresses):
+            raise ValueError("Duplicate Gossip API address")
+        return value
+
+    @pydantic.validator("announce_mode")
+    def is_valid_announce_mode(value: str):  # noqa
+        """
+        Checks :attr:`announce_mode` to be a known announce mode
+
+        :raise ValueError: if it's not known
+        """
+
+        if value not in ANNOUNCE_MODES:
+            raise ValueError(f"Unknown announce mode, use one of {', '.join(ANNOUNCE_MODES)}")
+        return value
+
+    @pydantic.validator("reconnect_max_delay")
+    def is_valid_reconnect_max_delay(value: float):  # noqa
+        """
+        Checks :attr:`reconnect_max_delay` to be positive
+
+        :raise ValueError: if it's not positive
+        """
+
+        if value <= 0:
+            raise ValueError("Maximum re-connect delay must be positive")
         return value
 
 
@@ -52,6 +94,12 @@ class NSEConfiguration(pydantic.BaseModel):
 
     enforce_localhost: bool = True
     """Switch to enforce incoming API connections to originate from localhost"""
+    api_idle_timeout: float = 60.0
+    """Seconds after which idle API connections are closed (0 keeps them open)"""
+    api_max_queries: int = 0
+    """Number of queries answered per API connection before it's closed (0 means no limit)"""
+    estimate_cache: bool = False
+    """Switch to answer queries from an in-memory estimate cache instead of the database"""
 
     log_file: str = "-"  # also supports stdout and stderr
     log_level: str = "DEBUG"
@@ -61,6 +109,12 @@ class NSEConfiguration(pydantic.BaseModel):
 
     database: str = persistence.DEFAULT_DATABASE_URL
     """Connection string to the database used in the project"""
+    storage: str = "database"
+    """Storage backend of rounds and peers (one of :const:`STORAGE_BACKENDS`)"""
+    store_public_keys: bool = True
+    """Switch to store the full public keys of peers in the database in addition to their fingerprints"""
+    sqlite_profile: str = "none"
+    """Preset of pragmas applied to SQLite connections (see :const:`p2p_nse5.persistence.SQLITE_PROFILES`)"""
 
     frequency: int = 1800
     """Length of a single NSE round in seconds"""
@@ -71,6 +125,37 @@ class NSEConfiguration(pydantic.BaseModel):
     proof_of_work_bits: int = p2p.DEFAULT_PROOF_OF_WORK_BITS
     """Number of bits required for the proof of work in P2P messages"""
 
+    proof_of_work_engine: str = "process"
+    """Name of the engine calculating the proof of work (see :mod:`p2p_nse5.proof_of_work`)"""
+    proof_of_work_workers: int = 0
+    """Number of worker processes of the ``process`` engine (0 uses one per CPU core)"""
+    precompute_rounds: int = 2
+    """Number of upcoming rounds to prepare our own P2P messages for in advance (0 disables it)"""
+    verification_cache_size: int = 4096
+    """Number of verification results of incoming P2P messages kept to detect duplicates"""
+    key_cache_size: int = 4096
+    """Number of parsed public keys and peer IDs of remote peers kept in memory"""
+    flush_interval: float = 1.0
+    """Maximum number of seconds accepted notifications are buffered before they are written to the database"""
+    flush_batch_size: int = 256
+    """Number of buffered rounds which are written to the database immediately"""
+    retention_rounds: int = 10000
+    """Number of most recent rounds kept in the database by the compaction (0 keeps all rounds)"""
+    peer_retention_rounds: int = 100
+    """Number of rounds after which peers not referenced by any stored round anymore are removed (0 keeps all peers)"""
+    compaction_interval: float = 3600.0
+    """Number of seconds between two runs of the database compaction (0 disables the compaction)"""
+    compaction_vacuum: str = "incremental"
+    """Mode of the SQLite vacuum after the compaction (one of :const:`VACUUM_MODES`)"""
+    metrics_address: str = ""
+    """Local address, port or Unix socket of the metrics endpoint in the Prometheus text format (empty disables it)"""
+    admin_socket: str = ""
+    """Path of the Unix socket accepting profiling commands (empty disables the admin socket)"""
+    profile_directory: str = ""
+    """Directory of the files written by the profiler (empty uses the directory for temporary files)"""
+    profile_seconds: float = 30.0
+    """Duration of the CPU profile triggered by the signal ``SIGUSR1`` in seconds"""
+
     @pydantic.validator("api_address")
     def is_valid_address_and_port(value: str):  # noqa
         """
@@ -94,6 +179,217 @@ class NSEConfiguration(pydantic.BaseModel):
             raise ValueError(f"Data type value {value} out of range for uint16")
         return value
 
+    @pydantic.validator("api_idle_timeout", "api_max_queries")
+    def is_non_negative_api_limit(value: float):  # noqa
+        """
+        Checks :attr:`api_idle_timeout` and :attr:`api_max_queries` to be non-negative
+
+        :raise ValueError: if it's negative
+        """
+
+        if value < 0:
+            raise ValueError("API connection limits must not be negative")
+        return value
+
+    @pydantic.validator("proof_of_work_engine")
+    def is_known_proof_of_work_engine(value: str):  # noqa
+        """
+        Checks :attr:`proof_of_work_engine` to be one of :const:`PROOF_OF_WORK_ENGINES`
+
+        :raise ValueError: if it's an unknown engine
+        """
+
+        if value not in PROOF_OF_WORK_ENGINES:
+            raise ValueError(f"Unknown proof of work engine {value!r}, use one of {PROOF_OF_WORK_ENGINES}")
+        return value
+
+    @pydantic.validator("proof_of_work_workers")
+    def is_valid_worker_count(value: int):  # noqa
+        """
+        Checks :attr:`proof_of_work_workers` to be non-negative
+
+        :raise ValueError: if it's negative
+        """
+
+        if value < 0:
+            raise ValueError("Number of proof of work workers must not be negative")
+        return value
+
+    @pydantic.validator("precompute_rounds")
+    def is_valid_precompute_rounds(value: int):  # noqa
+        """
+        Checks :attr:`precompute_rounds` to be non-negative
+
+        :raise ValueError: if it's negative
+        """
+
+        if value < 0:
+            raise ValueError("Number of precomputed rounds must not be negative")
+        return value
+
+    @pydantic.validator("verification_cache_size")
+    def is_valid_verification_cache_size(value: int):  # noqa
+        """
+        Checks :attr:`verification_cache_size` to be positive
+
+        :raise ValueError: if it's not positive
+        """
+
+        if value < 1:
+            raise ValueError("Size of the verification cache must be positive")
+        return value
+
+    @pydantic.validator("key_cache_size")
+    def is_valid_key_cache_size(value: int):  # noqa
+        """
+        Checks :attr:`key_cache_size` to be positive
+
+        :raise ValueError: if it's not positive
+        """
+
+        if value < 1:
+            raise ValueError("Size of the key cache must be positive")
+        return value
+
+    @pydantic.validator("storage")
+    def is_valid_storage(value: str):  # noqa
+        """
+        Checks :attr:`storage` to be a known storage backend
+
+        :raise ValueError: if it's not known
+        """
+
+        if value not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage backend, use one of {', '.join(STORAGE_BACKENDS)}")
+        return value
+
+    @pydantic.validator("sqlite_profile")
+    def is_valid_sqlite_profile(value: str):  # noqa
+        """
+        Checks :attr:`sqlite_profile` to be a known preset of SQLite pragmas
+
+        :raise ValueError: if it's not known
+        """
+
+        if value not in persistence.SQLITE_PROFILES:
+            raise ValueError(f"Unknown SQLite profile, use one of {', '.join(persistence.SQLITE_PROFILES)}")
+        return value
+
+    @pydantic.validator("retention_rounds")
+    def is_valid_retention_rounds(value: int, values: dict):  # noqa
+        """
+        Checks :attr:`retention_rounds` to be zero or at least :attr:`respected_rounds`
+
+        :raise ValueError: if it's negative or too small
+        """
+
+        if value < 0:
+            raise ValueError("Number of retained rounds must not be negative")
+        if 0 < value < values.get("respected_rounds", 0):
+            raise ValueError("Number of retained rounds must not be smaller than the number of respected rounds")
+        return value
+
+    @pydantic.validator("peer_retention_rounds")
+    def is_valid_peer_retention_rounds(value: int):  # noqa
+        """
+        Checks :attr:`peer_retention_rounds` to be non-negative
+
+        :raise ValueError: if it's negative
+        """
+
+        if value < 0:
+            raise ValueError("Number of rounds to retain unreferenced peers must not be negative")
+        return value
+
+    @pydantic.validator("compaction_interval")
+    def is_valid_compaction_interval(value: float):  # noqa
+        """
+        Checks :attr:`compaction_interval` to be non-negative
+
+        :raise ValueError: if it's negative
+        """
+
+        if value < 0:
+            raise ValueError("Compaction interval must not be negative")
+        return value
+
+    @pydantic.validator("compaction_vacuum")
+    def is_valid_compaction_vacuum(value: str):  # noqa
+        """
+        Checks :attr:`compaction_vacuum` to be a known vacuum mode
+
+        :raise ValueError: if it's not known
+        """
+
+        if value not in VACUUM_MODES:
+            raise ValueError(f"Unknown vacuum mode, use one of {', '.join(VACUUM_MODES)}")
+        return value
+
+    @pydantic.validator("flush_interval")
+    def is_valid_flush_interval(value: float):  # noqa
+        """
+        Checks :attr:`flush_interval` to be non-negative
+
+        :raise ValueError: if it's negative
+        """
+
+        if value < 0:
+            raise ValueError("Flush interval must not be negative")
+        return value
+
+    @pydantic.validator("flush_batch_size")
+    def is_valid_flush_batch_size(value: int):  # noqa
+        """
+        Checks :attr:`flush_batch_size` to be positive
+
+        :raise ValueError: if it's not positive
+        """
+
+        if value < 1:
+            raise ValueError("Flush batch size must be positive")
+        return value
+
+    @pydantic.validator("metrics_address")
+    def is_valid_metrics_address(value: str):  # noqa
+        """
+        Checks :attr:`metrics_address` to be empty, a Unix socket path with the prefix
+        :const:`p2p_nse5.metrics.UNIX_PREFIX`, a port or a localhost address conforming
+        to :func:`p2p_nse5.utils.split_ip_address_and_port`
+
+        :raise ValueError: if it's not valid
+        """
+
+        if value.startswith(metrics.UNIX_PREFIX):
+            if len(value) == len(metrics.UNIX_PREFIX):
+                raise ValueError("Missing path of the Unix socket")
+        elif value != "":
+            utils.split_ip_address_and_port(metrics.get_address(value), True)
+        return value
+
+    @pydantic.validator("profile_directory")
+    def is_valid_profile_directory(value: str):  # noqa
+        """
+        Checks :attr:`profile_directory` to be empty or an existing directory
+
+        :raise ValueError: if it's no directory
+        """
+
+        if value != "" and not os.path.isdir(value):
+            raise ValueError(f"Profile directory {value!r} doesn't exist")
+        return value
+
+    @pydantic.validator("profile_seconds")
+    def is_valid_profile_seconds(value: float):  # noqa
+        """
+        Checks :attr:`profile_seconds` to be positive
+
+        :raise ValueError: if it's not positive
+        """
+
+        if value <= 0:
+            raise ValueError("Profile duration must be positive")
+        return value
+
 
 class Configuration(pydantic.BaseModel):
     hostkey: str  # noqa
@@ -8,15 +8,21 @@ import sys
 import time
 import asyncio
 import logging
-from typing import Optional
+import functools
+from typing import Callable, Dict, Optional, Tuple
 
-from . import config, gossip, nse, persistence, utils
-from .protocols import api
+from . import config, gossip, metrics, nse, profiling, proof_of_work, scheduler, storage, utils
+from .protocols import api, p2p
+
+
+_avoided_announcements = metrics.registry.counter(
+    "nse_announcements_avoided_total", "Number of our own announcements suppressed by an equal or better proximity"
+)
 
 
 class Manager:
     """
-    Manager of program sub-tasks, executor of the NSE server, NSE scheduler and Gossip client
+    Manager of program sub-tasks, executor of the NSE server, NSE scheduler and Gossip clients
 
     :param conf: full package configuration instance
     """
@@ -25,64 +31,87 @@ class Manager:
         self._conf = conf
         self._logger = logging.getLogger("manager")
         self._server: Optional[asyncio.AbstractServer] = None
-        self._gossip_fails: int = 0
-        self._gossip_protocol: Optional[asyncio.Protocol] = None
-        self.gossip_transport: Optional[asyncio.Transport] = None
+        self._metrics_server: Optional[asyncio.AbstractServer] = None
+        self._profiler: profiling.Profiler = profiling.Profiler(conf)
+        self._gossip: gossip.ConnectionPool = gossip.ConnectionPool(conf, self._make_gossip_protocol)
+        self._notification_cache: gossip.NotificationCache = gossip.NotificationCache(conf.nse.verification_cache_size)
+        self._engine: proof_of_work.Engine = proof_of_work.get_engine(conf)
+        self._message_cache: Optional[nse.MessageCache] = None
+        self._estimates: Optional[nse.EstimateCache] = None
+        if conf.nse.estimate_cache:
+            self._estimates = nse.EstimateCache(conf)
+        self._writer: gossip.RoundWriter = gossip.RoundWriter(
+            conf.nse.flush_interval, conf.nse.flush_batch_size, self._on_flush
+        )
+        if conf.nse.precompute_rounds > 0:
+            self._message_cache = nse.MessageCache(conf)
+        self._scheduler: scheduler.RoundScheduler = scheduler.RoundScheduler(conf.nse.frequency)
+        self._scheduler.subscribe(self._start_nse_round)
+        self._round_handlers: Dict[int, Tuple[nse.RoundHandler, asyncio.Task]] = {}
+        self.avoided_announcements: int = 0
+        """Number of our own announcements which have been suppressed, since an equal or better proximity was known"""
+
+    def _make_gossip_protocol(self, reconnect: Callable[[], None]) -> gossip.Protocol:
+        """
+        Create a new instance of the Gossip API client class for one endpoint of the connection pool
 
-    async def _start_gossip_client(self, loop: asyncio.AbstractEventLoop, first: bool = False) -> bool:
+        :param reconnect: callable to re-connect the endpoint if the connection gets lost
+        :return: new Gossip protocol instance sharing the caches and the write-behind buffer
         """
-        Start a new instance of the Gossip API client class
 
-        Note that this method adds itself to the event loop again if a later
-        Gossip connection suddenly fails. It will wait exponentially longer
-        the more re-connect attempts have previously failed.
+        return gossip.Protocol(self._conf, reconnect, self._notification_cache, self._on_accept, self._writer)
 
-        :param loop: running AsyncIO event loop which should execute the Gossip client
-        :param first: switch to determine whether the current start is the first
-            start of the Gossip client in the program's runtime
-        :return: whether a new Gossip client has successfully established a connection
-        :raises Exception: when the very first connection to the Gossip API fails
+    def _on_flush(self) -> None:
         """
+        Handle newly written rounds in the database
 
-        family, host, port = utils.split_ip_address_and_port(self._conf.gossip.api_address)
-        try:
-            self.gossip_transport, self._gossip_protocol = await loop.create_connection(
-                lambda: gossip.Protocol(self._conf, self.reconnect_client), host, port, family=family
-            )
-
-        except Exception as exc:
-            if first:
-                if self.gossip_transport is None:
-                    self._logger.critical(f"Failed to create a connection to gossip on {host} port {port}: {exc}")
-                raise
-            if self.gossip_transport and self.gossip_transport.is_closing():
-                self.gossip_transport = None
-            self._logger.warning(f"Failed to connect to gossip: {exc}")
-            delay = 1.5 ** self._gossip_fails
-            self._gossip_fails += 1
-            self._logger.debug(f"Sleeping for {delay:.2f} seconds before the next auto-reconnect attempt ...")
-            await asyncio.sleep(delay)
-            loop.create_task(self._start_gossip_client(loop))
-            return False
-
-        if self._gossip_fails > 0:
-            self._logger.info(f"Successfully established a gossip connection after {self._gossip_fails} attempts")
-            self._gossip_fails = 0
-        return True
-
-    def reconnect_client(self):
-        """
-        Create an instant task in the event loop to (re)connect the Gossip client
+        :return: None
+        """
+
+        if self._estimates is not None:
+            self._estimates.invalidate()
+
+    def _on_accept(self, round_id: int, proximity: int) -> None:
+        """
+        Handle a newly accepted best proximity of a round by the Gossip client
+
+        The :class:`p2p_nse5.nse.RoundHandler` of that round is cancelled if the proximity
+        is at least as good as our own, so that no message is built for nothing.
+
+        :param round_id: identifier of the round of the accepted notification
+        :param proximity: new best proximity of the round
+        :return: None
+        """
+
+        handler, task = self._round_handlers.get(round_id, (None, None))
+        if handler is not None and not task.done() and proximity >= handler.own_proximity:
+            self._logger.debug(f"Cancelling the announcement of round {round_id}, found proximity {proximity}")
+            self.avoided_announcements += 1
+            _avoided_announcements.inc()
+            task.cancel()
+
+    def _finish_nse_round(self, round_id: int, task: asyncio.Task) -> None:
+        """
+        Clean up the task of a finished :class:`p2p_nse5.nse.RoundHandler`
 
+        :param round_id: identifier of the round handled by the task
+        :param task: finished task
         :return: None
         """
 
-        loop = asyncio.get_event_loop()
-        loop.create_task(self._start_gossip_client(loop))
+        if self._round_handlers.get(round_id, (None, None))[1] is task:
+            del self._round_handlers[round_id]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self._logger.error(f"NSE round {round_id} failed: {task.exception()!r}", exc_info=task.exception())
+        elif not task.result():
+            self.avoided_announcements += 1
+            _avoided_announcements.inc()
 
     def _send_gossip_announce(self, data: bytes) -> bool:
         """
-        Write arbitrary data as gossip announcement to the current network transport to the gossip API
+        Write arbitrary data as gossip announcement to the healthy connections to the gossip API servers
 
         This function must be called in the context of an async function.
 
@@ -91,29 +120,79 @@ class Manager:
         """
 
         msg = api.pack_gossip_announce(self._conf.nse.data_type, data, self._conf.nse.data_gossip_ttl)
-        if self.gossip_transport is None:
-            self.reconnect_client()
-            return False
-        self.gossip_transport.write(msg)
-        return True
+        return self._gossip.announce(msg)
 
-    async def _schedule_nse_round(self):
+    def _start_nse_round(self, round_id: int, start_time: int) -> None:
         """
-        Schedule the next NSE round and call continue recursively
+        Start the participation in a new NSE round
 
-        This recursive NSE round scheduler calls itself in regular intervals,
-        depending on the setting of the NSE frequency. It will trigger one
+        This hook of the :class:`p2p_nse5.scheduler.RoundScheduler` triggers one
         :meth:`p2p_nse5.nse.RoundHandler.run` call at the start of a new NSE round.
+        The task is kept until it's finished, so that :meth:`_on_accept` can cancel it.
 
+        :param round_id: identifier of the new round
+        :param start_time: UNIX timestamp of the start of the new round
         :return: None
         """
 
-        f = self._conf.nse.frequency
-        await asyncio.sleep(f - int(time.time()) % f - 1)
-        self._logger.debug(f"Triggering next NSE round participation (current time: {int(time.time())})")
-        asyncio.get_running_loop().create_task(nse.RoundHandler(self._conf, self._send_gossip_announce).run())
-        await asyncio.sleep(1)
-        asyncio.get_running_loop().create_task(self._schedule_nse_round())
+        self._logger.debug(f"Triggering NSE round {round_id} participation (current time: {time.time():.3f})")
+        handler = nse.RoundHandler(
+            self._conf, self._send_gossip_announce, self._engine, self._message_cache, self._notification_cache
+        )
+        task = asyncio.get_running_loop().create_task(handler.run())
+        self._round_handlers[handler.round_id] = handler, task
+        task.add_done_callback(functools.partial(self._finish_nse_round, handler.round_id))
+
+    async def _precompute_messages(self):
+        """
+        Prepare our own P2P messages of the upcoming rounds in the background
+
+        This loop fills the :class:`p2p_nse5.nse.MessageCache` once at
+        startup and again shortly after the start of every new round,
+        so that the proof of work for the next rounds is always ready.
+
+        :return: None
+        """
+
+        while True:
+            try:
+                created = await self._message_cache.fill(self._engine)
+                if created > 0:
+                    self._logger.debug(f"Prepared {created} messages for upcoming rounds in advance")
+            except Exception as exc:  # noqa
+                self._logger.exception(f"Failed to prepare messages for upcoming rounds: {exc}")
+            await asyncio.sleep(nse.get_remaining_time(self._conf) + 2)
+
+    async def _compact_database(self):
+        """
+        Remove old rounds and peers from the database in the background
+
+        This loop removes all but the most recent ``retention_rounds`` rounds
+        and peers which haven't been referenced for ``peer_retention_rounds``
+        rounds and runs the configured vacuum of the database every
+        ``compaction_interval`` seconds.
+
+        :return: None
+        """
+
+        backend = storage.get_storage()
+        while True:
+            await asyncio.sleep(self._conf.nse.compaction_interval)
+            oldest_round = None
+            if self._conf.nse.retention_rounds > 0:
+                oldest_round = nse.get_current_round(self._conf) - self._conf.nse.retention_rounds + 1
+            oldest_peer_round = None
+            if self._conf.nse.peer_retention_rounds > 0:
+                oldest_peer_round = nse.get_current_round(self._conf) - self._conf.nse.peer_retention_rounds
+            try:
+                rounds, peers = await backend.compact(oldest_round, oldest_peer_round)
+                self._logger.debug(f"Compaction removed {rounds} rounds and {peers} peers")
+                if rounds > 0 and self._estimates is not None:
+                    self._estimates.invalidate()
+                if await backend.vacuum(self._conf.nse.compaction_vacuum):
+                    self._logger.debug(f"Finished {self._conf.nse.compaction_vacuum} vacuum of the database")
+            except Exception as exc:  # noqa
+                self._logger.exception(f"Failed to compact the database: {exc}")
 
     async def run(self):
         """
@@ -125,25 +204,47 @@ class Manager:
         It's also the executor of the NSE API server,
         listening for incoming connections which uses
         :class:`p2p_nse5.nse.Protocol` as the protocol handler.
-        It will start the recursive NSE scheduler
-        :meth:`_schedule_nse_round` once at startup, after
-        successfully having established a Gossip connection via
-        :meth:`_start_gossip_client`.
+        It will start the :class:`p2p_nse5.scheduler.RoundScheduler`,
+        which calls :meth:`_start_nse_round` for the current and every
+        following round, the :class:`p2p_nse5.gossip.ConnectionPool` of
+        the Gossip clients and the background tasks
+        :meth:`_precompute_messages` and :meth:`_compact_database` if enabled.
+        The endpoint of the metrics and the :class:`p2p_nse5.profiling.Profiler`
+        are started first, if they are configured.
 
         :return: does not return while the Manager executes,
             but will be quit via KeyboardInterrupt
         """
 
         event_loop = asyncio.get_running_loop()
-        event_loop.create_task(self._schedule_nse_round())
-        await self._start_gossip_client(event_loop, True)
+        if self._conf.nse.metrics_address:
+            self._metrics_server = await metrics.serve(self._conf.nse.metrics_address)
+        await self._profiler.start()
+        self._scheduler.start(immediate=True)
+        await self._gossip.start()
+        if self._message_cache is not None:
+            event_loop.create_task(self._precompute_messages())
+        if self._conf.nse.compaction_interval > 0:
+            event_loop.create_task(self._compact_database())
         family, host, port = utils.split_ip_address_and_port(self._conf.nse.api_address)
         self._server = await event_loop.create_server(
-            lambda: nse.Protocol(self._conf), host, port, family=family
+            lambda: nse.Protocol(self._conf, self._estimates), host, port, family=family
         )
         self._logger.info("API server started on host %s and port %d", host, port)
-        async with self._server:
-            await self._server.serve_forever()
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            self._scheduler.stop()
+            self._gossip.close()
+            if self._metrics_server is not None:
+                self._metrics_server.close()
+            self._profiler.close()
+            for _, task in list(self._round_handlers.values()):
+                task.cancel()
+            await self._writer.flush()
+            self._engine.close()
+            storage.get_storage().close()
 
 
 def start(conf: config.Configuration):
@@ -173,8 +274,10 @@ def start(conf: config.Configuration):
     logger = logging.getLogger("entrypoint")
     logger.info("Starting...")
 
-    logger.debug(f"Configuring database using {conf.nse.database!r} ...")
-    persistence.init(conf.nse.database)
+    if conf.nse.storage == "database":
+        logger.debug(f"Configuring database using {conf.nse.database!r} ...")
+    storage.init(conf)
+    p2p.key_cache.size = conf.nse.key_cache_size
 
     try:
         asyncio.run(Manager(conf).run())
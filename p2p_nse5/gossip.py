@@ -3,15 +3,250 @@ Module handling interactions with the Gossip API server
 """
 
 import time
+import random
 import asyncio
 import hashlib
 import logging
-from typing import Callable, ClassVar, Optional
+import functools
+import collections
+import dataclasses
+from typing import Callable, ClassVar, Dict, List, Optional, Set, Union
 
-from . import config, persistence, utils
+from . import config, metrics, storage, utils
 from .protocols import api, p2p
 
 
+_verification_seconds = metrics.registry.histogram(
+    "nse_gossip_verification_seconds", "Duration of the full verification of incoming P2P messages"
+)
+_accepted = metrics.registry.counter(
+    "nse_gossip_accepted_total", "Number of notifications accepted as new best notification of their round"
+)
+_rejected = metrics.registry.counter(
+    "nse_gossip_rejected_total", "Number of rejected notifications by the reason of the rejection", ("reason",)
+)
+
+
+def _unpack_message(msg: bytes, proof_of_work_bits: int) -> Union[p2p.ProtocolMessage, ValueError]:
+    # Executed by worker threads, invalid messages are returned to cache their results as well
+    try:
+        return p2p.unpack_message(msg, proof_of_work_bits=proof_of_work_bits)
+    except ValueError as exc:
+        return exc
+
+
+class NotificationCache:
+    """
+    In-memory state shared by all Gossip clients to discard notifications early
+
+    It keeps the best known proximity of every round inside the acceptance
+    window, so that notifications which can't improve a round are rejected
+    before any cryptographic check. It also keeps the results of the most
+    recent verifications in a LRU cache, keyed by the SHA256 digest of the
+    signed part of the message, so that duplicates relayed by Gossip are
+    accepted or rejected without verifying them again. The verification
+    itself runs in a worker thread, so that floods of distinct forged
+    notifications don't block the event loop, and duplicates arriving
+    during a verification wait for its result instead of starting another one.
+
+    :param size: maximum number of verification results in the LRU cache
+    """
+
+    def __init__(self, size: int = 4096):
+        self._size: int = size
+        self._verified: collections.OrderedDict[bytes, Union[p2p.ProtocolMessage, ValueError]] = \
+            collections.OrderedDict()
+        self._verifying: Dict[bytes, asyncio.Future] = {}
+        # Rounds without any accepted notification are remembered by None
+        self._best_proximity: Dict[int, Optional[int]] = {}
+
+    async def get_best_proximity(self, round_id: int) -> Optional[int]:
+        """
+        Get the best known proximity of a round, loading it from the database on first use
+
+        Rounds which are unknown to the database are remembered as well, so
+        that the database is only queried once per round until :meth:`offer`
+        accepts the first notification of that round.
+
+        :param round_id: round identifier
+        :return: best known proximity or None if no notification was accepted for that round
+        """
+
+        if round_id not in self._best_proximity:
+            proximity = await storage.get_storage().get_proximity(round_id)
+            # The proximity might have been updated while the database was queried
+            best = self._best_proximity.get(round_id)
+            if best is None or (proximity is not None and proximity > best):
+                self._best_proximity[round_id] = proximity
+        return self._best_proximity[round_id]
+
+    def set_best_proximity(self, round_id: int, proximity: int, oldest_round: Optional[int] = None):
+        """
+        Update the best known proximity of a round
+
+        :param round_id: round identifier
+        :param proximity: new best proximity of the round
+        :param oldest_round: optional identifier of the oldest round which should be kept
+        :return: None
+        """
+
+        self._best_proximity[round_id] = proximity
+        if oldest_round is not None:
+            for r in [r for r in self._best_proximity if r < oldest_round]:
+                del self._best_proximity[r]
+
+    def offer(self, round_id: int, proximity: int, oldest_round: Optional[int] = None) -> bool:
+        """
+        Update the best known proximity of a round only if the new proximity is better
+
+        :param round_id: round identifier
+        :param proximity: proximity of a new notification of the round
+        :param oldest_round: optional identifier of the oldest round which should be kept
+        :return: whether the proximity is the new best proximity of the round
+        """
+
+        best = self._best_proximity.get(round_id)
+        if best is not None and best >= proximity:
+            return False
+        self.set_best_proximity(round_id, proximity, oldest_round)
+        return True
+
+    async def verify(self, msg: bytes, header: p2p.MessageHeader, proof_of_work_bits: int) -> p2p.ProtocolMessage:
+        """
+        Fully verify a message using :func:`p2p_nse5.protocols.p2p.unpack_message` unless it's cached
+
+        The message is verified in the default executor of the event loop.
+
+        :param msg: raw bytes string that has been received as incoming NSE P2P message
+        :param header: unpacked header of the same message
+        :param proof_of_work_bits: required bits of the proof of work hash
+        :return: the unpacked message as a ProtocolMessage instance
+        :raises ValueError: whenever something is wrong with the message
+        """
+
+        digest = hashlib.sha256(msg[p2p.SIGNATURE_SKIPPED_PREFIX:]).digest()
+        result = self._verified.get(digest)
+        if result is None:
+            if digest not in self._verifying:
+                self._verifying[digest] = asyncio.ensure_future(self._verify(digest, msg, proof_of_work_bits))
+            result = await asyncio.shield(self._verifying[digest])
+        else:
+            self._verified.move_to_end(digest)
+
+        if isinstance(result, ValueError):
+            raise ValueError(str(result))
+        # The hop count isn't signed, so it may differ for duplicates
+        return dataclasses.replace(result, hop_count=header.hop_count)
+
+    async def _verify(
+            self,
+            digest: bytes,
+            msg: bytes,
+            proof_of_work_bits: int
+    ) -> Union[p2p.ProtocolMessage, ValueError]:
+        try:
+            with _verification_seconds.time():
+                result = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                    _unpack_message, msg, proof_of_work_bits
+                ))
+        finally:
+            del self._verifying[digest]
+        self._verified[digest] = result
+        if len(self._verified) > self._size:
+            self._verified.popitem(last=False)
+        return result
+
+
+class RoundWriter:
+    """
+    Write-behind buffer of accepted notifications shared by all Gossip clients
+
+    Accepted notifications are coalesced in memory, keeping only the best
+    notification and the highest hop count of every round. The buffer is
+    handed over to the storage backend (see :mod:`p2p_nse5.storage`) after
+    ``interval`` seconds or as soon as it contains ``batch_size`` rounds,
+    which writes it to the database in a single transaction, instead of
+    committing every single notification. Stored rounds are only
+    updated if the buffered proximity is better than the stored one.
+
+    :param interval: maximum number of seconds a notification is buffered
+        (``0`` writes it as soon as the event loop gets idle)
+    :param batch_size: number of buffered rounds which triggers writing immediately
+    :param on_flush: optional callable which is called after the buffer
+        has been written successfully, e.g. to invalidate derived caches
+    """
+
+    def __init__(self, interval: float = 1.0, batch_size: int = 256, on_flush: Optional[Callable[[], None]] = None):
+        self._interval: float = interval
+        self._batch_size: int = batch_size
+        self._on_flush: Optional[Callable[[], None]] = on_flush
+        self._pending: Dict[int, storage.RoundUpdate] = {}
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.logger: logging.Logger = logging.getLogger("gossip.writer")
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, round_id: int, proximity: int, hop_count: int, key: p2p.KeyCacheEntry) -> None:
+        """
+        Buffer an accepted notification, replacing any worse notification of the same round
+
+        :param round_id: round identifier
+        :param proximity: proximity of the notification
+        :param hop_count: hop count of the notification
+        :param key: key cache entry of the public key of the notification
+        :return: None
+        """
+
+        pending = self._pending.get(round_id)
+        if pending is None:
+            self._pending[round_id] = storage.RoundUpdate(round_id, proximity, hop_count, key)
+        elif proximity > pending.proximity:
+            self._pending[round_id] = storage.RoundUpdate(round_id, proximity, max(hop_count, pending.max_hops), key)
+        else:
+            pending.max_hops = max(hop_count, pending.max_hops)
+
+        if len(self._pending) >= self._batch_size:
+            self._schedule(0)
+        elif self._handle is None:
+            self._schedule(self._interval)
+
+    def _schedule(self, delay: float) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._handle = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self) -> int:
+        """
+        Write all buffered notifications to the storage backend at once
+
+        :return: number of written rounds
+        """
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if not self._pending:
+            return 0
+        batch, self._pending = list(self._pending.values()), {}
+        try:
+            await storage.get_storage().store_rounds(batch)
+        except Exception as exc:
+            self.logger.error(f"Failed to write {len(batch)} rounds: {exc}", exc_info=exc)
+            return 0
+        self.logger.debug(f"Wrote {len(batch)} rounds to the storage")
+        if self._on_flush is not None:
+            self._on_flush()
+        return len(batch)
+
+
 class Protocol(asyncio.Protocol):
     """
     Implementation of the API protocol to/from the gossip module dependency using the asyncio framework
@@ -20,15 +255,35 @@ class Protocol(asyncio.Protocol):
     :param reconnect: callable that should trigger a reconnection attempt
         of the connection to the Gossip API server, which is usually supplied by
         a manager class, e.g. :class:`p2p_nse5.entrypoint.Manager`
+    :param cache: optional notification cache which should be shared across
+        all instances (otherwise, every instance uses its own cache)
+    :param on_accept: optional callable which gets the round identifier and
+        the new best proximity of that round whenever a notification was accepted
+    :param writer: optional write-behind buffer which should be shared across
+        all instances (otherwise, every instance uses its own buffer)
     """
 
     _instance_counter: ClassVar = utils.counter()
     """Simple counter to give every instance of this class a new increasing number"""
 
-    def __init__(self, conf: config.Configuration, reconnect: Optional[Callable[[], None]] = None):
+    def __init__(
+            self,
+            conf: config.Configuration,
+            reconnect: Optional[Callable[[], None]] = None,
+            cache: Optional[NotificationCache] = None,
+            on_accept: Optional[Callable[[int, int], None]] = None,
+            writer: Optional[RoundWriter] = None
+    ):
         self._conf: config.Configuration = conf
         self._ident: int = next(type(self)._instance_counter)
         self._reconnect: Optional[Callable[[], None]] = reconnect
+        self._cache: NotificationCache = cache or NotificationCache(conf.nse.verification_cache_size)
+        self._on_accept: Optional[Callable[[int, int], None]] = on_accept
+        if writer is None:
+            writer = RoundWriter(conf.nse.flush_interval, conf.nse.flush_batch_size)
+        self._writer: RoundWriter = writer
+        self._framer: api.MessageFramer = api.MessageFramer()
+        self._tasks: Set[asyncio.Task] = set()
         self.logger: logging.Logger = logging.getLogger(f"gossip.client.{self._ident}")
         self.transport: Optional[asyncio.Transport] = None
 
@@ -46,106 +301,142 @@ class Protocol(asyncio.Protocol):
         """
         Handler to be called when some data is received by the underlying TCP transport
 
-        This method will first attempt to parse the incoming TCP packet as
-        a ``GOSSIP_NOTIFICATION`` API message, since no other messages are
+        The incoming data is split into single API messages by a
+        :class:`p2p_nse5.protocols.api.MessageFramer`, since TCP may coalesce
+        multiple notifications into one read or split one across multiple
+        reads. Every complete message is handled by :meth:`_handle_message`.
+
+        :param data: incoming raw data (buffer of bytes from the underlying TCP connection)
+        :return: None
+        """
+
+        try:
+            for msg in self._framer.feed(data):
+                self._handle_message(msg)
+        except api.InvalidMessage as exc:
+            self.logger.warning(f"Invalid API message stream, dropping buffered data: {exc}")
+
+    def _handle_message(self, msg: memoryview) -> None:
+        """
+        Handler of a single complete API message received from Gossip
+
+        This method will first attempt to parse the message as a
+        ``GOSSIP_NOTIFICATION`` API message, since no other messages are
         expected on the Gossip TCP connection anyways. If this fails, the
-        message is silently discarded. Then, the payload of that message will be
-        unpacked as instance of our P2P protocol. If this fails, the message is
-        discarded, and the Gossip server will be notified of an invalid message.
-        In this step, the proof of work is also forcefully verified by
-        :func:`p2p_nse5.protocols.p2p.unpack_message`.
-
-        The remote peer's public key will now be extracted from the validated
-        gossip message. If the peer is already known in the database, the
-        peer ID can be looked up; otherwise, a new peer entry will be created.
-
-        Next, the round is identified. If it's too far in the past or future,
-        the message will be invalidated. Otherwise, if the proximity of the
-        message is sufficiently large (at least one bit higher than any previous
-        proximity for the specified round), it will be accepted.
-
-        :param data: incoming raw message (buffer of bytes from the underlying TCP connection)
+        message is silently discarded. Then, the notification is processed
+        by :meth:`_process` in a new task, since the best known proximity of
+        its round might need to be loaded from the database first.
+
+        :param msg: incoming API message as view of the framer's buffer
         :return: None
         """
 
         try:
-            msg_type, value = api.unpack_incoming_message(data, [api.MessageType.GOSSIP_NOTIFICATION])
+            msg_type, value = api.unpack_incoming_message(msg, [api.MessageType.GOSSIP_NOTIFICATION])
             self.logger.debug(f"Incoming API message: {msg_type=!r}")
         except api.InvalidMessage as exc:
+            _rejected.inc("api")
             self.logger.warning(f"Invalid API message: {exc}")
-            self.logger.debug(f"First {min(len(data), 80)} bytes of incoming ignored/invalid message: {data[:80]}")
+            self.logger.debug(f"First {min(len(msg), 80)} bytes of incoming ignored/invalid message: {bytes(msg[:80])}")
             return
 
+        current_round = int(time.time()) // self._conf.nse.frequency
+        task = asyncio.ensure_future(self._process(value.message_id, bytes(value.data), current_round))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, message_id: int, data: bytes, current_round: int) -> None:
+        """
+        Validate and store a single notification and send the validation result to Gossip
+
+        The payload of the notification will be validated by :meth:`_validate`.
+        If this fails, the message is discarded, and the Gossip server will be
+        notified of an invalid message. Otherwise, :meth:`_accept` stores it.
+
+        :param message_id: message ID of the ``GOSSIP_NOTIFICATION`` message
+        :param data: payload of the ``GOSSIP_NOTIFICATION`` message
+        :param current_round: identifier of the current round
+        :return: None
+        """
+
+        notification = await self._validate(data, current_round)
+        valid = notification is not None and self._accept(notification, current_round)
+        if not self.transport.is_closing():
+            self.transport.write(api.pack_gossip_validation(message_id, valid))
+
+    async def _validate(self, data: bytes, current_round: int) -> Optional[p2p.ProtocolMessage]:
+        """
+        Validate the payload of a notification in stages from cheap to expensive checks
+
+        First, only the header of the P2P message is unpacked. Notifications from
+        the past or too far ahead in the future are rejected, as well as those
+        whose claimed proximity isn't better than the best known proximity of
+        their round. Only then, the proof of work, the signature and the
+        proximity are verified by :meth:`NotificationCache.verify`.
+
+        :param data: payload of the ``GOSSIP_NOTIFICATION`` message
+        :param current_round: identifier of the current round
+        :return: the unpacked message or None if it should be rejected
+        """
+
         try:
-            notification = p2p.unpack_message(
-                value.data,
-                min_proximity=0,
-                proof_of_work_bits=self._conf.nse.proof_of_work_bits
-            )
-            r = notification.round_time // self._conf.nse.frequency
-            self.logger.debug(f"Successfully parsed gossip notification: {notification!r} (round {r})")
-            der_key = notification.public_key.export_key("DER")
+            header = p2p.unpack_header(data)
         except ValueError as exc:
+            _rejected.inc("malformed")
             self.logger.warning(f"Invalid GOSSIP_NOTIFICATION: {exc}")
-            self.transport.write(api.pack_gossip_validation(value.message_id, False))
-            return
+            return None
 
-        current_round = int(time.time()) // self._conf.nse.frequency
-        with persistence.get_new_session() as session:
-
-            # Determining the peer and adding them to our dataset for more efficient storage of rounds
-            peers = session.query(persistence.Peer).filter_by(public_key=der_key).all()
-            if len(peers) == 1:
-                peer = peers[0]
-                self.logger.debug(f"Found peer {peer.id!r} ({peer.interactions!r}) with matching public key")
-            elif len(peers) == 0:
-                peer = persistence.Peer(public_key=der_key, interactions=1)
-                session.add(peer)
-                session.commit()
-                h = hashlib.sha256(notification.public_key.export_key("PEM")).hexdigest()
-                self.logger.debug(f"New peer {peer.id} created for new public key (hash: {h})")
-
-            # Notifications for the current round or any round in the future
-            # (as long as it's not too far ahead) are accepted when they have a
-            # sufficiently high proximity or as the first notification for that round
-            if r == current_round or (r > current_round and r - current_round <= self._conf.nse.max_backlog_rounds):
-                if r > current_round:
-                    self.logger.debug(f"Notification comes from a future round (r={r}, current={current_round})")
-
-                model = session.query(persistence.Round).filter_by(round=current_round).first()
-                if model is not None:
-                    if model.proximity >= notification.proximity:
-                        self.logger.debug(f"Too low proximity {notification.proximity} (best: {model.proximity})")
-                        self.transport.write(api.pack_gossip_validation(value.message_id, False))
-                        return
-
-                    model.proximity = notification.proximity
-                    model.max_hops = max(notification.hop_count, model.max_hops)
-                    model.peer = peer
-                    session.add(model)
-                    session.commit()
-                    self.logger.info(f"Updated round {model.round} to proximity {model.proximity} (peer ID: {peer.id})")
-                    self.transport.write(api.pack_gossip_validation(value.message_id, True))
-                    return
-
-                m = persistence.Round(
-                    round=current_round,
-                    proximity=notification.proximity,
-                    max_hops=notification.hop_count,
-                    peer=peer
-                )
-                session.add(m)
-                session.commit()
-                self.logger.info(
-                    f"Added new round entry {m.id} for {current_round} with proximity "
-                    f"{m.proximity} and max_hops {m.max_hops} (peer ID: {peer.id})"
-                )
-                self.transport.write(api.pack_gossip_validation(value.message_id, True))
-
-            # Notifications from the past or too far ahead in the future are ignored
-            else:
-                self.logger.debug(f"Notification (r={r}) is outdated or too far ahead for now ({current_round})")
-                self.transport.write(api.pack_gossip_validation(value.message_id, False))
+        # Notifications for the current round or any round in the future
+        # (as long as it's not too far ahead) may be accepted
+        r = header.round_time // self._conf.nse.frequency
+        if not current_round <= r <= current_round + self._conf.nse.max_backlog_rounds:
+            _rejected.inc("outdated")
+            self.logger.debug(f"Notification (r={r}) is outdated or too far ahead for now ({current_round})")
+            return None
+        if r > current_round:
+            self.logger.debug(f"Notification comes from a future round (r={r}, current={current_round})")
+
+        best = await self._cache.get_best_proximity(r)
+        if best is not None and best >= header.proximity:
+            _rejected.inc("proximity")
+            self.logger.debug(f"Too low proximity {header.proximity} (best: {best})")
+            return None
+
+        try:
+            notification = await self._cache.verify(data, header, self._conf.nse.proof_of_work_bits)
+        except ValueError as exc:
+            _rejected.inc("invalid")
+            self.logger.warning(f"Invalid GOSSIP_NOTIFICATION: {exc}")
+            return None
+        self.logger.debug(f"Successfully parsed gossip notification: {notification!r} (round {r})")
+        return notification
+
+    def _accept(self, notification: p2p.ProtocolMessage, current_round: int) -> bool:
+        """
+        Accept a validated notification as the new best notification of its round
+
+        The decision is made using the best known proximities of the
+        :class:`NotificationCache`. The notification is then buffered in the
+        :class:`RoundWriter`, which writes it to the database later on, so that
+        the validation result can be sent to Gossip without waiting for it.
+
+        :param notification: validated message with a better proximity than any known one
+        :param current_round: identifier of the current round
+        :return: whether the notification has been accepted
+        """
+
+        r = notification.round_time // self._conf.nse.frequency
+        if not self._cache.offer(r, notification.proximity, current_round):
+            _rejected.inc("superseded")
+            self.logger.debug(f"Too low proximity {notification.proximity} for round {r}")
+            return False
+
+        key = notification.key or p2p.key_cache.get(notification.public_key.export_key("DER"))
+        self._writer.add(r, notification.proximity, notification.hop_count, key)
+        _accepted.inc()
+        if self._on_accept is not None:
+            self._on_accept(r, notification.proximity)
+        return True
 
     def eof_received(self) -> Optional[bool]:
         self.logger.error("Received EOF from gossip. Trying to re-connect ...")
@@ -159,3 +450,164 @@ class Protocol(asyncio.Protocol):
         self.transport.close()
         if self._reconnect is not None:
             asyncio.get_event_loop().call_soon(self._reconnect)
+
+
+@dataclasses.dataclass
+class Endpoint:
+    """
+    Connection state of a single Gossip API server in a :class:`ConnectionPool`
+    """
+
+    address: str
+    """API address of the Gossip server"""
+    transport: Optional[asyncio.Transport] = None
+    protocol: Optional[Protocol] = None
+    failures: int = 0
+    """Number of consecutive failed connection attempts"""
+    connecting: bool = False
+    """Whether a background task is currently trying to re-connect"""
+    announcements: int = 0
+    """Number of announcements written to this Gossip server"""
+
+    @property
+    def healthy(self) -> bool:
+        """Whether the connection is established and usable"""
+        return self.transport is not None and not self.transport.is_closing()
+
+
+class ConnectionPool:
+    """
+    Connections to all configured Gossip API servers with health tracking and failover
+
+    Every endpoint gets its own :class:`Protocol` instance. Lost connections
+    are re-established in the background, waiting exponentially longer after
+    every failed attempt, but never longer than the configured maximum delay
+    (with random jitter, so that restarted Gossip servers aren't hit by all
+    clients at once). Announcements are written to the first healthy endpoint
+    in the configured order (``failover``) or to all healthy endpoints
+    (``fanout``), depending on the ``announce_mode`` of the configuration.
+
+    :param conf: package configuration instance for a NSE5 instance
+    :param factory: callable accepting the callback to re-connect the
+        endpoint which returns a new protocol instance for the endpoint
+    """
+
+    backoff_base: float = 1.5
+    """Base of the exponential backoff between two connection attempts"""
+
+    def __init__(self, conf: config.Configuration, factory: Callable[[Callable[[], None]], Protocol]):
+        self._conf: config.Configuration = conf
+        self._factory: Callable[[Callable[[], None]], Protocol] = factory
+        self._tasks: Set[asyncio.Task] = set()
+        self._closed: bool = False
+        self.endpoints: List[Endpoint] = [Endpoint(address) for address in conf.gossip.api_addresses]
+        self.logger: logging.Logger = logging.getLogger("gossip.pool")
+
+    @property
+    def healthy(self) -> List[Endpoint]:
+        """List of all healthy endpoints in the configured order"""
+        return [endpoint for endpoint in self.endpoints if endpoint.healthy]
+
+    def get_delay(self, failures: int) -> float:
+        """
+        Calculate the delay before the next connection attempt to an endpoint
+
+        :param failures: number of consecutive failed connection attempts
+        :return: capped and jittered delay in seconds
+        """
+
+        delay = min(self.backoff_base ** min(failures, 64), self._conf.gossip.reconnect_max_delay)
+        return delay * (0.5 + random.random() / 2)
+
+    async def _connect(self, endpoint: Endpoint) -> None:
+        family, host, port = utils.split_ip_address_and_port(endpoint.address)
+        endpoint.transport, endpoint.protocol = await asyncio.get_running_loop().create_connection(
+            lambda: self._factory(functools.partial(self.reconnect, endpoint)), host, port, family=family
+        )
+
+    async def start(self) -> None:
+        """
+        Connect to all endpoints, failed endpoints are re-connected in the background
+
+        :return: None
+        :raises Exception: when not a single endpoint could be connected
+        """
+
+        results = await asyncio.gather(*[self._connect(e) for e in self.endpoints], return_exceptions=True)
+        for endpoint, result in zip(self.endpoints, results):
+            if isinstance(result, Exception):
+                self.logger.warning(f"Failed to connect to gossip on {endpoint.address}: {result}")
+        if not self.healthy:
+            self.logger.critical("Failed to create a connection to any gossip endpoint")
+            raise next(r for r in results if isinstance(r, Exception))
+        for endpoint, result in zip(self.endpoints, results):
+            if isinstance(result, Exception):
+                endpoint.failures += 1
+                self.reconnect(endpoint)
+
+    def reconnect(self, endpoint: Endpoint) -> None:
+        """
+        Start a background task to re-connect the endpoint, if there's none already
+
+        :param endpoint: endpoint of this pool which lost its connection
+        :return: None
+        """
+
+        if self._closed or endpoint.connecting:
+            return
+        endpoint.connecting = True
+        task = asyncio.get_running_loop().create_task(self._reconnect(endpoint))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _reconnect(self, endpoint: Endpoint) -> None:
+        try:
+            while not self._closed:
+                if endpoint.failures > 0:
+                    delay = self.get_delay(endpoint.failures)
+                    self.logger.debug(f"Sleeping for {delay:.2f} seconds before re-connecting to {endpoint.address}")
+                    await asyncio.sleep(delay)
+                try:
+                    await self._connect(endpoint)
+                except Exception as exc:  # noqa
+                    endpoint.failures += 1
+                    self.logger.warning(f"Failed to connect to gossip on {endpoint.address}: {exc}")
+                    continue
+                if endpoint.failures > 0:
+                    self.logger.info(
+                        f"Successfully re-connected to gossip on {endpoint.address} after {endpoint.failures} attempts"
+                    )
+                    endpoint.failures = 0
+                return
+        finally:
+            endpoint.connecting = False
+
+    def announce(self, data: bytes) -> bool:
+        """
+        Write a packed API message to the healthy endpoints according to the announce mode
+
+        :param data: complete API message
+        :return: whether the message was written to at least one endpoint
+        """
+
+        healthy = self.healthy
+        if self._conf.gossip.announce_mode == "failover":
+            healthy = healthy[:1]
+        for endpoint in healthy:
+            endpoint.transport.write(data)
+            endpoint.announcements += 1
+        return len(healthy) > 0
+
+    def close(self) -> None:
+        """
+        Close all connections and stop re-connecting
+
+        :return: None
+        """
+
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        for endpoint in self.endpoints:
+            if endpoint.transport is not None:
+                endpoint.transport.close()
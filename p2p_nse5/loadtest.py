@@ -0,0 +1,641 @@
+"""
+Module providing load generators which measure the capacity of a running NSE instance
+
+The :class:`GossipLoadGenerator` takes the role of the Gossip API server. It waits
+for the NSE instance to connect and subscribe to its data type, then it sends
+``GOSSIP_NOTIFICATION`` messages at a fixed rate, regardless of how fast they
+are validated (open-loop). The payloads are taken from a corpus, which is built
+in advance by :func:`build_messages` and :func:`make_corpus`, so that the proof
+of work and the signatures don't limit the rate of the generator. The time
+between the scheduled sending of a notification and receiving its
+``GOSSIP_VALIDATION`` is the validation latency, the number of notifications
+without validation so far is the backlog of the instance. A backlog which keeps
+growing shows that the rate is higher than the instance can sustain.
+
+The :class:`QueryLoadGenerator` sends ``NSE_QUERY`` messages to the API of a NSE
+instance at fixed rates, either over a new connection for every query or pipelined
+over persistent connections. It reports the latency percentiles of the answers,
+the error rates and the throughput, which helps to size the capacity of the API.
+
+Use the commands ``python -m p2p_nse5 gossip-load`` and ``python -m p2p_nse5 query-load``
+to run them from the command line.
+"""
+
+import math
+import random
+import struct
+import asyncio
+import logging
+import itertools
+import collections
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from Crypto.PublicKey import RSA
+
+from . import proof_of_work, utils
+from .protocols import api, p2p
+
+
+PERCENTILES: Tuple[float, ...] = (0.5, 0.9, 0.99, 0.999)
+"""Percentiles of the latencies included in the reports"""
+
+INVALID_KINDS: Tuple[str, ...] = ("forged", "malformed", "outdated")
+"""Kinds of invalid notifications of a corpus (see :func:`make_corpus`)"""
+
+_NOTIFICATION_HEADER = struct.Struct("!HHHH")
+
+
+def get_percentile(values: Sequence[float], q: float) -> float:
+    """
+    Get a percentile of some sorted values using the nearest-rank method
+
+    :param values: values sorted in ascending order
+    :param q: percentile as a fraction, e.g. ``0.99``
+    :return: smallest value which is at least as large as the fraction q of all values (0 without values)
+    """
+
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+def summarize_latencies(latencies: Iterable[float]) -> Dict[str, float]:
+    """
+    Summarize latencies by their mean, maximum and :data:`PERCENTILES`
+
+    :param latencies: unsorted latencies in seconds
+    :return: mapping with the keys ``mean``, ``max`` and e.g. ``p50`` or ``p999``
+    """
+
+    values = sorted(latencies)
+    summary = {"mean": sum(values) / len(values) if values else 0.0, "max": values[-1] if values else 0.0}
+    for q in PERCENTILES:
+        summary[f"p{q * 100:g}".replace(".", "")] = get_percentile(values, q)
+    return summary
+
+
+def _get_slope(samples: Sequence[Tuple[float, int]]) -> float:
+    # Least squares fit of the samples, which is less sensitive to bursts than the difference of the last and first one
+    if len(samples) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in samples) / len(samples)
+    mean_y = sum(y for _, y in samples) / len(samples)
+    variance = sum((x - mean_x) ** 2 for x, _ in samples)
+    if variance == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in samples) / variance
+
+
+async def build_messages(
+        keys: Iterable[RSA.RsaKey],
+        round_times: Iterable[int],
+        proof_of_work_bits: int,
+        engine: Optional[proof_of_work.Engine] = None
+) -> List[bytes]:
+    """
+    Build valid P2P messages of every key for every round
+
+    The messages are ordered by rounds first, then by ascending proximity,
+    so that every message of a round can become the new best notification of
+    the round when sending them in order. Rounds are interleaved, though.
+
+    :param keys: RSA 4096 bit private keys of the simulated peers
+    :param round_times: start times of the rounds
+    :param proof_of_work_bits: required bits of the proof of work hash
+    :param engine: proof of work engine (defaults to a :class:`p2p_nse5.proof_of_work.ThreadEngine`)
+    :return: list of valid P2P messages
+    """
+
+    engine = engine or proof_of_work.ThreadEngine()
+    keys = list(keys)
+    rounds = []
+    for round_time in round_times:
+        ordered = sorted(keys, key=lambda k: p2p.calculate_proximity(k, round_time))
+        rounds.append([
+            await engine.build_message(k, round_time, proof_of_work_bits=proof_of_work_bits) for k in ordered
+        ])
+    return [msg for messages in itertools.zip_longest(*rounds) for msg in messages if msg is not None]
+
+
+def _make_invalid(kind: str, msg: bytes, rng: random.Random) -> bytes:
+    if kind == "forged":
+        # The header and the proof of work are still valid, only the signature check fails
+        return msg[:-p2p.SIGNATURE_LENGTH] + rng.randbytes(p2p.SIGNATURE_LENGTH)
+    if kind == "malformed":
+        return msg[:rng.randrange(1, len(msg))]
+    raise ValueError(f"Unknown kind of invalid notification {kind!r}")
+
+
+def make_corpus(
+        messages: Sequence[bytes],
+        count: int,
+        duplicates: float = 0.25,
+        invalid: float = 0.1,
+        seed: Optional[int] = None,
+        outdated: Sequence[bytes] = ()
+) -> List[Tuple[str, bytes]]:
+    """
+    Mix valid messages with duplicates and invalid messages into a corpus of notifications
+
+    Every valid message is used once in its given order, as long as there are
+    valid messages left, after that duplicates are used instead. Duplicates are
+    earlier valid messages with a random hop count, like Gossip would relay them.
+    Invalid messages are used in turns: ``forged`` ones are valid messages with
+    a random signature, ``malformed`` ones are truncated valid messages and
+    ``outdated`` ones are taken from the given outdated messages, if any.
+
+    :param messages: valid P2P messages, e.g. built by :func:`build_messages`
+    :param count: number of notifications in the corpus
+    :param duplicates: fraction of duplicates
+    :param invalid: fraction of invalid messages
+    :param seed: optional seed to reproduce a corpus
+    :param outdated: correctly signed P2P messages of rounds which aren't accepted
+        anymore, e.g. built by :func:`build_messages` for the previous round
+    :return: list of the kind (``valid``, ``duplicate`` or one of :data:`INVALID_KINDS`) and the payload
+    :raises ValueError: for invalid fractions or without any valid messages
+    """
+
+    if not messages:
+        raise ValueError("At least one valid message is required")
+    if duplicates < 0 or invalid < 0 or duplicates + invalid > 1:
+        raise ValueError("Fractions must not be negative and must not exceed 1 in total")
+
+    rng = random.Random(seed)
+    unused = iter(messages)
+    used = []
+    invalid_kinds = itertools.cycle([k for k in INVALID_KINDS if outdated or k != "outdated"])
+    corpus = []
+    for _ in range(count):
+        x = rng.random()
+        if x < invalid:
+            kind = next(invalid_kinds)
+            if kind == "outdated":
+                corpus.append((kind, rng.choice(outdated)))
+            else:
+                corpus.append((kind, _make_invalid(kind, rng.choice(messages), rng)))
+            continue
+        msg = None if x < invalid + duplicates and used else next(unused, None)
+        if msg is not None:
+            used.append(msg)
+            corpus.append(("valid", msg))
+        else:
+            msg = rng.choice(used or messages)
+            corpus.append(("duplicate", msg[:1] + struct.pack("!H", rng.randrange(1, 64)) + msg[3:]))
+    return corpus
+
+
+class _GossipServerProtocol(asyncio.Protocol):
+    def __init__(self, generator: "GossipLoadGenerator"):
+        self._generator = generator
+        self._framer = api.MessageFramer()
+        self._served = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self._served = self._generator.connection_made(transport)
+
+    def data_received(self, data: bytes) -> None:
+        if not self._served:
+            return
+        try:
+            for msg in self._framer.feed(data):
+                self._generator.message_received(msg)
+        except api.InvalidMessage as exc:
+            self._generator.logger.warning(f"Invalid API message stream of the NSE instance: {exc}")
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self._served:
+            self._generator.connection_lost(exc)
+
+
+class GossipLoadGenerator:
+    """
+    Fake Gossip API server sending notifications of a corpus to a NSE instance at a fixed rate
+
+    Only the first connecting NSE instance is served. Call :meth:`start`
+    first and start the NSE instance afterwards, then :meth:`run` the load.
+    Message identifiers are 16 bit integers, so notifications are skipped while
+    their identifier is still waiting for its validation (after 65536 others).
+
+    :param corpus: list of kinds and payloads of notifications (see :func:`make_corpus`)
+    :param rate: number of notifications sent per second
+    :param data_type: data type of the notifications, which the instance needs to subscribe to
+    :param drain_timeout: number of seconds to wait for outstanding validations after the last notification
+    :param sample_interval: number of seconds between two samples of the backlog
+    """
+
+    def __init__(
+            self,
+            corpus: Sequence[Tuple[str, bytes]],
+            rate: float,
+            data_type: int,
+            drain_timeout: float = 5.0,
+            sample_interval: float = 0.1
+    ):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.corpus: Sequence[Tuple[str, bytes]] = corpus
+        self.rate: float = rate
+        self.data_type: int = data_type
+        self.drain_timeout: float = drain_timeout
+        self.sample_interval: float = sample_interval
+        self.announcements: int = 0
+        """Number of ``GOSSIP_ANNOUNCE`` messages received from the instance"""
+        self.logger: logging.Logger = logging.getLogger("loadtest.gossip")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._transport: Optional[asyncio.Transport] = None
+        self._subscribed: asyncio.Event = asyncio.Event()
+        self._drained: asyncio.Event = asyncio.Event()
+        self._sending: bool = False
+        self._pending: Dict[int, Tuple[str, float]] = {}
+        self._results: List[Tuple[str, bool, float]] = []
+        self._samples: List[Tuple[float, int]] = []
+        self._sent: collections.Counter = collections.Counter()
+
+    @property
+    def backlog(self) -> int:
+        """Number of notifications which have been sent, but not validated yet"""
+        return len(self._pending)
+
+    async def start(self, address: str) -> asyncio.AbstractServer:
+        """
+        Start listening for the connection of the NSE instance
+
+        :param address: IPv4 or IPv6 address with port (see
+            :func:`p2p_nse5.utils.split_ip_address_and_port`)
+        :return: the started server, which is closed by :meth:`run`
+        :raises ValueError: for invalid addresses
+        """
+
+        family, host, port = utils.split_ip_address_and_port(address)
+        self._server = await asyncio.get_running_loop().create_server(
+            lambda: _GossipServerProtocol(self), host, port, family=family
+        )
+        self.logger.info(f"Waiting for a NSE instance to connect to {address}")
+        return self._server
+
+    def connection_made(self, transport: asyncio.Transport) -> bool:
+        """Handler of a new connection of a NSE instance, which returns whether it's served (only the first one)"""
+        if self._transport is not None:
+            self.logger.warning("Closing an additional connection, only one NSE instance is served")
+            transport.close()
+            return False
+        self._transport = transport
+        self.logger.info("NSE instance connected from %s port %d", *transport.get_extra_info("peername")[:2])
+        return True
+
+    def message_received(self, msg: memoryview) -> None:
+        """Handler of a single complete API message received from the NSE instance"""
+        if len(msg) < 8:
+            self.logger.warning(f"Too short API message of the NSE instance: {bytes(msg)}")
+            return
+        size, msg_type, value, data_type = _NOTIFICATION_HEADER.unpack(msg[:8])
+        if msg_type == api.MessageType.GOSSIP_NOTIFY:
+            if data_type != self.data_type:
+                self.logger.warning(f"NSE instance subscribed to data type {data_type}, not {self.data_type}")
+            self._subscribed.set()
+        elif msg_type == api.MessageType.GOSSIP_ANNOUNCE:
+            self.announcements += 1
+        elif msg_type == api.MessageType.GOSSIP_VALIDATION:
+            # The message identifier is the third field, the validity is the fourth one
+            pending = self._pending.pop(value, None)
+            if pending is None:
+                self.logger.warning(f"Unexpected validation of message ID {value}")
+                return
+            kind, sent = pending
+            self._results.append((kind, bool(data_type & 1), asyncio.get_running_loop().time() - sent))
+            if not self._sending and not self._pending:
+                self._drained.set()
+        else:
+            self.logger.warning(f"Unexpected API message type {msg_type} of the NSE instance")
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        """Handler of a lost connection of the NSE instance"""
+        if self._server is not None:
+            self.logger.error("Lost the connection of the NSE instance", exc_info=exc)
+        self._drained.set()
+
+    async def _sample(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._samples.append((loop.time(), len(self._pending)))
+            await asyncio.sleep(self.sample_interval)
+
+    async def _send(self) -> Tuple[int, int]:
+        # Notifications are sent at their scheduled time, independent of the validations
+        # (open-loop); if the loop falls behind, all overdue notifications are sent at once
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        sent = skipped = 0
+        for i, (kind, payload) in enumerate(self.corpus):
+            scheduled = start + i / self.rate
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._transport.is_closing():
+                break
+            message_id = i % 65536
+            if message_id in self._pending:
+                skipped += 1
+                continue
+            self._pending[message_id] = (kind, scheduled)
+            self._transport.write(_NOTIFICATION_HEADER.pack(
+                8 + len(payload), api.MessageType.GOSSIP_NOTIFICATION, message_id, self.data_type
+            ) + payload)
+            self._sent[kind] += 1
+            sent += 1
+        return sent, skipped
+
+    async def run(self, connect_timeout: Optional[float] = 60.0) -> Dict:
+        """
+        Wait for the NSE instance, send the whole corpus and collect the validations
+
+        :param connect_timeout: number of seconds to wait for the NSE
+            instance to connect and subscribe (None waits forever)
+        :return: JSON-serializable report of the run
+        :raises RuntimeError: if :meth:`start` hasn't been called before
+        :raises asyncio.TimeoutError: if the instance didn't subscribe in time
+        """
+
+        if self._server is None:
+            raise RuntimeError("Load generator hasn't been started")
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(self._subscribed.wait(), connect_timeout)
+            self.logger.info(f"Sending {len(self.corpus)} notifications at {self.rate} per second")
+            sampler = loop.create_task(self._sample())
+            try:
+                self._sending = True
+                start = loop.time()
+                sent, skipped = await self._send()
+                duration = loop.time() - start
+                self._sending = False
+                backlog = len(self._pending)
+                growth = _get_slope(self._samples)
+                if self._pending and not self._transport.is_closing():
+                    self._drained.clear()
+                    try:
+                        await asyncio.wait_for(self._drained.wait(), self.drain_timeout)
+                    except asyncio.TimeoutError:
+                        self.logger.warning(f"{len(self._pending)} notifications haven't been validated in time")
+                total_duration = loop.time() - start
+            finally:
+                sampler.cancel()
+        finally:
+            self._server.close()
+            self._server = None
+            if self._transport is not None:
+                self._transport.close()
+
+        return self._make_report(sent, skipped, duration, total_duration, backlog, growth)
+
+    def _make_report(
+            self,
+            sent: int,
+            skipped: int,
+            duration: float,
+            total_duration: float,
+            backlog: int,
+            growth: float
+    ) -> Dict:
+        accepted = sum(valid for _, valid, _ in self._results)
+        kinds = {}
+        for kind in ("valid", "duplicate", *INVALID_KINDS):
+            results = [(valid, latency) for k, valid, latency in self._results if k == kind]
+            kinds[kind] = {
+                "sent": self._sent[kind],
+                "accepted": sum(valid for valid, _ in results),
+                "rejected": sum(not valid for valid, _ in results),
+                "latency_seconds": summarize_latencies(latency for _, latency in results)
+            }
+        return {
+            "offered_per_second": self.rate,
+            "duration_seconds": duration,
+            "sent": sent,
+            "skipped": skipped,
+            "validated": len(self._results),
+            "unanswered": len(self._pending),
+            "accepted": accepted,
+            "rejected": len(self._results) - accepted,
+            "sent_per_second": sent / duration if duration > 0 else 0.0,
+            "validated_per_second": len(self._results) / total_duration if total_duration > 0 else 0.0,
+            "accepted_per_second": accepted / total_duration if total_duration > 0 else 0.0,
+            "rejected_per_second": (len(self._results) - accepted) / total_duration if total_duration > 0 else 0.0,
+            "latency_seconds": summarize_latencies(latency for _, _, latency in self._results),
+            "backlog": {
+                "max": max((n for _, n in self._samples), default=0),
+                "end_of_sending": backlog,
+                "growth_per_second": growth
+            },
+            "announcements": self.announcements,
+            "kinds": kinds
+        }
+
+
+_QUERY = struct.pack("!HH", 4, api.MessageType.NSE_QUERY)
+_ESTIMATE_HEADER = struct.Struct("!HH")
+
+
+class _QueryClientProtocol(asyncio.Protocol):
+    def __init__(self, generator: "QueryLoadGenerator", single: bool):
+        self._generator = generator
+        self._single = single
+        self._framer = api.MessageFramer()
+        self._sent: collections.deque = collections.deque()
+        self.transport: Optional[asyncio.Transport] = None
+        self.closed: bool = False
+
+    def query(self, sent: float) -> None:
+        # Queries made before the connection is established are sent as soon as it is
+        self._sent.append(sent)
+        if self.transport is not None:
+            self.transport.write(_QUERY)
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        transport.write(_QUERY * len(self._sent))
+
+    def data_received(self, data: bytes) -> None:
+        now = asyncio.get_running_loop().time()
+        try:
+            for msg in self._framer.feed(data):
+                if self._sent:
+                    self._generator.record(self._sent.popleft(), now, msg)
+                else:
+                    self._generator.record_error("unexpected")
+        except api.InvalidMessage:
+            self.fail("invalid")
+            self.transport.close()
+            return
+        if self._single and not self._sent:
+            self.transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.fail("closed")
+
+    def fail(self, reason: str) -> None:
+        self.closed = True
+        self._generator.forget(self)
+        if self._sent:
+            self._generator.record_error(reason, len(self._sent))
+            self._sent.clear()
+
+
+class QueryLoadGenerator:
+    """
+    Client sending ``NSE_QUERY`` messages to the API of a NSE instance at fixed rates
+
+    Queries are sent at their scheduled time, regardless of how fast they are
+    answered (open-loop). Without persistent connections, every query opens a
+    new connection, so that a slow instance leads to thousands of concurrent
+    connections (mind the limit of open files). Otherwise, queries are pipelined
+    in turns over the persistent connections, which are re-opened when the
+    instance closes them (e.g. due to ``api_max_queries``).
+
+    Queries fail with one of the reasons ``connect`` (the connection couldn't
+    be established), ``closed`` (the connection was closed before the answer),
+    ``invalid`` (the answer is no ``NSE_ESTIMATE``), ``timeout`` (the answer
+    took longer than the timeout) or ``unexpected`` (an answer without query).
+    Latencies are measured from the scheduled time of a query, so that delays
+    of the generator itself aren't hidden when it can't keep up with the rate.
+
+    :param address: IPv4 or IPv6 address with port of the API of the NSE instance
+    :param connections: number of persistent connections (0 opens a new connection for every query)
+    :param timeout: number of seconds after which a query without answer has failed
+    :raises ValueError: for invalid addresses
+    """
+
+    def __init__(self, address: str, connections: int = 0, timeout: float = 5.0):
+        self.address: str = address
+        self.family, self.host, self.port = utils.split_ip_address_and_port(address)
+        self.connections: int = connections
+        self.timeout: float = timeout
+        self.logger: logging.Logger = logging.getLogger("loadtest.query")
+        self._slots: List[Optional[_QueryClientProtocol]] = []
+        self._protocols: Set[_QueryClientProtocol] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._latencies: List[float] = []
+        self._errors: collections.Counter = collections.Counter()
+        self._in_flight: int = 0
+        self._sending: bool = False
+        self._drained: Optional[asyncio.Event] = None
+
+    def record(self, sent: float, received: float, msg: memoryview) -> None:
+        """Handler of an answer of a query sent at the given time"""
+        self._in_flight -= 1
+        if len(msg) != 12 or _ESTIMATE_HEADER.unpack(msg[:4])[1] != api.MessageType.NSE_ESTIMATE:
+            self._errors["invalid"] += 1
+        elif received - sent > self.timeout:
+            self._errors["timeout"] += 1
+        else:
+            self._latencies.append(received - sent)
+        self._check_drained()
+
+    def record_error(self, reason: str, count: int = 1) -> None:
+        """Handler of failed queries (or of answers without query for the reason ``unexpected``)"""
+        if reason != "unexpected":
+            self._in_flight -= count
+        self._errors[reason] += count
+        self._check_drained()
+
+    def forget(self, protocol: _QueryClientProtocol) -> None:
+        """Handler of a closed connection, which won't be used anymore"""
+        self._protocols.discard(protocol)
+
+    def _check_drained(self) -> None:
+        if not self._sending and self._in_flight <= 0 and self._drained is not None:
+            self._drained.set()
+
+    async def _connect(self, protocol: _QueryClientProtocol) -> None:
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().create_connection(
+                lambda: protocol, self.host, self.port, family=self.family
+            ), self.timeout)
+        except (OSError, asyncio.TimeoutError) as exc:
+            self.logger.debug(f"Failed to connect to {self.address}: {exc}")
+            protocol.fail("connect")
+
+    def _open(self, single: bool) -> _QueryClientProtocol:
+        protocol = _QueryClientProtocol(self, single)
+        self._protocols.add(protocol)
+        task = asyncio.get_running_loop().create_task(self._connect(protocol))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return protocol
+
+    def _query(self, index: int, sent: float) -> None:
+        self._in_flight += 1
+        if not self.connections:
+            self._open(True).query(sent)
+            return
+        slot = index % self.connections
+        protocol = self._slots[slot]
+        if protocol is None or protocol.closed:
+            protocol = self._slots[slot] = self._open(False)
+        protocol.query(sent)
+
+    def _close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for protocol in list(self._protocols):
+            protocol.fail("timeout")
+            if protocol.transport is not None:
+                protocol.transport.close()
+        self._protocols.clear()
+        self._slots = [None] * self.connections
+
+    async def run(self, rate: float, duration: float) -> Dict:
+        """
+        Send queries at a fixed rate for some time and wait for their answers
+
+        :param rate: number of queries sent per second
+        :param duration: number of seconds queries are sent
+        :return: JSON-serializable report of the run
+        :raises ValueError: for non-positive rates or durations
+        """
+
+        if rate <= 0 or duration <= 0:
+            raise ValueError("Rate and duration must be positive")
+        loop = asyncio.get_running_loop()
+        self._slots = [None] * self.connections
+        self._latencies, self._errors, self._in_flight = [], collections.Counter(), 0
+        self._drained = asyncio.Event()
+        max_in_flight = 0
+
+        self.logger.info(f"Sending queries to {self.address} at {rate} per second for {duration} seconds")
+        self._sending = True
+        start = loop.time()
+        try:
+            for i in range(max(1, round(rate * duration))):
+                scheduled = start + i / rate
+                delay = scheduled - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._query(i, scheduled)
+                max_in_flight = max(max_in_flight, self._in_flight)
+            sent = i + 1
+            sending_duration = loop.time() - start
+            self._sending = False
+            self._check_drained()
+            try:
+                await asyncio.wait_for(self._drained.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(f"{self._in_flight} queries haven't been answered in time")
+            total_duration = loop.time() - start
+        finally:
+            self._sending = False
+            self._close()
+
+        errors = sum(self._errors.values())
+        return {
+            "offered_per_second": rate,
+            "duration_seconds": sending_duration,
+            "sent": sent,
+            "answered": len(self._latencies),
+            "failed": errors,
+            "errors": dict(self._errors),
+            "error_rate": errors / sent,
+            "sent_per_second": sent / sending_duration if sending_duration > 0 else 0.0,
+            "answered_per_second": len(self._latencies) / total_duration if total_duration > 0 else 0.0,
+            "max_in_flight": max_in_flight,
+            "latency_seconds": summarize_latencies(self._latencies)
+        }
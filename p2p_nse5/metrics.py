@@ -0,0 +1,367 @@
+"""
+Module providing a low-overhead registry of metrics and its exposition in the Prometheus text format
+
+Instrumented modules create their metrics once at import time using the global
+:data:`registry`. Recording values is skipped as long as the registry is disabled,
+which is the default, so that the instrumentation costs a single attribute lookup
+only. The registry is enabled by :func:`serve`, which starts a local HTTP endpoint
+answering every ``GET`` request of ``/metrics`` with the current values.
+
+The endpoint has no authentication at all. It only binds to addresses of localhost
+(:const:`DEFAULT_HOST` unless configured otherwise) or to Unix sockets, so that
+the metrics are only exposed to other programs and users of the same machine.
+"""
+
+import abc
+import time
+import bisect
+import asyncio
+import logging
+import contextlib
+from typing import ClassVar, ContextManager, Dict, List, Optional, Sequence, Tuple
+
+from . import utils
+
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+"""Default upper bounds of the buckets of a :class:`Histogram` in seconds"""
+
+CONTENT_TYPE: str = "text/plain; version=0.0.4; charset=utf-8"
+"""Content type of the Prometheus text format"""
+
+UNIX_PREFIX: str = "unix:"
+"""Prefix of addresses of the endpoint which are paths of Unix sockets"""
+
+DEFAULT_HOST: str = "127.0.0.1"
+"""Address of the endpoint if only a port has been given"""
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Metric(abc.ABC):
+    """
+    Base class of all metrics of a :class:`Registry`
+
+    :param registry: registry which owns the metric
+    :param name: unique name of the metric
+    :param documentation: help text of the metric
+    """
+
+    type: ClassVar[str] = "untyped"
+    """Type of the metric in the Prometheus text format"""
+
+    def __init__(self, registry: "Registry", name: str, documentation: str):
+        self.name: str = name
+        self.documentation: str = documentation
+        self._registry: Registry = registry
+
+    @property
+    def enabled(self) -> bool:
+        """Whether new values are recorded"""
+        return self._registry.enabled
+
+    @abc.abstractmethod
+    def collect(self) -> List[str]:
+        """
+        Export the current values of the metric
+
+        :return: list of lines in the Prometheus text format without the help and type lines
+        """
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        """
+        Reset all recorded values of the metric
+
+        :return: None
+        """
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter, optionally partitioned by the values of some labels
+
+    :param labels: names of the labels whose values partition the counter
+    """
+
+    type = "counter"
+
+    def __init__(self, registry: "Registry", name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(registry, name, documentation)
+        self.labels: Tuple[str, ...] = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        """
+        Increase the counter
+
+        :param values: values of the labels of the counter in the order of their names
+        :param amount: non-negative amount which should be added
+        :return: None
+        """
+
+        if self._registry.enabled:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def get(self, *values: str) -> float:
+        """
+        Get the current value of the counter
+
+        :param values: values of the labels of the counter in the order of their names
+        :return: current value (0 if it has never been increased)
+        """
+
+        return self._values.get(values, 0)
+
+    def collect(self) -> List[str]:
+        if not self.labels and not self._values:
+            return [f"{self.name} 0"]
+        return [f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in sorted(self._values.items())]
+
+    def clear(self) -> None:
+        self._values.clear()
+
+
+class _Timer:
+    def __init__(self, histogram: "Histogram"):
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in buckets with fixed upper bounds
+
+    :param buckets: ascending upper bounds of the buckets (an implicit
+        bucket of all values is added automatically)
+    """
+
+    type = "histogram"
+
+    def __init__(
+            self,
+            registry: "Registry",
+            name: str,
+            documentation: str,
+            buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(registry, name, documentation)
+        if list(buckets) != sorted(set(buckets)):
+            raise ValueError("Buckets must be unique and sorted in ascending order")
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        self._counts: List[int] = [0] * (len(self.buckets) + 1)
+        self._sum: float = 0.0
+
+    @property
+    def count(self) -> int:
+        """Total number of observed values"""
+        return sum(self._counts)
+
+    @property
+    def sum(self) -> float:
+        """Sum of all observed values"""
+        return self._sum
+
+    def observe(self, value: float) -> None:
+        """
+        Add a new value to the distribution
+
+        :param value: observed value, e.g. a duration in seconds
+        :return: None
+        """
+
+        if self._registry.enabled:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def time(self) -> ContextManager:
+        """
+        Observe the duration of a ``with`` block in seconds
+
+        :return: context manager which measures the duration of its block (if enabled)
+        """
+
+        if self._registry.enabled:
+            return _Timer(self)
+        return contextlib.nullcontext()
+
+    def collect(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound!r}"}} {cumulative}')
+        cumulative += self._counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self._sum!r}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+    def clear(self) -> None:
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+
+class Registry:
+    """
+    Collection of uniquely named metrics
+
+    Metrics are created by :meth:`counter` and :meth:`histogram`, which
+    return the existing metric if a metric of that name exists already.
+    """
+
+    def __init__(self):
+        self.enabled: bool = False
+        """Switch to record new values of all metrics of this registry"""
+        self._metrics: Dict[str, Metric] = {}
+
+    def _get(self, cls: type, name: str, *args) -> Metric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(self, name, *args)
+        elif type(metric) is not cls:
+            raise ValueError(f"Metric {name!r} exists already as {metric.type}")
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        """
+        Create a new counter or get the existing one of the same name
+
+        :param name: unique name of the counter
+        :param documentation: help text of the counter
+        :param labels: names of the labels whose values partition the counter
+        :return: counter of the registry
+        :raises ValueError: if another type of metric has the same name
+        """
+
+        return self._get(Counter, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """
+        Create a new histogram or get the existing one of the same name
+
+        :param name: unique name of the histogram
+        :param documentation: help text of the histogram
+        :param buckets: ascending upper bounds of the buckets
+        :return: histogram of the registry
+        :raises ValueError: if another type of metric has the same name
+        """
+
+        return self._get(Histogram, name, documentation, buckets)
+
+    def get(self, name: str) -> Optional[Metric]:
+        """
+        Get a metric by its name
+
+        :param name: unique name of the metric
+        :return: metric or None if it doesn't exist
+        """
+
+        return self._metrics.get(name)
+
+    def clear(self) -> None:
+        """
+        Reset all recorded values of all metrics
+
+        :return: None
+        """
+
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def expose(self) -> str:
+        """
+        Export all metrics in the Prometheus text format
+
+        :return: complete text of all metrics sorted by their names
+        """
+
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+"""Global registry of all metrics of the package"""
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, source: Registry):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        method, path, *_ = request.decode("latin-1").split("\r\n", 1)[0].split(" ") + ["", ""]
+        if method == "GET" and path.split("?", 1)[0] in ("/", "/metrics"):
+            status, content_type, body = "200 OK", CONTENT_TYPE, source.expose().encode("utf-8")
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def get_address(address: str) -> str:
+    """
+    Complete the address of the endpoint by :const:`DEFAULT_HOST` if only a port has been given
+
+    :param address: address of the endpoint, a port or a Unix socket prefixed by :const:`UNIX_PREFIX`
+    :return: the address with a host, if it's no Unix socket
+    """
+
+    if address.isdigit():
+        return f"{DEFAULT_HOST}:{address}"
+    return address
+
+
+async def serve(address: str, source: Optional[Registry] = None) -> asyncio.AbstractServer:
+    """
+    Enable a registry and start a local HTTP endpoint exposing its metrics
+
+    The endpoint doesn't require any authentication, therefore only addresses
+    of localhost are accepted. Unix sockets additionally restrict the access
+    by the permissions of their file system paths.
+
+    :param address: either a local address and port (see
+        :func:`p2p_nse5.utils.split_ip_address_and_port`), only a port
+        (bound to :const:`DEFAULT_HOST`) or the path of a Unix socket
+        prefixed by :const:`UNIX_PREFIX`
+    :param source: registry which should be exposed (defaults to the global :data:`registry`)
+    :return: the started server, which should be closed eventually
+    :raises ValueError: for invalid addresses or addresses which don't belong to localhost
+    """
+
+    source = registry if source is None else source
+    address = get_address(address)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await _handle_request(reader, writer, source)
+
+    if address.startswith(UNIX_PREFIX):
+        server = await asyncio.start_unix_server(handle, address[len(UNIX_PREFIX):])
+    else:
+        family, host, port = utils.split_ip_address_and_port(address, True)
+        server = await asyncio.start_server(handle, host, port, family=family)
+    source.enabled = True
+    logging.getLogger("metrics").info(f"Metrics endpoint started on {address}")
+    return server
@@ -5,36 +5,56 @@ Module handling interactions with other NSE API clients and other NSE peers via
 import math
 import time
 import random
+import hashlib
 import socket
 import asyncio
 import logging
 import ipaddress
-from typing import Callable, ClassVar, Optional, Union
+from typing import Callable, ClassVar, Dict, List, Optional, Tuple, Union
 
-import sqlalchemy.orm
-
-from . import config, persistence, utils
+from . import config, gossip, metrics, proof_of_work, storage, utils
 from .protocols import api, p2p
 
 
+_query_seconds = metrics.registry.histogram(
+    "nse_query_seconds", "Duration from receiving a NSE_QUERY message until it has been answered"
+)
+
+
 class Protocol(asyncio.Protocol):
     """
     Implementation of the API protocol for the NSE module using the asyncio framework
 
+    Connections are kept open, so that clients can send any number of
+    (pipelined) ``NSE_QUERY`` messages, which are answered in order.
+    Queries received while the estimate is looked up in the database
+    are answered together as soon as the lookup has finished.
+    A connection is closed after it was idle for
+    :attr:`p2p_nse5.config.NSEConfiguration.api_idle_timeout` seconds or after
+    :attr:`p2p_nse5.config.NSEConfiguration.api_max_queries` answered queries.
+
     :param configuration: package configuration instance for a NSE5 instance
+    :param estimates: optional estimate cache shared by all instances (otherwise,
+        the estimate is calculated from the database for every query)
     """
 
     _instance_counter: ClassVar = utils.counter()
     """Simple counter to give every instance of this class a new increasing number"""
 
-    def __init__(self, configuration: config.Configuration):
+    def __init__(self, configuration: config.Configuration, estimates: Optional["EstimateCache"] = None):
         self._ident: int = next(type(self)._instance_counter)
+        self._estimates: Optional[EstimateCache] = estimates
         self.logger: logging.Logger = logging.getLogger(f"nse.handler.{self._ident}")
         self.config: config.Configuration = configuration
         self.transport: Optional[asyncio.Transport] = None
+        self._framer: api.MessageFramer = api.MessageFramer()
+        self._queries: int = 0
+        self._pending: int = 0
+        self._received: List[float] = []
+        self._lookup: Optional[asyncio.Future] = None
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
         self.family: socket.AddressFamily
         self.family, _, _ = utils.split_ip_address_and_port(self.config.nse.api_address)
-        self.session: Optional[sqlalchemy.orm.Session] = None
 
     def connection_made(self, transport: asyncio.Transport) -> None:
         """
@@ -67,48 +87,113 @@ class Protocol(asyncio.Protocol):
             self.transport.close()
             return
         self.logger.info("Accepted incoming connection from %s port %d", host, port)
+        self._reset_idle_timer()
+
+    def _reset_idle_timer(self) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+        if self.config.nse.api_idle_timeout > 0:
+            self._idle_handle = asyncio.get_running_loop().call_later(
+                self.config.nse.api_idle_timeout, self._close, "idle timeout"
+            )
+
+    def _close(self, reason: str) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if not self.transport.is_closing():
+            self.logger.debug(f"Closing connection ({reason})")
+            if self.transport.can_write_eof():
+                self.transport.write_eof()
+            self.transport.close()
 
     def data_received(self, data: bytes) -> None:
         """
         Handler to be called when some data is received by the underlying TCP transport
 
-        This method will first attempt to parse the incoming TCP packet as
+        The incoming data is split into single API messages by a
+        :class:`p2p_nse5.protocols.api.MessageFramer`, since TCP may coalesce
+        or split messages. Every complete message is handled by :meth:`_handle_message`.
+
+        :param data: incoming raw data (buffer of bytes from the underlying TCP connection)
+        :return: None
+        """
+
+        self._reset_idle_timer()
+        try:
+            for msg in self._framer.feed(data):
+                if self.transport.is_closing() or 0 < self.config.nse.api_max_queries <= self._queries:
+                    continue
+                self._handle_message(msg)
+        except api.InvalidMessage as exc:
+            self.logger.warning(f"Invalid API message stream, dropping buffered data: {exc}")
+
+    def _handle_message(self, msg: memoryview) -> None:
+        """
+        Handler of a single complete API message received from a client
+
+        This method will first attempt to parse the message as
         a ``NSE_QUERY`` API message, since no other messages are
         expected on the protocol's TCP connection anyways. If this
         fails, the message is silently discarded.
 
-        Then, the database is queried for the most recent rounds
-        known to the peer, to calculate the overall network size
-        estimate and standard deviation. Those values are then
-        returned via the same transport as ``NSE_ESTIMATE`` message.
+        Then, the overall network size estimate and standard deviation
+        are looked up in the :class:`EstimateCache` or calculated by
+        :func:`query_estimate`. Those values are then returned via
+        the same transport as ``NSE_ESTIMATE`` message. If the answer
+        isn't available immediately, the query is answered by
+        :meth:`_lookup_estimate` as soon as the lookup has finished.
 
-        :param data: incoming raw message (buffer of bytes from the underlying TCP connection)
+        :param msg: incoming API message as view of the framer's buffer
         :return: None
         """
 
         try:
-            api.unpack_incoming_message(data, [api.MessageType.NSE_QUERY])
+            api.unpack_incoming_message(msg, [api.MessageType.NSE_QUERY])
             self.logger.info("Incoming API message: NSE_QUERY")
         except api.InvalidMessage as exc:
             self.logger.warning(f"Invalid API message: {exc}")
-            self.logger.debug(f"First {min(len(data), 80)} bytes of incoming ignored/invalid message: {data[:80]}")
+            self.logger.debug(f"First {min(len(msg), 80)} bytes of incoming ignored/invalid message: {bytes(msg[:80])}")
             return
 
         # Handle the incoming message and respond with an NSE_ESTIMATE answer
-        with persistence.get_new_session() as session:
-            rounds = session.query(persistence.Round) \
-                .filter(persistence.Round.round <= get_current_round(self.config.nse.frequency)) \
-                .limit(self.config.nse.respected_rounds).all()
-
-            proximity_values = list(map(lambda p: p.proximity, rounds))
-            std_deviation = utils.get_std_deviation(proximity_values)
-            total_peers = round(sum(map(get_size_estimate, proximity_values)))
-            answer = api.pack_nse_estimate(total_peers, std_deviation)
-            self.transport.write(answer)
-
-        if self.transport.can_write_eof():
-            self.transport.write_eof()
-        self.transport.close()
+        self._queries += 1
+        self._pending += 1
+        if _query_seconds.enabled:
+            self._received.append(time.perf_counter())
+        answer = self._estimates.peek() if self._estimates is not None else None
+        if answer is not None and self._lookup is None:
+            self._answer(answer)
+        elif self._lookup is None:
+            self._lookup = asyncio.ensure_future(self._lookup_estimate())
+
+    async def _lookup_estimate(self) -> None:
+        try:
+            if self._estimates is not None:
+                answer = await self._estimates.get()
+            else:
+                answer = api.pack_nse_estimate(*await query_estimate(self.config))
+        except Exception as exc:
+            self.logger.error(f"Failed to look up the network size estimate: {exc}", exc_info=exc)
+            self._close("failed lookup")
+            return
+        finally:
+            self._lookup = None
+        self._answer(answer)
+
+    def _answer(self, answer: bytes) -> None:
+        # Answer all pending queries with the same estimate
+        if not self.transport.is_closing():
+            for _ in range(self._pending):
+                self.transport.write(answer)
+        self._pending = 0
+        if self._received:
+            now = time.perf_counter()
+            for received in self._received:
+                _query_seconds.observe(now - received)
+            self._received.clear()
+        if 0 < self.config.nse.api_max_queries <= self._queries:
+            self._close(f"reached the limit of {self._queries} queries")
 
     def eof_received(self) -> Optional[bool]:
         self.logger.debug("Received EOF on transport (closing connection)")
@@ -121,10 +206,157 @@ class Protocol(asyncio.Protocol):
             self.logger.debug("Lost connection to remote end")
         else:
             self.logger.debug("Lost connection to remote side (reason: %s)", str(exc), exc_info=exc)
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self._lookup is not None:
+            self._lookup.cancel()
         if not self.transport.is_closing():
             self.transport.close()
 
 
+class EstimateCache:
+    """
+    Cache of the packed ``NSE_ESTIMATE`` answer shared by all API connections
+
+    The estimate only changes when a new round value is accepted from Gossip or
+    when a new round starts. The former has to be signalled by calling
+    :meth:`invalidate`, the latter is detected by keying the answer by round.
+    Answering a query then only needs a dictionary lookup without any database
+    access. Note that changes of the database by other processes aren't noticed.
+    Concurrent misses of the cache share the same database lookup.
+
+    :param conf: package configuration instance for a NSE5 instance
+    """
+
+    def __init__(self, conf: config.Configuration):
+        self._conf = conf
+        self._answers: Dict[int, bytes] = {}
+        self._lookups: Dict[Tuple[int, int], asyncio.Future] = {}
+        self._generation: int = 0
+
+    def invalidate(self, *_) -> None:
+        """
+        Drop the cached answer, so that it's calculated again for the next query
+
+        This method accepts and ignores arbitrary arguments, so that it may be
+        used as a callback directly, e.g. for :class:`p2p_nse5.gossip.RoundWriter`.
+
+        :return: None
+        """
+
+        self._answers = {}
+        self._generation += 1
+
+    def peek(self) -> Optional[bytes]:
+        """
+        Get the packed ``NSE_ESTIMATE`` answer for the current round if it's cached
+
+        :return: packed API message or None if it needs to be looked up by :meth:`get`
+        """
+
+        return self._answers.get(int(time.time()) // self._conf.nse.frequency)
+
+    async def get(self) -> bytes:
+        """
+        Get the packed ``NSE_ESTIMATE`` answer for the current round
+
+        :return: packed API message
+        """
+
+        current_round = int(time.time()) // self._conf.nse.frequency
+        answer = self._answers.get(current_round)
+        if answer is None:
+            key = (current_round, self._generation)
+            if key not in self._lookups:
+                self._lookups[key] = asyncio.ensure_future(self._query(*key))
+            answer = await asyncio.shield(self._lookups[key])
+        return answer
+
+    async def _query(self, current_round: int, generation: int) -> bytes:
+        try:
+            answer = api.pack_nse_estimate(*await query_estimate(self._conf, current_round))
+        finally:
+            del self._lookups[(current_round, generation)]
+        # Answers of lookups which were running during an invalidation are outdated already
+        if generation == self._generation:
+            self._answers = {current_round: answer}
+        return answer
+
+
+class MessageCache:
+    """
+    Bounded persistent cache of our own ready-to-send P2P messages for upcoming rounds
+
+    The round time in the signed header of a message only depends on the round
+    and the configured frequency. Therefore, the proof of work and the signature
+    of the next rounds can be calculated long before those rounds start, so that
+    a :class:`RoundHandler` only needs to look up the message of its round.
+    Messages are stored by the storage backend (see :mod:`p2p_nse5.storage`),
+    at most one per round for the current round and the next
+    :attr:`p2p_nse5.config.NSEConfiguration.precompute_rounds` rounds.
+
+    :param conf: package configuration instance for a NSE5 instance
+    """
+
+    def __init__(self, conf: config.Configuration):
+        self._conf = conf
+        self._fingerprint: Optional[str] = None
+        self.logger: logging.Logger = logging.getLogger("nse.precompute")
+
+    @property
+    def fingerprint(self) -> str:
+        """Hex-encoded SHA256 hash of our own public key in DER format (loaded on first use)"""
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha256(self._conf.public_key.export_key("DER")).hexdigest()
+        return self._fingerprint
+
+    async def get(self, round_id: int) -> Optional[bytes]:
+        """
+        Look up the prepared message of a round
+
+        :param round_id: round identifier
+        :return: the complete signed message or None if there is no usable message
+        """
+
+        return await storage.get_storage().get_message(round_id, self.fingerprint, self._conf.nse.proof_of_work_bits)
+
+    async def fill(self, engine: proof_of_work.Engine, current_round: Optional[int] = None) -> int:
+        """
+        Drop outdated or unusable messages and calculate the missing ones
+
+        :param engine: proof of work engine used to build new messages
+        :param current_round: optional override of the current round identifier
+        :return: number of newly calculated messages
+        """
+
+        f = self._conf.nse.frequency
+        if current_round is None:
+            current_round = get_current_round(f)
+        last_round = current_round + self._conf.nse.precompute_rounds
+        fingerprint = self.fingerprint
+        bits = self._conf.nse.proof_of_work_bits
+
+        backend = storage.get_storage()
+        known = await backend.prune_messages(current_round, last_round, fingerprint, bits)
+
+        created = 0
+        for round_id in range(current_round, last_round + 1):
+            if round_id in known:
+                continue
+            start_time = round_id * f
+            msg = await engine.build_message(
+                self._conf.private_key,
+                start_time,
+                proximity=p2p.calculate_proximity(self._conf.private_key, start_time),
+                proof_of_work_bits=bits
+            )
+            await backend.store_message(round_id, fingerprint, bits, msg)
+            created += 1
+            self.logger.debug(f"Prepared the message for round {round_id} in advance")
+        return created
+
+
 class RoundHandler:
     """
     Handler class for a single iteration (round) of the GNUnet NSE algorithm
@@ -133,17 +365,45 @@ class RoundHandler:
     :param write: callable accepting some bytes which should be written
         to the currently active transport to the Gossip API server,
         so that NSE information can be successfully spread in the network
+    :param engine: optional proof of work engine used to build our own
+        P2P message off the event loop (defaults to a
+        :class:`p2p_nse5.proof_of_work.ThreadEngine`)
+    :param cache: optional cache of messages which have been prepared in
+        advance; the message is only built when the cache has no entry
+    :param notifications: optional cache of the best proximities accepted from
+        Gossip, which also knows accepted values that haven't been written to
+        the storage yet (the storage is used directly otherwise)
     """
 
-    def __init__(self, conf: config.Configuration, write: Callable[[bytes], bool]):
+    def __init__(
+            self,
+            conf: config.Configuration,
+            write: Callable[[bytes], bool],
+            engine: Optional[proof_of_work.Engine] = None,
+            cache: Optional[MessageCache] = None,
+            notifications: Optional[gossip.NotificationCache] = None
+    ):
         self._conf = conf
         self._write = write
+        self._engine = engine or proof_of_work.ThreadEngine()
+        self._cache = cache
+        self._notifications = notifications
         self._current_round = int(time.time()) // self._conf.nse.frequency
         self._start_time = get_start_time(self._conf)
         self._own_proximity = p2p.calculate_proximity(self._conf.private_key, self._start_time)
         self.logger: logging.Logger = logging.getLogger(f"nse.round.{self._current_round}")
 
-    async def run(self) -> None:
+    @property
+    def round_id(self) -> int:
+        """Identifier of the round handled by this instance"""
+        return self._current_round
+
+    @property
+    def own_proximity(self) -> int:
+        """Proximity of our own public key in the handled round"""
+        return self._own_proximity
+
+    async def run(self) -> bool:
         """
         Execute the NSE round handler algorithm based on GNUnet NSE
 
@@ -153,44 +413,77 @@ class RoundHandler:
           3. Lookup whether some better proximity for the current round appeared while waiting
           4. If we're worse than the current proximity, return
           5. Otherwise announce our own proximity in a valid P2P message to the gossip API
+             (prepared in advance by a :class:`MessageCache` if possible)
 
-        :return: None
+        The task running this method may be cancelled while it's waiting, as
+        soon as an equal or better proximity for the current round is known.
+
+        :return: whether our own proximity has been announced (False if it's been suppressed)
         """
 
         # Get the previous estimate either from the database or use 1 for the first round
         previous_estimate = 1.0
-        with persistence.get_new_session() as session:
-            rounds = session.query(persistence.Round).filter_by(round=self._current_round - 1).all()
-            if len(rounds) > 0:
-                previous_estimate = get_size_estimate(rounds[0].proximity)
+        previous_proximity = await storage.get_storage().get_proximity(self._current_round - 1)
+        if previous_proximity is not None:
+            previous_estimate = get_size_estimate(previous_proximity)
 
         delay = get_delay(self._conf.nse.frequency, self._own_proximity, previous_estimate)
         self.logger.debug(f"Starting... (round={self._current_round}, proximity={self._own_proximity}, delay={delay})")
         await asyncio.sleep(delay * (1 + random.random() / 20))
 
         # Return when some equal or better proximity for the current round appeared while waiting
-        with persistence.get_new_session() as session:
-            rounds = session.query(persistence.Round).filter_by(round=self._current_round).all()
-            if len(rounds) > 0:
-                if rounds[0].proximity >= self._own_proximity:
-                    self.logger.debug(
-                        f"Cancelling the broadcast of the current round's estimate, found proximity "
-                        f"{rounds[0].proximity} from peer ID {rounds[0].peer_id}"
-                    )
-                    return
-
-        # Build our own P2P message and hand it over to gossip to spread in the network
-        msg = p2p.build_message(
-            self._conf.private_key,
-            self._start_time,
-            logger=self.logger,
-            proximity=self._own_proximity,
-            proof_of_work_bits=self._conf.nse.proof_of_work_bits
-        )
+        if self._notifications is not None:
+            proximity = await self._notifications.get_best_proximity(self._current_round)
+        else:
+            proximity = await storage.get_storage().get_proximity(self._current_round)
+        if proximity is not None and proximity >= self._own_proximity:
+            self.logger.debug(f"Cancelling the broadcast of the current round's estimate, found proximity {proximity}")
+            return False
+
+        # Look up or build our own P2P message and hand it over to gossip to spread in the network
+        msg = None
+        if self._cache is not None:
+            msg = await self._cache.get(self._current_round)
+        if msg is None:
+            msg = await self._engine.build_message(
+                self._conf.private_key,
+                self._start_time,
+                proximity=self._own_proximity,
+                proof_of_work_bits=self._conf.nse.proof_of_work_bits
+            )
         success = self._write(msg)
         self.logger.debug(f"Announce {['failed', 'succeeded'][success]}! Message: {msg}")
         if not success:
             self.logger.warning("Failed to sent a gossip announcement!")
+        return True
+
+
+def calculate_estimate(proximity_values: List[int]) -> Tuple[int, int]:
+    """
+    Calculate the network size estimate and its standard deviation from the proximities of recent rounds
+
+    :param proximity_values: best proximities of the most recent rounds
+    :return: tuple of the estimated number of peers and the standard deviation
+    """
+
+    std_deviation = utils.get_std_deviation(proximity_values)
+    total_peers = round(sum(map(get_size_estimate, proximity_values)))
+    return total_peers, std_deviation
+
+
+async def query_estimate(conf: config.Configuration, current_round: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Calculate the network size estimate from the most recent rounds of the storage backend
+
+    :param conf: package configuration instance for a NSE5 instance
+    :param current_round: optional override of the current round identifier
+    :return: tuple of the estimated number of peers and the standard deviation
+    """
+
+    if current_round is None:
+        current_round = get_current_round(conf.nse.frequency)
+    rounds = await storage.get_storage().get_recent_rounds(current_round, conf.nse.respected_rounds)
+    return calculate_estimate([proximity for _, proximity in rounds])
 
 
 def get_delay(frequency: int, proximity: int, previous_estimate: float) -> float:
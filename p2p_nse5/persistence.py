@@ -3,45 +3,113 @@ Database models and functions using SQLAlchemy
 
 :func:`init` needs to be called at an early program stage.
 Afterwards, :func:`get_new_session` can be used to handle database operations.
+Code running on the asyncio event loop should use :func:`run` instead, which
+executes the operations in a dedicated database thread, so that slow queries
+or commits don't block the event loop.
 """
 
 import random
 import string
+import asyncio
+import hashlib
 import logging
 import datetime
-from typing import Optional
+import functools
+import concurrent.futures
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar, Union
 
-from sqlalchemy import create_engine, Column, DateTime, ForeignKey, func, Integer, LargeBinary
-from sqlalchemy.engine import Engine as _Engine
+from sqlalchemy import create_engine, Column, DateTime, ForeignKey, func, Integer, LargeBinary, String
+from sqlalchemy import event, exists, Index, inspect, MetaData, select, Table, text
+from sqlalchemy.engine import Connection, Engine as _Engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
 
 
 DEFAULT_DATABASE_URL: str = f"sqlite:////tmp/nse_{''.join(random.choice(string.ascii_lowercase) for _ in '_' * 16)}.db"
 
+SQLITE_PROFILES: Dict[str, Dict[str, Union[int, str]]] = {
+    "none": {},
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "cache_size": -16384,
+        "mmap_size": 0
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY"
+    }
+}
+"""Presets of pragmas applied to every new SQLite connection (negative cache sizes are measured in KiB)"""
+
+SQLITE_CACHED_STATEMENTS: int = 256
+"""Number of prepared statements cached per SQLite connection if a profile is used"""
+
 Base = declarative_base()
 _engine: Optional[_Engine] = None
 _make_session: Optional[sessionmaker] = None
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+T = TypeVar("T")
 
 
 class Peer(Base):
     """
-    Model of a peer in the network identified by the unique public key
+    Model of a peer in the network identified by the unique fingerprint of its public key
+
+    The full public key is stored in a separate :class:`PeerKey`, if at all.
+    Passing ``public_key`` to the constructor sets both the fingerprint and the key.
     """
 
     __tablename__ = "peers"
 
     id: int = Column(Integer, nullable=False, primary_key=True, autoincrement=True, unique=True)
-    public_key: bytes = Column(LargeBinary, nullable=False, unique=True)
-    """RSA 4096 bit public key of the remote peer in DER binary format"""
+    fingerprint: str = Column(String(64), nullable=False, unique=True)
+    """Hex-encoded SHA256 hash of the RSA public key of the remote peer in DER format (see :func:`get_fingerprint`)"""
     interactions: int = Column(Integer, nullable=False, default=1)
     """Counter how often we received information from the other peer's NSE module"""
+    last_round: Optional[int] = Column(Integer, nullable=True)
+    """Identifier of the most recent round which referenced the peer as its best peer (used by :func:`compact`)"""
     created: datetime.datetime = Column(DateTime, nullable=False, server_default=func.now())
     updated: datetime.datetime = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
+    key: Optional["PeerKey"] = relationship("PeerKey", uselist=False, backref="peer", cascade="all, delete-orphan")
+    """Relation to the full public key of the peer, if it's stored"""
+
+    def __init__(self, public_key: Optional[bytes] = None, **kwargs):
+        if public_key is not None:
+            kwargs.setdefault("fingerprint", get_fingerprint(public_key))
+            kwargs.setdefault("key", PeerKey(public_key=public_key))
+        super().__init__(**kwargs)
+
+    @property
+    def public_key(self) -> Optional[bytes]:
+        """RSA 4096 bit public key of the remote peer in DER binary format, if it's stored"""
+        return None if self.key is None else self.key.public_key
 
     def __repr__(self) -> str:
         return f"Peer(id={self.id}, interactions={self.interactions})"
 
 
+class PeerKey(Base):
+    """
+    Model of the full public key of a peer, which is only needed to inspect the peers later on
+    """
+
+    __tablename__ = "peer_keys"
+
+    peer_id: int = Column(Integer, ForeignKey("peers.id"), nullable=False, primary_key=True)
+    public_key: bytes = Column(LargeBinary, nullable=False)
+    """RSA 4096 bit public key of the remote peer in DER binary format"""
+
+    def __repr__(self) -> str:
+        return f"PeerKey(peer_id={self.peer_id})"
+
+
 class Round(Base):
     """
     Model of a time round and related information like the best peer or the max hops
@@ -63,11 +131,53 @@ class Round(Base):
     created: datetime.datetime = Column(DateTime, nullable=False, server_default=func.now())
     updated: datetime.datetime = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
 
+    __table_args__ = (
+        Index("ix_rounds_round_proximity", "round", "proximity"),
+        Index("ix_rounds_peer_id", "peer_id")
+    )
+
     def __repr__(self) -> str:
         return f"Round(id={self.id}, round={self.round}, proximity={self.proximity})"
 
 
-def init(database_url: str, create_all: bool = True):
+class PreparedMessage(Base):
+    """
+    Model of a ready-to-send P2P message of our own for an upcoming round
+    """
+
+    __tablename__ = "prepared_messages"
+
+    id: int = Column(Integer, nullable=False, primary_key=True, autoincrement=True, unique=True)
+    round: int = Column(Integer, nullable=False, unique=True)
+    """Round identifier"""
+    fingerprint: str = Column(String(64), nullable=False)
+    """Hex-encoded SHA256 hash of the DER public key which signed the message"""
+    proof_of_work_bits: int = Column(Integer, nullable=False)
+    """Number of bits of the proof of work of the message"""
+    message: bytes = Column(LargeBinary, nullable=False)
+    """Complete signed P2P message"""
+    created: datetime.datetime = Column(DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self) -> str:
+        return f"PreparedMessage(id={self.id}, round={self.round}, proof_of_work_bits={self.proof_of_work_bits})"
+
+
+class SchemaVersion(Base):
+    """
+    Model of the version of the database schema, the table contains a single row at most
+    """
+
+    __tablename__ = "schema_version"
+
+    version: int = Column(Integer, nullable=False, primary_key=True)
+    """Version of the schema as used as key in :const:`MIGRATIONS`"""
+    updated: datetime.datetime = Column(DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self) -> str:
+        return f"SchemaVersion(version={self.version})"
+
+
+def init(database_url: str, create_all: bool = True, sqlite_profile: str = "none"):
     """
     Initialize the database connections
 
@@ -80,8 +190,12 @@ def init(database_url: str, create_all: bool = True):
 
     :param database_url: the full URL to connect to the database (see
         https://docs.sqlalchemy.org/en/14/core/connections.html for details)
-    :param create_all: whether the metadata of the declarative base should
-        be used to create all non-existing tables in the database
+    :param create_all: whether all non-existing tables should be created and
+        databases of older versions of this program should be migrated (see
+        :func:`migrate`, this is skipped if the schema is up-to-date already)
+    :param sqlite_profile: name of the preset of pragmas in :const:`SQLITE_PROFILES`
+        which should be applied to every new connection to a SQLite database
+    :raises KeyError: for unknown SQLite profiles
     """
 
     global _engine, _make_session
@@ -92,16 +206,239 @@ def init(database_url: str, create_all: bool = True):
         )
 
     if database_url.startswith("sqlite:"):
-        _engine = create_engine(database_url, echo=False, connect_args={"check_same_thread": False})
+        pragmas = SQLITE_PROFILES[sqlite_profile]
+        connect_args = {"check_same_thread": False}
+        if pragmas:
+            connect_args["cached_statements"] = SQLITE_CACHED_STATEMENTS
+        _engine = create_engine(database_url, echo=False, connect_args=connect_args)
+        if pragmas:
+            event.listen(_engine, "connect", functools.partial(_apply_pragmas, pragmas=pragmas))
     else:
         _engine = create_engine(database_url, echo=False)
 
     if create_all:
-        Base.metadata.create_all(bind=_engine)
+        migrate(_engine)
 
     _make_session = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
 
 
+def get_fingerprint(public_key: bytes) -> str:
+    """
+    Calculate the fingerprint of a public key
+
+    :param public_key: RSA public key in DER binary format
+    :return: hex-encoded SHA256 hash of the public key
+    """
+
+    return hashlib.sha256(public_key).hexdigest()
+
+
+def _migrate_peer_fingerprints(connection: Connection) -> bool:
+    # Databases created before peers were identified by fingerprints store the full public key
+    # in the peers table, so it's replaced by the fingerprint and the keys are moved to peer_keys
+    if "public_key" not in {c["name"] for c in inspect(connection).get_columns("peers")}:
+        return False
+
+    logging.getLogger("persistence").info("Migrating the peers to fingerprints of their public keys ...")
+    legacy = Table("peers", MetaData(), autoload_with=connection)
+    rows = connection.execute(select(legacy)).mappings().all()
+    fingerprints = {row["id"]: get_fingerprint(row["public_key"]) for row in rows}
+
+    if connection.dialect.name == "sqlite":
+        # SQLite can't drop unique columns, so the whole table needs to be rebuilt
+        table = Peer.__table__.to_metadata(MetaData(), name="peers_migration")
+        table.create(connection)
+        if rows:
+            connection.execute(table.insert(), [{
+                "id": row["id"],
+                "fingerprint": fingerprints[row["id"]],
+                "interactions": row["interactions"],
+                "created": row["created"],
+                "updated": row["updated"]
+            } for row in rows])
+        connection.exec_driver_sql("DROP TABLE peers")
+        connection.exec_driver_sql("ALTER TABLE peers_migration RENAME TO peers")
+    else:
+        connection.exec_driver_sql("ALTER TABLE peers ADD COLUMN fingerprint VARCHAR(64)")
+        if rows:
+            connection.execute(
+                text("UPDATE peers SET fingerprint = :fingerprint WHERE id = :id"),
+                [{"id": i, "fingerprint": f} for i, f in fingerprints.items()]
+            )
+        connection.exec_driver_sql("CREATE UNIQUE INDEX ix_peers_fingerprint ON peers (fingerprint)")
+        connection.exec_driver_sql("ALTER TABLE peers DROP COLUMN public_key")
+
+    if rows:
+        connection.execute(PeerKey.__table__.insert(), [
+            {"peer_id": row["id"], "public_key": row["public_key"]} for row in rows
+        ])
+    return True
+
+
+def _create_round_indexes(connection: Connection):
+    # Covering index of the round window of NSE queries and the index of the
+    # peer references, which is needed to find unreferenced peers quickly
+    for index in Round.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _add_peer_last_round(connection: Connection):
+    # The most recent round referencing a peer is derived from the stored rounds once,
+    # peers which aren't referenced at all keep NULL and are removed by the next compaction
+    if "last_round" not in {c["name"] for c in inspect(connection).get_columns("peers")}:
+        connection.exec_driver_sql("ALTER TABLE peers ADD COLUMN last_round INTEGER")
+    connection.exec_driver_sql(
+        "UPDATE peers SET last_round = (SELECT MAX(rounds.round) FROM rounds WHERE rounds.peer_id = peers.id) "
+        "WHERE last_round IS NULL"
+    )
+
+
+MIGRATIONS: Dict[int, Callable[[Connection], None]] = {
+    2: _migrate_peer_fingerprints,
+    3: _create_round_indexes,
+    4: _add_peer_last_round
+}
+"""Mapping of schema versions to the functions migrating the schema of the previous version in place"""
+
+SCHEMA_VERSION: int = max(MIGRATIONS)
+"""Current version of the database schema (databases without version are considered version 1)"""
+
+
+def get_schema_version(engine: _Engine) -> Optional[int]:
+    """
+    Get the version of the schema of a database
+
+    :param engine: database engine
+    :return: stored version of the schema or None if the database isn't versioned (yet)
+    """
+
+    try:
+        with engine.connect() as connection:
+            return connection.execute(select(func.max(SchemaVersion.version))).scalar()
+    except DBAPIError:
+        return None
+
+
+def migrate(engine: _Engine) -> int:
+    """
+    Create or migrate the schema of a database to the current :const:`SCHEMA_VERSION`
+
+    A database with a matching schema version is left untouched after a single
+    query, no tables are reflected or created. New databases are created with
+    the current schema. Databases of older versions get all non-existing tables
+    and the pending :const:`MIGRATIONS` in a single transaction.
+
+    :param engine: database engine
+    :return: previous version of the schema (0 for new databases)
+    :raises ValueError: when the schema is newer than the supported version
+    """
+
+    version = get_schema_version(engine)
+    if version == SCHEMA_VERSION:
+        return version
+    if version is not None and version > SCHEMA_VERSION:
+        raise ValueError(f"Database schema version {version} is newer than the supported version {SCHEMA_VERSION}")
+
+    logger = logging.getLogger("persistence")
+    with engine.begin() as connection:
+        if version is None:
+            version = 1 if inspect(connection).has_table(Peer.__tablename__) else 0
+        Base.metadata.create_all(bind=connection)
+        if version > 0:
+            for target in sorted(v for v in MIGRATIONS if v > version):
+                logger.info(f"Migrating the database schema to version {target} ...")
+                MIGRATIONS[target](connection)
+        connection.execute(SchemaVersion.__table__.delete())
+        connection.execute(SchemaVersion.__table__.insert(), {"version": SCHEMA_VERSION})
+    return version
+
+
+def get_recent_rounds(session: Session, current_round: int, limit: int) -> List[Tuple[int, int]]:
+    """
+    Get the most recent rounds up to the current round in descending order
+
+    The query uses the unique index of the round identifiers, so that only
+    ``limit`` rows are read regardless of the size of the history. Only the
+    round identifier and the proximity are selected, no model instances.
+
+    :param session: database session
+    :param current_round: identifier of the most recent round which should be included
+    :param limit: maximum number of rounds
+    :return: list of tuples of the round identifier and its best proximity
+    """
+
+    return session.query(Round.round, Round.proximity) \
+        .filter(Round.round <= current_round) \
+        .order_by(Round.round.desc()) \
+        .limit(limit).all()
+
+
+def compact(session: Session, oldest_round: Optional[int], oldest_peer_round: Optional[int]) -> Tuple[int, int]:
+    """
+    Remove old rounds and unreferenced peers from the database
+
+    Peers are removed if they aren't referenced by any stored round and the most
+    recent round which referenced them (see :attr:`Peer.last_round`) is older than
+    ``oldest_peer_round``, regardless of whether that round is still stored.
+
+    :param session: database session
+    :param oldest_round: identifier of the oldest round which should be kept (None keeps all rounds)
+    :param oldest_peer_round: identifier of the oldest round whose peers should be
+        kept, even if they aren't referenced anymore (None keeps all peers)
+    :return: tuple of the numbers of removed rounds and removed peers
+    """
+
+    rounds = 0
+    if oldest_round is not None:
+        rounds = session.query(Round).filter(Round.round < oldest_round).delete(synchronize_session=False)
+    peers = 0
+    if oldest_peer_round is not None:
+        removable = (Peer.last_round.is_(None) | (Peer.last_round < oldest_peer_round)) \
+            & ~exists().where(Round.peer_id == Peer.id)
+        session.query(PeerKey).filter(
+            PeerKey.peer_id.in_(session.query(Peer.id).filter(removable))
+        ).delete(synchronize_session=False)
+        peers = session.query(Peer).filter(removable).delete(synchronize_session=False)
+    session.commit()
+    return rounds, peers
+
+
+def vacuum(mode: str) -> bool:
+    """
+    Return free pages of a SQLite database to the file system
+
+    The ``incremental`` mode needs the incremental auto-vacuum mode of
+    the database. If it's not enabled yet, it's enabled by a full vacuum.
+    Other databases are not supported and left untouched.
+
+    :param mode: one of ``none``, ``incremental`` or ``full``
+    :return: whether the database has been vacuumed
+    """
+
+    engine = get_engine()
+    if mode == "none" or engine.dialect.name != "sqlite":
+        return False
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        if mode == "incremental":
+            if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+                connection.exec_driver_sql("PRAGMA incremental_vacuum")
+                return True
+            logging.getLogger("persistence").info("Enabling the incremental auto-vacuum mode of the database")
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+    return True
+
+
+def _apply_pragmas(dbapi_connection, _, pragmas: Dict[str, Union[int, str]]):
+    cursor = dbapi_connection.cursor()
+    try:
+        for key, value in pragmas.items():
+            cursor.execute(f"PRAGMA {key} = {value}")
+    finally:
+        cursor.close()
+
+
 def _warn(obj: str):
     logging.getLogger("persistence").warning(
         f"Database {obj} not initialized! Using default database URL with database "
@@ -122,3 +459,48 @@ def get_new_session() -> Session:
         _warn("engine or its session maker")
         init(DEFAULT_DATABASE_URL)
     return _make_session()
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        # A single thread serializes all database operations, which avoids
+        # lock contention on SQLite and keeps the order of the operations
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+    return _executor
+
+
+async def run(func: Callable[[Session], T]) -> T:
+    """
+    Execute a function with a new session in the database thread without blocking the event loop
+
+    The function gets the session as its only argument. It's responsible to
+    commit its changes, the session is closed after the function returned.
+    All functions are executed one after another in the order of the calls.
+    Note that the returned value shouldn't be a model instance bound to the
+    session, since accessing its attributes may need the (closed) session.
+
+    :param func: callable accepting a session which should be executed
+    :return: return value of the function
+    """
+
+    def call():
+        with get_new_session() as session:
+            return func(session)
+
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), call)
+
+
+def shutdown():
+    """
+    Wait for all pending operations of the database thread and stop it
+
+    The thread is started again when :func:`run` is called afterwards.
+
+    :return: None
+    """
+
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,237 @@
+"""
+Module providing runtime profiling of a live NSE instance
+
+The :class:`Profiler` collects CPU profiles with :mod:`cProfile`, snapshots of
+the allocated memory with :mod:`tracemalloc` and the stacks of all asyncio tasks.
+All results are written to files in the configured directory. The profiler is
+controlled by the signals ``SIGUSR1`` (CPU profile for ``profile_seconds`` seconds)
+and ``SIGUSR2`` (memory snapshot and task stacks), or by commands sent to the local
+admin socket configured by ``admin_socket``, which is only accessible by the user
+running the instance. Every command is a single line, the
+answer is a single line starting with ``ok`` or ``error``:
+
+  * ``profile [seconds]`` enables the CPU profiler for some seconds
+  * ``memory`` takes a memory snapshot and compares it to the previous one
+  * ``tasks`` dumps the stacks of all asyncio tasks
+  * ``help`` lists the known commands
+
+The event loop keeps running while the profiler is enabled, so that the
+instance keeps serving API clients and Gossip notifications.
+"""
+
+import os
+import stat
+import time
+import signal
+import socket
+import asyncio
+import cProfile
+import logging
+import tempfile
+import tracemalloc
+from typing import Optional
+
+from . import config, utils
+
+
+COMMANDS = ("profile", "memory", "tasks", "help")
+"""Commands accepted by the admin socket"""
+
+MEMORY_FRAMES: int = 16
+"""Number of frames stored per memory allocation while tracing"""
+
+MEMORY_TOP: int = 50
+"""Number of the largest differences written per memory snapshot"""
+
+
+class Profiler:
+    """
+    Profiling control of a running instance triggered by signals or the admin socket
+
+    :param conf: package configuration instance for a NSE5 instance
+    """
+
+    def __init__(self, conf: config.Configuration):
+        self._conf: config.Configuration = conf
+        self._profile: Optional[cProfile.Profile] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._signals: bool = False
+        self._counter = utils.counter()
+        self.directory: str = conf.nse.profile_directory or tempfile.gettempdir()
+        """Directory of all files written by the profiler"""
+        self.logger: logging.Logger = logging.getLogger("profiling")
+
+    @property
+    def profiling(self) -> bool:
+        """Whether the CPU profiler is currently enabled"""
+        return self._profile is not None
+
+    def _get_path(self, kind: str, extension: str) -> str:
+        name = f"nse-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{next(self._counter)}-{kind}.{extension}"
+        return os.path.join(self.directory, name)
+
+    async def profile(self, seconds: float) -> str:
+        """
+        Enable the CPU profiler of the event loop thread for some seconds
+
+        :param seconds: duration of the profile
+        :return: path of the file containing the :mod:`pstats` statistics
+        :raises RuntimeError: if the profiler is enabled already
+        :raises ValueError: for non-positive durations
+        """
+
+        if seconds <= 0:
+            raise ValueError("Duration must be positive")
+        if self._profile is not None:
+            raise RuntimeError("CPU profiler is enabled already")
+        self.logger.info(f"Enabling the CPU profiler for {seconds} seconds")
+        self._profile = profile = cProfile.Profile()
+        try:
+            profile.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            self._profile = None
+        path = self._get_path("cpu", "pstats")
+        await asyncio.get_running_loop().run_in_executor(None, profile.dump_stats, path)
+        self.logger.info(f"Wrote CPU profile to {path!r}")
+        return path
+
+    def _write_memory(self, path: str) -> None:
+        snapshot = tracemalloc.take_snapshot()
+        with open(path, "w") as f:
+            if self._snapshot is None:
+                f.write("Largest allocations since tracing was started:\n")
+                stats = snapshot.statistics("lineno")
+            else:
+                f.write("Largest differences to the previous snapshot:\n")
+                stats = snapshot.compare_to(self._snapshot, "lineno")
+            for statistic in stats[:MEMORY_TOP]:
+                f.write(f"{statistic}\n")
+            current, peak = tracemalloc.get_traced_memory()
+            f.write(f"Traced memory: {current} bytes (peak: {peak} bytes)\n")
+        self._snapshot = snapshot
+
+    async def snapshot_memory(self) -> str:
+        """
+        Take a snapshot of the allocated memory and compare it to the previous one
+
+        Tracing allocations is started by the first call, so the first
+        snapshot only contains allocations made after this call.
+
+        :return: path of the file containing the largest allocations or differences
+        """
+
+        if not tracemalloc.is_tracing():
+            self.logger.info("Starting to trace memory allocations")
+            tracemalloc.start(MEMORY_FRAMES)
+        path = self._get_path("memory", "txt")
+        await asyncio.get_running_loop().run_in_executor(None, self._write_memory, path)
+        self.logger.info(f"Wrote memory snapshot to {path!r}")
+        return path
+
+    def dump_tasks(self) -> str:
+        """
+        Write the stacks of all asyncio tasks of the running event loop to a file
+
+        :return: path of the file containing the task stacks
+        """
+
+        path = self._get_path("tasks", "txt")
+        tasks = asyncio.all_tasks()
+        with open(path, "w") as f:
+            f.write(f"{len(tasks)} tasks\n")
+            for task in tasks:
+                f.write(f"\n{task!r}\n")
+                task.print_stack(file=f)
+        self.logger.info(f"Wrote {len(tasks)} task stacks to {path!r}")
+        return path
+
+    async def execute(self, command: str) -> str:
+        """
+        Execute a single command of the admin socket
+
+        :param command: command line, e.g. ``profile 10``
+        :return: answer line starting with ``ok`` or ``error``
+        """
+
+        name, *args = command.split() or [""]
+        try:
+            if name == "profile":
+                return f"ok {await self.profile(float(args[0]) if args else self._conf.nse.profile_seconds)}"
+            if name == "memory":
+                return f"ok {await self.snapshot_memory()}"
+            if name == "tasks":
+                return f"ok {self.dump_tasks()}"
+            if name == "help":
+                return f"ok {' '.join(COMMANDS)}"
+            return f"error unknown command {name!r}"
+        except (OSError, RuntimeError, ValueError) as exc:
+            return f"error {exc}"
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                writer.write((await self.execute(line.decode("utf-8", "replace").strip())).encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _run_in_background(self, *commands: str) -> None:
+        async def run():
+            for command in commands:
+                self.logger.info(f"Profiling command {command!r} finished: {await self.execute(command)}")
+
+        asyncio.get_running_loop().create_task(run())
+
+    async def start(self) -> None:
+        """
+        Install the signal handlers and start the admin socket, if it's configured
+
+        :return: None
+        """
+
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self._run_in_background, "profile")
+            loop.add_signal_handler(signal.SIGUSR2, self._run_in_background, "memory", "tasks")
+            self._signals = True
+        path = self._conf.nse.admin_socket
+        if path:
+            # Sockets left behind by instances which weren't shut down cleanly are replaced
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)
+            # Every client of the socket may run the profiler, so it's restricted to our own user.
+            # The socket is bound with a restrictive umask, it's never accessible by others.
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            umask = os.umask(0o177)
+            try:
+                sock.bind(path)
+            except OSError:
+                sock.close()
+                raise
+            finally:
+                os.umask(umask)
+            self._server = await asyncio.start_unix_server(self._handle_client, sock=sock)
+            self.logger.info(f"Admin socket started on {path!r}")
+
+    def close(self) -> None:
+        """
+        Remove the signal handlers and close the admin socket
+
+        :return: None
+        """
+
+        if self._signals:
+            loop = asyncio.get_running_loop()
+            loop.remove_signal_handler(signal.SIGUSR1)
+            loop.remove_signal_handler(signal.SIGUSR2)
+            self._signals = False
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if os.path.exists(self._conf.nse.admin_socket):
+                os.remove(self._conf.nse.admin_socket)
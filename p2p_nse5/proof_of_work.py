@@ -0,0 +1,199 @@
+"""
+Module providing pluggable engines to calculate the proof of work of NSE P2P messages
+
+The nonce search of :func:`p2p_nse5.protocols.p2p.build_message` is CPU-bound and
+takes seconds for larger values of ``proof_of_work_bits``. The engines in this
+module move this search off the asyncio event loop, so that the API server
+and the Gossip client stay responsive while a new message is being built.
+Use :func:`get_engine` to construct the engine selected in the configuration.
+"""
+
+import os
+import abc
+import time
+import asyncio
+import logging
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
+from typing import Optional, Set
+
+from Crypto.PublicKey import RSA
+
+from . import config, metrics
+from .protocols import p2p
+
+
+_proof_of_work_seconds = metrics.registry.histogram(
+    "nse_proof_of_work_seconds", "Duration of the nonce search of our own messages"
+)
+
+
+class Engine(abc.ABC):
+    """
+    Base class of all proof of work engines
+
+    Subclasses only need to implement :meth:`search`. Building and signing
+    a complete message is then done by :meth:`build_message`.
+    """
+
+    def __init__(self):
+        self.logger: logging.Logger = logging.getLogger(f"pow.{type(self).__name__.lower()}")
+
+    @abc.abstractmethod
+    async def search(self, body: bytes, proof_of_work_bits: int) -> int:
+        """
+        Search a nonce which makes the given payload a valid proof of work
+
+        :param body: template of the hashed payload as returned by
+            :func:`p2p_nse5.protocols.p2p.pack_hashed_body`
+        :param proof_of_work_bits: required trailing zero bits of the SHA256 hash
+        :return: valid nonce for the payload
+        :raises ValueError: when no valid nonce could be found
+        """
+
+    async def build_message(
+            self,
+            rsa_key: RSA.RsaKey,
+            round_time: int,
+            proximity: Optional[int] = None,
+            proof_of_work_bits: Optional[int] = None
+    ) -> bytes:
+        """
+        Construct a binary NSE protocol message without blocking the event loop
+
+        See :func:`p2p_nse5.protocols.p2p.build_message` for the meaning of the parameters.
+
+        :return: assembled bytes string containing a valid NSE protocol message
+        :raises ValueError: for invalid RSA key input or when the search for a nonce failed
+        """
+
+        proof_of_work_bits = proof_of_work_bits or p2p.DEFAULT_PROOF_OF_WORK_BITS
+        p2p.check_private_key(rsa_key)
+        proximity = proximity or p2p.calculate_proximity(rsa_key, round_time)
+        body = p2p.pack_hashed_body(proximity, round_time, rsa_key.public_key().export_key(format="DER"))
+
+        start = time.time()
+        nonce = await self.search(body, proof_of_work_bits)
+        duration = time.time() - start
+        _proof_of_work_seconds.observe(duration)
+        self.logger.debug(
+            f"Calculating message with {proof_of_work_bits}-bit hash collision took {duration:.3f} seconds"
+        )
+
+        # Signing with a 4096 bit key takes some milliseconds, so it's done off the event loop as well
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            p2p.build_message, rsa_key, round_time, proximity=proximity,
+            proof_of_work_bits=proof_of_work_bits, nonce=nonce
+        ))
+
+    def close(self) -> None:
+        """
+        Release all resources held by the engine (it may be used again afterwards)
+
+        :return: None
+        """
+
+
+class ThreadEngine(Engine):
+    """
+    Proof of work engine running the whole nonce search in the default executor of the event loop
+
+    This engine uses a single core only, but it's cheap and doesn't need any worker processes.
+    """
+
+    async def search(self, body: bytes, proof_of_work_bits: int) -> int:
+        nonce = await asyncio.get_running_loop().run_in_executor(None, p2p.search_nonce, body, proof_of_work_bits)
+        if nonce is None:
+            raise ValueError("Failed to calculate a hash collision. Invalid header configuration?")
+        return nonce
+
+
+def _watch_parent(parent_pid: int, interval: float = 1.0):
+    # Worker processes would otherwise stay alive forever, blocked on their
+    # task queue, when the main process gets killed without shutting down
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(interval)
+        os._exit(1)  # noqa
+
+    threading.Thread(target=watch, name="parent-watchdog", daemon=True).start()
+
+
+class ProcessPoolEngine(Engine):
+    """
+    Proof of work engine splitting the nonce space across a pool of worker processes
+
+    The nonce space is cut into chunks of :attr:`chunk_size` nonces. Every worker
+    has up to two chunks queued at any time. As soon as any chunk yields a valid
+    nonce, all queued chunks are cancelled, so that the workers stop early.
+
+    :param workers: number of worker processes (defaults to the number of CPU cores)
+    """
+
+    chunk_size: int = 1 << 16
+    """Number of nonces checked by a worker in a single task"""
+
+    def __init__(self, workers: Optional[int] = None):
+        super().__init__()
+        self.workers: int = workers or os.cpu_count() or 1
+        self._pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_watch_parent,
+                initargs=(os.getpid(),)
+            )
+        return self._pool
+
+    async def search(self, body: bytes, proof_of_work_bits: int) -> int:
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        pending: Set[asyncio.Future] = set()
+        next_start = 0
+
+        def submit():
+            nonlocal next_start
+            stop = min(next_start + self.chunk_size, 1 << 64)
+            pending.add(loop.run_in_executor(pool, p2p.search_nonce, body, proof_of_work_bits, next_start, stop))
+            next_start = stop
+
+        try:
+            while len(pending) < 2 * self.workers and next_start < 1 << 64:
+                submit()
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                found = [f.result() for f in done if f.result() is not None]
+                if found:
+                    return min(found)
+                while len(pending) < 2 * self.workers and next_start < 1 << 64:
+                    submit()
+        finally:
+            for future in pending:
+                future.cancel()
+        raise ValueError("Failed to calculate a hash collision. Invalid header configuration?")
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def get_engine(conf: config.Configuration) -> Engine:
+    """
+    Construct the proof of work engine selected by the configuration
+
+    :param conf: package configuration instance for a NSE5 instance
+    :return: new instance of a subclass of :class:`Engine`
+    :raises ValueError: for unknown engine names
+    """
+
+    if conf.nse.proof_of_work_engine == "process":
+        return ProcessPoolEngine(conf.nse.proof_of_work_workers or None)
+    if conf.nse.proof_of_work_engine == "thread":
+        return ThreadEngine()
+    raise ValueError(f"Unknown proof of work engine {conf.nse.proof_of_work_engine!r}")
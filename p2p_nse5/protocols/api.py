@@ -5,7 +5,12 @@ Helper module to provide abstractions for API communications
 import enum
 import struct
 import dataclasses
-from typing import Iterable, Optional, Tuple
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+
+MAX_MESSAGE_SIZE = 65535
+"""Maximum size of an API message including its header, limited by the 16-bit size field"""
+SIZE_HEADER = struct.Struct("!H")
 
 
 class MessageType(enum.IntEnum):
@@ -80,10 +85,98 @@ class GossipNotification:
     """Message ID of the incoming packet"""
     data_type: int
     """Data type of the data in the packet"""
-    data: bytes
+    data: Union[bytes, memoryview]
     """Arbitrary data (in our case, packed P2P messages for network size info)"""
 
 
+class MessageFramer:
+    """
+    Incremental framer splitting a stream of bytes into single API messages
+
+    TCP doesn't preserve message boundaries: one read may contain multiple API
+    messages, while large messages may be split across multiple reads. This
+    framer copies every incoming chunk once into a preallocated buffer and uses
+    the 16-bit size field of the API header to find complete messages. Those
+    are handed out as :class:`memoryview` slices of the buffer without copying.
+    Consumed space is reclaimed by moving the remaining partial message to the
+    front of the buffer. Only if a single partial message fills the whole
+    buffer, it's replaced by a buffer of twice the size, but never larger than
+    :const:`MAX_MESSAGE_SIZE`, since a partial message is always smaller.
+
+    :param capacity: initial size of the buffer
+    """
+
+    def __init__(self, capacity: int = 4096):
+        if capacity < 4:
+            raise ValueError("Capacity must be at least 4 bytes")
+        self._buffer: bytearray = bytearray(capacity)
+        self._view: memoryview = memoryview(self._buffer)
+        self._start: int = 0
+        self._end: int = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def reset(self):
+        """
+        Drop all buffered data, e.g. after the stream got out of sync
+
+        :return: None
+        """
+
+        self._start = self._end = 0
+
+    def _compact(self):
+        length = self._end - self._start
+        if self._start > 0:
+            self._view[:length] = self._view[self._start:self._end]
+        self._start, self._end = 0, length
+        if self._end == len(self._buffer):
+            # Views of the old buffer handed out earlier stay valid, since it's not modified anymore
+            self._buffer = bytearray(min(2 * len(self._buffer), MAX_MESSAGE_SIZE))
+            self._buffer[:length] = self._view[:length]
+            self._view = memoryview(self._buffer)
+
+    def feed(self, data: bytes) -> Iterator[memoryview]:
+        """
+        Add incoming data to the buffer and iterate over all messages which are complete now
+
+        Every yielded message is a view into the internal buffer, which is
+        only valid until the next message is requested. Use ``bytes(msg)``
+        to keep it longer. The iterator must be exhausted, otherwise parts
+        of the incoming data may not be added to the buffer.
+
+        :param data: incoming raw bytes of the stream
+        :return: iterator over the complete messages (including their headers)
+        :raises InvalidMessage: when a message header contains an invalid size
+            (all buffered data is dropped, since the stream is out of sync then)
+        """
+
+        data = memoryview(data)
+        while True:
+            if len(data) > len(self._buffer) - self._end:
+                self._compact()
+            n = min(len(data), len(self._buffer) - self._end)
+            self._view[self._end:self._end + n] = data[:n]
+            self._end += n
+            data = data[n:]
+
+            while self._end - self._start >= SIZE_HEADER.size:
+                size, = SIZE_HEADER.unpack_from(self._buffer, self._start)
+                if size < 4:
+                    self.reset()
+                    raise InvalidMessage(f"Invalid length field value {size}")
+                if self._end - self._start < size:
+                    break
+                self._start += size
+                yield self._view[self._start - size:self._start]
+
+            if self._start == self._end:
+                self._start = self._end = 0
+            if not data:
+                return
+
+
 def pack_gossip_announce(data_type: int, data: bytes, ttl: int) -> bytes:
     """Pack a ``GOSSIP_ANNOUNCE`` message"""
     header = struct.Struct("!HHBxH").pack(8 + len(data), MessageType.GOSSIP_ANNOUNCE, ttl, data_type)
@@ -106,13 +199,14 @@ def pack_nse_estimate(peers: int, std_deviation: int) -> bytes:
 
 
 def unpack_incoming_message(
-        msg: bytes,
+        msg: Union[bytes, memoryview],
         expected_types: Optional[Iterable[int]] = None
 ) -> Tuple[int, Optional[GossipNotification]]:
     """
     Parse, validate and unpack an incoming API message into type and data
 
-    :param msg: incoming unchecked message in raw bytes
+    :param msg: incoming unchecked message in raw bytes (views of
+        bytes are accepted, e.g. from a :class:`MessageFramer`)
     :param expected_types: iterable of expected message types
     :return: tuple of the message type identifier and the
         unpacked value specific to the specific message type
@@ -10,8 +10,10 @@ import time
 import struct
 import hashlib
 import logging
+import threading
+import collections
 import dataclasses
-from typing import Union
+from typing import Any, Iterable, List, Optional, Tuple, Union
 
 from Crypto.PublicKey import RSA
 from Crypto.Signature import pss
@@ -29,6 +31,8 @@ from Crypto.Hash import SHA512
 # 512 bytes  | 4096-bit RSA signature of everything except the first 2 bytes
 PROTOCOL_HEADER = struct.Struct("!xHBHQQ")
 HASHED_HEADER = struct.Struct("!BHQQ")
+NONCE = struct.Struct("!Q")
+NONCE_OFFSET = HASHED_HEADER.size - NONCE.size
 HEADER_LENGTH = 22
 SIGNATURE_LENGTH = 512
 SIGNATURE_SKIPPED_PREFIX = 3
@@ -37,6 +41,82 @@ DEFAULT_PROOF_OF_WORK_BITS = 20
 HASH_ENDIAN = "big"
 
 
+@dataclasses.dataclass
+class KeyCacheEntry:
+    """
+    Simple dataclass carrying everything derived from a public key in DER format
+    """
+
+    der: bytes
+    """RSA public key in DER binary format (the key of the cache)"""
+    public_key: RSA.RsaKey
+    """Parsed RSA public key"""
+    verifier: Any
+    """PSS signature scheme object prepared to verify signatures of that key"""
+
+
+class KeyCache:
+    """
+    Bounded LRU cache mapping public keys in DER format to :class:`KeyCacheEntry` objects
+
+    The same peers usually send their messages every round, so caching
+    the parsed keys avoids the ASN.1 parsing of every incoming message.
+    Messages may be unpacked by worker threads, so the cache is thread-safe.
+
+    :param size: maximum number of cached keys
+    """
+
+    def __init__(self, size: int = 4096):
+        self.size: int = size
+        self._entries: collections.OrderedDict[bytes, KeyCacheEntry] = collections.OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, der: bytes) -> KeyCacheEntry:
+        """
+        Get the cache entry of a public key, parsing it on a cache miss
+
+        :param der: RSA public key in DER binary format
+        :return: cache entry of that public key
+        :raises ValueError: when the key can't be parsed
+        """
+
+        with self._lock:
+            entry = self._entries.get(der)
+            if entry is not None:
+                self._entries.move_to_end(der)
+                return entry
+
+        try:
+            public_key = RSA.import_key(der)
+        except (IndexError, TypeError) as exc:
+            raise ValueError("Invalid public key") from exc
+        entry = KeyCacheEntry(der=der, public_key=public_key, verifier=pss.new(public_key))
+        with self._lock:
+            # Another thread might have parsed the same key in the meantime
+            entry = self._entries.setdefault(der, entry)
+            self._entries.move_to_end(der)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+
+        :return: None
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+
+key_cache: KeyCache = KeyCache()
+"""Global cache of public keys used by :func:`unpack_message` by default"""
+
+
 @dataclasses.dataclass
 class ProtocolMessage:
     """
@@ -51,6 +131,26 @@ class ProtocolMessage:
     """Number of hops the packet travelled (not used while using the Gossip transport)"""
     public_key: RSA.RsaKey
     """RSA public key as re-assembled from the incoming packet"""
+    key: Optional[KeyCacheEntry] = None
+    """Cache entry of the public key (including its DER format)"""
+
+
+@dataclasses.dataclass
+class MessageHeader:
+    """
+    Simple dataclass carrying the unverified header values of an incoming NSE protocol message
+    """
+
+    hop_count: int
+    """Number of hops the packet travelled"""
+    proximity: int
+    """Claimed proximity in bits (not checked yet)"""
+    key_length: int
+    """Length of the public key in DER format"""
+    round_time: int
+    """Identifier of a NSE round"""
+    nonce: int
+    """Nonce of the proof of work (not checked yet)"""
 
 
 def _check_proof_of_work(required_bits: int, body: bytes) -> bool:
@@ -58,36 +158,155 @@ def _check_proof_of_work(required_bits: int, body: bytes) -> bool:
     return int.from_bytes(h[-math.ceil(required_bits / 8):], HASH_ENDIAN) % (1 << required_bits) == 0
 
 
+_modulus_prefixes: collections.OrderedDict[int, Tuple[RSA.RsaKey, int]] = collections.OrderedDict()
+_modulus_prefixes_lock = threading.Lock()
+MODULUS_PREFIX_CACHE_SIZE = 4096
+
+
+def _compute_modulus_prefix(rsa_key: RSA.RsaKey) -> int:
+    n = rsa_key.n
+    if n.bit_length() < 256:
+        raise ValueError("RSA keys of less than 256 bits are not supported")
+    return n >> (n.bit_length() - 256)
+
+
+def _get_modulus_prefix(rsa_key: RSA.RsaKey) -> int:
+    # The top 256 bits of the modulus N are all that's needed of a key. Accessing
+    # N converts the whole 4096 bit number, so the prefix is cached per key object.
+    # Keys aren't hashable; the cache keeps a reference, so that their IDs stay unique,
+    # and every hit is checked for identity. Proximities are calculated by the event
+    # loop as well as by worker threads, therefore all accesses hold the lock.
+    key_id = id(rsa_key)
+    with _modulus_prefixes_lock:
+        cached = _modulus_prefixes.get(key_id)
+        if cached is not None and cached[0] is rsa_key:
+            _modulus_prefixes.move_to_end(key_id)
+            return cached[1]
+
+    prefix = _compute_modulus_prefix(rsa_key)
+    with _modulus_prefixes_lock:
+        _modulus_prefixes[key_id] = (rsa_key, prefix)
+        _modulus_prefixes.move_to_end(key_id)
+        while len(_modulus_prefixes) > MODULUS_PREFIX_CACHE_SIZE:
+            _modulus_prefixes.popitem(last=False)
+    return prefix
+
+
+def _hash_comparison_value(value: Union[int, bytes]) -> int:
+    # Possibly large integer values are converted to little endian bytes of minimal length
+    if isinstance(value, int):
+        if value < 0:
+            raise ValueError(f"Expected a non-negative integer, not {value}")
+        value = value.to_bytes(max(1, (value.bit_length() + 7) // 8), "little")
+    elif not isinstance(value, bytes):
+        raise TypeError(f"Expected bytes or int, not {type(value)}")
+    return int.from_bytes(hashlib.sha256(value).digest(), HASH_ENDIAN)
+
+
 def calculate_proximity(rsa_key: RSA.RsaKey, value: Union[int, bytes]) -> int:
     """
     Determine the proximity as number of equal leading bits between the
     RSA public key's N and some comparison value's unsalted SHA256 hash
 
-    :param rsa_key: RSA public key of at least 1024 bits size
+    :param rsa_key: RSA public key of at least 1024 bits size (a private key may be used
+        as well, since it has the same N; passing it avoids creating a new public key object,
+        which would miss the cache of the modulus prefix every time)
     :param value: some comparison value, usually a representation of the round time
     :return: number of equal leading bits between the hashed value and the public key
     """
 
-    # Convert possibly large integer values to big endian bytearrays
-    if isinstance(value, int):
-        ba = bytearray()
-        while value > 255:
-            ba.append(value % 256)
-            value = value >> 8
-        ba.append(value)
-        value = bytes(ba)
-    elif not isinstance(value, bytes):
-        raise TypeError(f"Expected bytes or int, not {type(value)}")
+    return 256 - (_get_modulus_prefix(rsa_key) ^ _hash_comparison_value(value)).bit_length()
+
+
+def calculate_proximities(rsa_keys: Iterable[RSA.RsaKey], values: Iterable[Union[int, bytes]]) -> List[List[int]]:
+    """
+    Determine the proximities of many keys to many comparison values at once
+
+    Every value is hashed only once and the modulus prefix of every key is
+    extracted only once, without going through the shared prefix cache of
+    :func:`calculate_proximity`. The proximities of a key to all values are
+    then calculated by mapping built-in integer operations over all hashes.
+    See :func:`calculate_proximity` for details about the proximity itself.
+
+    :param rsa_keys: RSA public keys of at least 1024 bits size
+    :param values: comparison values, usually representations of round times
+    :return: list of proximities to all values (in the given order) for every key
+    """
+
+    hashes = [_hash_comparison_value(value) for value in values]
+    bit_length = int.bit_length
+    proximities = []
+    for rsa_key in rsa_keys:
+        prefix = _compute_modulus_prefix(rsa_key)
+        proximities.append([256 - b for b in map(bit_length, map(prefix.__xor__, hashes))])
+    return proximities
+
+
+def check_private_key(rsa_key: RSA.RsaKey):
+    """
+    Ensure that an RSA key may be used to sign outgoing NSE protocol messages
+
+    :param rsa_key: private and public key pair of a 4096 bit RSA key
+    :raises ValueError: when the key has no private part or a wrong size
+    """
 
-    # Using binary representations and string operations is hacky but easy
-    n = bin(rsa_key.public_key().n)[2:]
-    h = bin(int.from_bytes(hashlib.sha256(value).digest(), HASH_ENDIAN))[2:]
-    for c in range(256-len(h)):
-        h = "0" + h
-    proximity = 0
-    while proximity < 256 and h[proximity] == n[proximity]:
-        proximity += 1
-    return proximity
+    if not rsa_key.has_private():
+        raise ValueError(f"RSA key {rsa_key} doesn't contain a private part!")
+    if rsa_key.size_in_bits() != 4096:
+        raise ValueError("Only RSA keys of size 4096 bits are supported")
+
+
+def pack_hashed_body(proximity: int, round_time: int, exported_public_key: bytes, nonce: int = 0) -> bytes:
+    """
+    Pack the part of a NSE protocol message which is covered by the proof of work
+
+    :param proximity: claimed proximity of the message
+    :param round_time: round time which is spread across the network
+    :param exported_public_key: public key of the sender in DER format
+    :param nonce: nonce of the proof of work (use any value as a template for :func:`search_nonce`)
+    :return: hashed header followed by the exported public key
+    :raises ValueError: when packing of the header struct failed
+    """
+
+    try:
+        return HASHED_HEADER.pack(proximity, len(exported_public_key), round_time, nonce) + exported_public_key
+    except struct.error as exc:
+        raise ValueError("Error packing the hashed header") from exc
+
+
+def search_nonce(body: bytes, proof_of_work_bits: int, start: int = 0, stop: int = 1 << 64) -> Optional[int]:
+    """
+    Search the range of nonces ``[start, stop)`` for a valid proof of work
+
+    This function is the CPU-bound core of :func:`build_message`. It's kept at
+    module level, so that it can be executed in worker processes as well.
+
+    The payload is copied into a single preallocated buffer once. Every attempt
+    only patches the eight nonce bytes in place and hashes the buffer again,
+    without packing the header or concatenating the public key.
+
+    :param body: template of the hashed payload as returned by :func:`pack_hashed_body`
+        (the nonce stored in the template is ignored)
+    :param proof_of_work_bits: required trailing zero bits of the SHA256 hash
+    :param start: first nonce to be checked
+    :param stop: first nonce after the searched range
+    :return: the first valid nonce in the range or None if there is none
+    """
+
+    buffer = bytearray(body)
+    pack_nonce = NONCE.pack_into
+    zero_bytes, remaining_bits = divmod(proof_of_work_bits, 8)
+    zeros = bytes(zero_bytes)
+    mask = (1 << remaining_bits) - 1
+    mask_index = hashlib.sha256().digest_size - zero_bytes - 1
+    stop = min(stop, 1 << 64)
+    sha256 = hashlib.sha256
+    for sample in range(start, stop):
+        pack_nonce(buffer, NONCE_OFFSET, sample)
+        digest = sha256(buffer).digest()
+        if digest.endswith(zeros) and not (mask and digest[mask_index] & mask):
+            return sample
+    return None
 
 
 def build_message(
@@ -96,7 +315,8 @@ def build_message(
         logger: logging.Logger = None,
         proximity: int = None,
         proof_of_work_bits: int = None,
-        hop_count: int = None
+        hop_count: int = None,
+        nonce: int = None
 ) -> bytes:
     """
     Construct a binary NSE protocol message from a set of input values
@@ -110,47 +330,75 @@ def build_message(
     :param proof_of_work_bits: optional override of the required
         trailing zero bits of the SHA256 hash of the unsigned payload
     :param hop_count: optional override of the default hop count
+    :param nonce: optional nonce of an already calculated proof of work
+        (e.g. by a :class:`p2p_nse5.proof_of_work.Engine`), which skips the search
     :return: assembled bytes string containing a valid NSE protocol message
-    :raises ValueError: for invalid RSA key input or when packing of structs failed
+    :raises ValueError: for invalid RSA key input, an invalid given nonce or when packing of structs failed
     """
 
     hop_count = hop_count or 0
     proof_of_work_bits = proof_of_work_bits or DEFAULT_PROOF_OF_WORK_BITS
-    if not rsa_key.has_private():
-        raise ValueError(f"RSA key {rsa_key} doesn't contain a private part!")
-    if rsa_key.size_in_bits() != 4096:
-        raise ValueError("Only RSA keys of size 4096 bits are supported")
-    proximity = proximity or calculate_proximity(rsa_key.public_key(), round_time)
+    check_private_key(rsa_key)
+    proximity = proximity or calculate_proximity(rsa_key, round_time)
     exported_public_key = rsa_key.public_key().export_key(format="DER")
     key_length = len(exported_public_key)
 
     # Calculate a hash collision for the header and the public key in DEM format (proof of work!)
-    start = time.time()
-    sample = -1
-    hashed_header = None
-    try:
-        for sample in range(1 << 64):
-            hashed_header = HASHED_HEADER.pack(proximity, key_length, round_time, sample) + exported_public_key
-            if _check_proof_of_work(proof_of_work_bits, hashed_header):
-                break
-    except struct.error as exc:
-        raise ValueError("Error packing the hashed header") from exc
-    end = time.time()
+    if nonce is None:
+        start = time.time()
+        nonce = search_nonce(pack_hashed_body(proximity, round_time, exported_public_key), proof_of_work_bits)
+        end = time.time()
+        if nonce is None:
+            raise ValueError("Failed to calculate a hash collision. Invalid header configuration?")
+        if logger is not None:
+            logger.debug(
+                f"Calculating message with {proof_of_work_bits}-bit hash collision took {end - start:.3f} seconds"
+            )
+    hashed_header = pack_hashed_body(proximity, round_time, exported_public_key, nonce)
+    if not _check_proof_of_work(proof_of_work_bits, hashed_header):
+        raise ValueError(f"Nonce {nonce} is no valid {proof_of_work_bits}-bit proof of work")
 
     # Sign the relevant payload and return it
-    if hashed_header is None or sample == -1:
-        raise ValueError("Failed to calculate a hash collision. Invalid header configuration?")
-    if logger is not None:
-        logger.debug(f"Calculating message with {proof_of_work_bits}-bit hash collision took {end - start:.3f} seconds")
     sig = pss.new(rsa_key).sign(SHA512.new(hashed_header))
     try:
-        header = PROTOCOL_HEADER.pack(hop_count, proximity, key_length, round_time, sample)
+        header = PROTOCOL_HEADER.pack(hop_count, proximity, key_length, round_time, nonce)
     except struct.error as exc:
         raise ValueError("Error packing the protocol header") from exc
     return header + exported_public_key + sig
 
 
-def unpack_message(msg: bytes, min_proximity: int = None, proof_of_work_bits: int = None) -> ProtocolMessage:
+def unpack_header(msg: bytes) -> MessageHeader:
+    """
+    Unpack the header of an incoming message without verifying anything but its length
+
+    This is cheap compared to :func:`unpack_message`, so it may be used
+    to discard messages before checking the proof of work and the signature.
+
+    :param msg: raw bytes string that has been received as incoming NSE P2P message
+    :return: the unverified header values of the message
+    :raises ValueError: when the header has an invalid format or the message has an invalid size
+    """
+
+    if not isinstance(msg, bytes):
+        raise TypeError(f"Invalid message type {type(msg)}, expected bytes")
+    if len(msg) < 2 * SIGNATURE_LENGTH:
+        raise ValueError("Message is too small, it can't hold all relevant data.")
+
+    try:
+        header = MessageHeader(*PROTOCOL_HEADER.unpack(msg[:HEADER_LENGTH]))
+    except struct.error as exc:
+        raise ValueError("Invalid header format can't be unpacked") from exc
+    if len(msg) != HEADER_LENGTH + header.key_length + SIGNATURE_LENGTH:
+        raise ValueError(f"Invalid public key length {header.key_length} found in header")
+    return header
+
+
+def unpack_message(
+        msg: bytes,
+        min_proximity: int = None,
+        proof_of_work_bits: int = None,
+        keys: Optional[KeyCache] = None
+) -> ProtocolMessage:
     """
     Unpack an incoming message as raw bytes string into a :class:`ProtocolMessage` instance
 
@@ -159,6 +407,7 @@ def unpack_message(msg: bytes, min_proximity: int = None, proof_of_work_bits: in
         hash will be discarded before further checks of the content (e.g. signature
         and proof of work) to improve this function's performance
     :param proof_of_work_bits: optional indicator of the required bits of the proof of work hash
+    :param keys: optional cache of parsed public keys (defaults to the global :data:`key_cache`)
     :return: the unpacked message as a ProtocolMessage instance
     :raises ValueError: whenever something is wrong with the message, e.g. the
         signature is invalid, the proof of work hash is invalid or not large
@@ -168,17 +417,7 @@ def unpack_message(msg: bytes, min_proximity: int = None, proof_of_work_bits: in
 
     min_proximity = min_proximity or 0
     proof_of_work_bits = proof_of_work_bits or DEFAULT_PROOF_OF_WORK_BITS
-    if not isinstance(msg, bytes):
-        raise TypeError(f"Invalid message type {type(msg)}, expected bytes")
-    if len(msg) < 2 * SIGNATURE_LENGTH:
-        raise ValueError("Message is too small, it can't hold all relevant data.")
-
-    try:
-        hop_count, proximity, pub_key_len, round_time, sample = PROTOCOL_HEADER.unpack(msg[:HEADER_LENGTH])
-    except struct.error as exc:
-        raise ValueError("Invalid header format can't be unpacked") from exc
-    if len(msg) != HEADER_LENGTH + pub_key_len + SIGNATURE_LENGTH:
-        raise ValueError(f"Invalid public key length {pub_key_len} found in header")
+    hop_count, proximity, pub_key_len, round_time, sample = dataclasses.astuple(unpack_header(msg))
     if min_proximity > proximity:
         raise ValueError(f"Message proximity {proximity} is smaller than minimum {min_proximity}")
 
@@ -190,14 +429,20 @@ def unpack_message(msg: bytes, min_proximity: int = None, proof_of_work_bits: in
         raise ValueError("Invalid ProofOfWork hash")
     try:
         signature = msg[-SIGNATURE_LENGTH:]
-        pub_key = RSA.import_key(msg[HEADER_LENGTH:HEADER_LENGTH + pub_key_len])
-        pss.new(pub_key).verify(SHA512.new(msg[SIGNATURE_SKIPPED_PREFIX:-SIGNATURE_LENGTH]), signature)
+        entry = (key_cache if keys is None else keys).get(msg[HEADER_LENGTH:HEADER_LENGTH + pub_key_len])
+        entry.verifier.verify(SHA512.new(msg[SIGNATURE_SKIPPED_PREFIX:-SIGNATURE_LENGTH]), signature)
     except IndexError as exc:
         raise ValueError from exc
-    if calculate_proximity(pub_key, round_time) != proximity:
+    if calculate_proximity(entry.public_key, round_time) != proximity:
         raise ValueError(f"Calculated proximity doesn't match proximity {proximity}")
 
-    return ProtocolMessage(public_key=pub_key, proximity=proximity, hop_count=hop_count, round_time=round_time)
+    return ProtocolMessage(
+        public_key=entry.public_key,
+        proximity=proximity,
+        hop_count=hop_count,
+        round_time=round_time,
+        key=entry
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+"""
+Module providing the event-driven scheduler of the NSE rounds
+
+Rounds start at the boundaries calculated by :func:`p2p_nse5.nse.get_start_time`.
+The :class:`RoundScheduler` calls its subscribed hooks at every boundary. The
+timer is set on the monotonic clock of the event loop, but the deadline of every
+round is derived from the wall clock again, so that delays of the event loop
+never add up and rounds skipped due to a suspended system or an overloaded
+event loop are detected and reported.
+"""
+
+import time
+import asyncio
+import logging
+from typing import Callable, List, Optional
+
+from . import nse
+
+
+RoundHook = Callable[[int, int], None]
+"""Hook called with the round identifier and the UNIX timestamp of the start of the round"""
+
+
+class RoundScheduler:
+    """
+    Scheduler calling the subscribed hooks at the start of every NSE round
+
+    The hooks are called synchronously on the event loop, so they should only
+    create tasks for long-running operations. Exceptions raised by one hook
+    are logged and don't affect the other hooks or the scheduler.
+
+    :param frequency: configured network-wide time of a single round in seconds
+    """
+
+    def __init__(self, frequency: int):
+        self.frequency: int = frequency
+        self.missed_rounds: int = 0
+        """Total number of rounds which were skipped, since the scheduler couldn't fire in time"""
+        self.logger: logging.Logger = logging.getLogger("scheduler")
+        self._hooks: List[RoundHook] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._last_round: Optional[int] = None
+
+    @property
+    def running(self) -> bool:
+        """Whether the scheduler has been started and wasn't stopped yet"""
+        return self._handle is not None
+
+    def subscribe(self, hook: RoundHook) -> None:
+        """
+        Add a hook which should be called at the start of every round
+
+        :param hook: callable accepting the round identifier and the start time of the round
+        :return: None
+        """
+
+        self._hooks.append(hook)
+
+    def unsubscribe(self, hook: RoundHook) -> None:
+        """
+        Remove a previously subscribed hook
+
+        :param hook: callable which has been added by :meth:`subscribe`
+        :return: None
+        :raises ValueError: if the hook wasn't subscribed
+        """
+
+        self._hooks.remove(hook)
+
+    def start(self, immediate: bool = False) -> None:
+        """
+        Start the scheduler in the running event loop
+
+        :param immediate: whether the hooks should be called for the current round
+            as soon as possible, instead of waiting for the start of the next round
+        :return: None
+        :raises RuntimeError: if the scheduler is running already
+        """
+
+        if self.running:
+            raise RuntimeError("Round scheduler is running already")
+        self._loop = asyncio.get_running_loop()
+        if immediate:
+            self._handle = self._loop.call_soon(self._fire, nse.get_start_time(self.frequency))
+        else:
+            self._schedule()
+
+    def stop(self) -> None:
+        """
+        Stop the scheduler, no more hooks will be called afterwards
+
+        :return: None
+        """
+
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self, start_time: Optional[int] = None) -> None:
+        # The deadline is calculated from the wall clock for every round, so
+        # that the latency of the event loop doesn't accumulate over time
+        now = time.time()
+        if start_time is None:
+            start_time = nse.get_start_time(self.frequency, now) + self.frequency
+        self._handle = self._loop.call_at(self._loop.time() + max(start_time - now, 0), self._fire, start_time)
+
+    def _fire(self, start_time: int) -> None:
+        now = time.time()
+        if now < start_time:
+            # The monotonic clock and the wall clock may disagree slightly (or the wall clock was adjusted)
+            self._schedule(start_time)
+            return
+
+        round_id = int(now) // self.frequency
+        if self._last_round is not None and round_id <= self._last_round:
+            self.logger.warning(f"Round {round_id} has started already, the system clock was probably set back")
+            self._schedule()
+            return
+        if self._last_round is not None and round_id > self._last_round + 1:
+            missed = round_id - self._last_round - 1
+            self.missed_rounds += missed
+            self.logger.warning(
+                f"Missed {missed} round(s) after round {self._last_round}, the system was "
+                f"probably suspended or the event loop was blocked for {now - start_time:.3f} seconds"
+            )
+        self._last_round = round_id
+
+        start_time = nse.get_start_time(self.frequency, now)
+        self.logger.debug(f"Starting round {round_id} (delayed by {now - start_time:.3f} seconds)")
+        for hook in list(self._hooks):
+            try:
+                hook(round_id, start_time)
+            except Exception as exc:  # noqa
+                self.logger.exception(f"Round hook {hook!r} failed: {exc}")
+        self._schedule()
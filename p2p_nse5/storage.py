@@ -0,0 +1,467 @@
+"""
+Module providing pluggable storage backends for rounds, peers and prepared messages
+
+The protocols don't access the database directly, but use the methods of
+the :class:`Storage` returned by :func:`get_storage`. :func:`init` selects the
+backend at a very early program stage, similar to :func:`p2p_nse5.persistence.init`.
+The :class:`DatabaseStorage` keeps everything in the database configured by
+:attr:`p2p_nse5.config.NSEConfiguration.database`, while the :class:`MemoryStorage`
+keeps everything in memory and loses it when the program exits.
+"""
+
+import abc
+import bisect
+import hashlib
+import logging
+import functools
+import collections
+import dataclasses
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import sqlalchemy.orm
+
+from . import config, metrics, persistence
+from .protocols import p2p
+
+
+_commit_seconds = metrics.registry.histogram(
+    "nse_database_commit_seconds", "Duration of the commits of accepted rounds to the database"
+)
+
+
+@dataclasses.dataclass
+class RoundUpdate:
+    """
+    Best notification of a round which should be stored
+    """
+
+    round: int
+    proximity: int
+    max_hops: int
+    key: p2p.KeyCacheEntry
+
+
+class RoundRecord(NamedTuple):
+    """
+    Compact record of the best notification of a round in the :class:`MemoryStorage`
+    """
+
+    proximity: int
+    max_hops: int
+    peer_id: int
+
+
+class Storage(abc.ABC):
+    """
+    Base class of all storage backends
+
+    Stored rounds are only replaced by rounds with a better proximity, but the
+    highest hop count of a round is always kept. Peers are identified by their
+    public keys and get an ID when they are stored for the first time.
+    """
+
+    def __init__(self):
+        self.logger: logging.Logger = logging.getLogger(f"storage.{type(self).__name__.lower()}")
+
+    @abc.abstractmethod
+    async def get_proximity(self, round_id: int) -> Optional[int]:
+        """
+        Get the best stored proximity of a round
+
+        :param round_id: round identifier
+        :return: best stored proximity or None if the round is unknown
+        """
+
+    @abc.abstractmethod
+    async def get_recent_rounds(self, current_round: int, limit: int) -> List[Tuple[int, int]]:
+        """
+        Get the most recent rounds up to the current round in descending order
+
+        :param current_round: identifier of the most recent round which should be included
+        :param limit: maximum number of rounds
+        :return: list of tuples of the round identifier and its best proximity
+        """
+
+    @abc.abstractmethod
+    async def store_rounds(self, batch: List[RoundUpdate]) -> List[int]:
+        """
+        Store the best notifications of distinct rounds if they are better than the stored ones
+
+        :param batch: list of the best notifications of distinct rounds
+        :return: list of peer IDs of the notifications in the same order
+        """
+
+    @abc.abstractmethod
+    async def get_message(self, round_id: int, fingerprint: str, proof_of_work_bits: int) -> Optional[bytes]:
+        """
+        Look up a prepared message of a round
+
+        :param round_id: round identifier
+        :param fingerprint: hex-encoded SHA256 hash of the DER public key which signed the message
+        :param proof_of_work_bits: minimal number of bits of the proof of work of the message
+        :return: the complete signed message or None if there is no usable message
+        """
+
+    @abc.abstractmethod
+    async def prune_messages(
+            self,
+            first_round: int,
+            last_round: int,
+            fingerprint: str,
+            proof_of_work_bits: int
+    ) -> Set[int]:
+        """
+        Drop prepared messages outside the range of rounds or with another fingerprint or too few bits
+
+        :param first_round: identifier of the first round whose message should be kept
+        :param last_round: identifier of the last round whose message should be kept
+        :param fingerprint: hex-encoded SHA256 hash of our own DER public key
+        :param proof_of_work_bits: minimal number of bits of the proof of work of the messages
+        :return: set of round identifiers which still have a prepared message
+        """
+
+    @abc.abstractmethod
+    async def store_message(self, round_id: int, fingerprint: str, proof_of_work_bits: int, message: bytes) -> None:
+        """
+        Store a prepared message of a round
+
+        :param round_id: round identifier
+        :param fingerprint: hex-encoded SHA256 hash of the DER public key which signed the message
+        :param proof_of_work_bits: number of bits of the proof of work of the message
+        :param message: complete signed message
+        :return: None
+        """
+
+    @abc.abstractmethod
+    async def compact(self, oldest_round: Optional[int], oldest_peer_round: Optional[int]) -> Tuple[int, int]:
+        """
+        Remove old rounds and unreferenced peers
+
+        Peer IDs cached by the backend are dropped when peers have been
+        removed, so that they are looked up again.
+
+        :param oldest_round: identifier of the oldest round which should be kept (None keeps all rounds)
+        :param oldest_peer_round: peers which aren't referenced by any round and weren't
+            referenced by this round or a later one are removed (None keeps all peers)
+        :return: tuple of the numbers of removed rounds and removed peers
+        """
+
+    async def vacuum(self, mode: str) -> bool:
+        """
+        Return unused space to the operating system if supported by the backend
+
+        :param mode: one of :const:`p2p_nse5.config.VACUUM_MODES`
+        :return: whether any space has been returned
+        """
+
+        return False
+
+    def close(self) -> None:
+        """
+        Wait for all pending operations and release all resources held by the backend
+
+        :return: None
+        """
+
+
+class DatabaseStorage(Storage):
+    """
+    Storage backend using the database of :mod:`p2p_nse5.persistence`
+
+    All operations are executed in the database thread (see :func:`p2p_nse5.persistence.run`).
+    Peers are looked up by the fingerprints of their public keys. The peer IDs of
+    recently stored public keys are cached; like the database, this cache is only
+    used by the database thread, so compactions can reset it without any races.
+
+    :param store_public_keys: whether the full public keys of new peers should be
+        stored in addition to their fingerprints
+    :param peers: maximum number of cached peer IDs
+    """
+
+    def __init__(self, store_public_keys: bool = True, peers: int = 4096):
+        super().__init__()
+        self._store_public_keys: bool = store_public_keys
+        self._peer_ids: collections.OrderedDict[bytes, int] = collections.OrderedDict()
+        self._peer_limit: int = peers
+
+    async def get_proximity(self, round_id: int) -> Optional[int]:
+        return await persistence.run(functools.partial(self._select_proximity, round_id=round_id))
+
+    @staticmethod
+    def _select_proximity(session: sqlalchemy.orm.Session, round_id: int) -> Optional[int]:
+        model = session.query(persistence.Round).filter_by(round=round_id).first()
+        return None if model is None else model.proximity
+
+    async def get_recent_rounds(self, current_round: int, limit: int) -> List[Tuple[int, int]]:
+        return await persistence.run(functools.partial(
+            persistence.get_recent_rounds, current_round=current_round, limit=limit
+        ))
+
+    async def store_rounds(self, batch: List[RoundUpdate]) -> List[int]:
+        return await persistence.run(functools.partial(self._write_rounds, batch=batch))
+
+    def _write_rounds(self, session: sqlalchemy.orm.Session, batch: List[RoundUpdate]) -> List[int]:
+        # If the peer ID of a notification is already cached, it's used directly. If the
+        # peer is already known in the database, the peer ID can be looked up; otherwise,
+        # a new peer entry will be created in the same transaction.
+        peer_ids = []
+        new_peers: Dict[str, persistence.Peer] = {}
+        for entry in batch:
+            peer_id = self._peer_ids.get(entry.key.der)
+            if peer_id is not None:
+                self._peer_ids.move_to_end(entry.key.der)
+            else:
+                fingerprint = persistence.get_fingerprint(entry.key.der)
+                peer = new_peers.get(fingerprint)
+                if peer is None:
+                    peer = session.query(persistence.Peer).filter_by(fingerprint=fingerprint).first()
+                if peer is None:
+                    if self._store_public_keys:
+                        peer = persistence.Peer(public_key=entry.key.der, interactions=1, last_round=entry.round)
+                    else:
+                        peer = persistence.Peer(fingerprint=fingerprint, interactions=1, last_round=entry.round)
+                    session.add(peer)
+                    session.flush()
+                    self.logger.debug(f"New peer {peer.id} created for new public key (hash: {fingerprint})")
+                new_peers[fingerprint] = peer
+                peer_id = peer.id
+            peer_ids.append(peer_id)
+
+            model = session.query(persistence.Round).filter_by(round=entry.round).first()
+            if model is None or model.proximity < entry.proximity:
+                self._reference_peer(session, peer_id, entry.round)
+            if model is None:
+                session.add(persistence.Round(
+                    round=entry.round,
+                    proximity=entry.proximity,
+                    max_hops=entry.max_hops,
+                    peer_id=peer_id
+                ))
+                self.logger.info(
+                    f"Added new round entry for {entry.round} with proximity "
+                    f"{entry.proximity} and max_hops {entry.max_hops} (peer ID: {peer_id})"
+                )
+                continue
+
+            model.max_hops = max(entry.max_hops, model.max_hops)
+            if model.proximity < entry.proximity:
+                model.proximity = entry.proximity
+                model.peer_id = peer_id
+                self.logger.info(f"Updated round {entry.round} to proximity {entry.proximity} (peer ID: {peer_id})")
+        with _commit_seconds.time():
+            session.commit()
+
+        # The peer IDs are only valid after the transaction has been committed
+        for entry, peer_id in zip(batch, peer_ids):
+            self._peer_ids[entry.key.der] = peer_id
+            self._peer_ids.move_to_end(entry.key.der)
+        while len(self._peer_ids) > self._peer_limit:
+            self._peer_ids.popitem(last=False)
+        return peer_ids
+
+    @staticmethod
+    def _reference_peer(session: sqlalchemy.orm.Session, peer_id: int, round_id: int) -> None:
+        table = persistence.Peer
+        session.query(table).filter(
+            (table.id == peer_id) & (table.last_round.is_(None) | (table.last_round < round_id))
+        ).update({table.last_round: round_id}, synchronize_session=False)
+
+    async def get_message(self, round_id: int, fingerprint: str, proof_of_work_bits: int) -> Optional[bytes]:
+        def select(session: sqlalchemy.orm.Session) -> Optional[bytes]:
+            model = session.query(persistence.PreparedMessage).filter_by(
+                round=round_id, fingerprint=fingerprint
+            ).first()
+            if model is not None and model.proof_of_work_bits >= proof_of_work_bits:
+                return model.message
+            return None
+
+        return await persistence.run(select)
+
+    async def prune_messages(
+            self,
+            first_round: int,
+            last_round: int,
+            fingerprint: str,
+            proof_of_work_bits: int
+    ) -> Set[int]:
+        def prune(session: sqlalchemy.orm.Session) -> Set[int]:
+            table = persistence.PreparedMessage
+            session.query(table).filter(
+                (table.round < first_round)
+                | (table.round > last_round)
+                | (table.fingerprint != fingerprint)
+                | (table.proof_of_work_bits < proof_of_work_bits)
+            ).delete(synchronize_session=False)
+            session.commit()
+            return {r for r, in session.query(table.round)}
+
+        return await persistence.run(prune)
+
+    async def store_message(self, round_id: int, fingerprint: str, proof_of_work_bits: int, message: bytes) -> None:
+        def store(session: sqlalchemy.orm.Session) -> None:
+            session.add(persistence.PreparedMessage(
+                round=round_id,
+                fingerprint=fingerprint,
+                proof_of_work_bits=proof_of_work_bits,
+                message=message
+            ))
+            session.commit()
+
+        await persistence.run(store)
+
+    async def compact(self, oldest_round: Optional[int], oldest_peer_round: Optional[int]) -> Tuple[int, int]:
+        def remove(session: sqlalchemy.orm.Session) -> Tuple[int, int]:
+            rounds, peers = persistence.compact(session, oldest_round, oldest_peer_round)
+            if peers > 0:
+                self._peer_ids.clear()
+            return rounds, peers
+
+        return await persistence.run(remove)
+
+    async def vacuum(self, mode: str) -> bool:
+        return await persistence.run(lambda _: persistence.vacuum(mode))
+
+    def close(self) -> None:
+        persistence.shutdown()
+
+
+class MemoryStorage(Storage):
+    """
+    Storage backend keeping everything in memory without any database
+
+    Rounds are kept in a dictionary of round identifiers to :class:`RoundRecord`
+    instances. Peer IDs are assigned by a bounded index of SHA256 hashes of
+    public keys, which also keeps the most recent round referencing every peer,
+    so that the least recently seen peers are forgotten if there are too many of them.
+    Nothing is kept when the program exits.
+
+    :param peers: maximum number of peers in the index of public keys
+    """
+
+    def __init__(self, peers: int = 4096):
+        super().__init__()
+        self._rounds: Dict[int, RoundRecord] = {}
+        self._round_ids: List[int] = []
+        self._peers: collections.OrderedDict[bytes, Tuple[int, int]] = collections.OrderedDict()
+        self._peer_limit: int = peers
+        self._next_peer_id: int = 1
+        self._messages: Dict[int, Tuple[str, int, bytes]] = {}
+
+    async def get_proximity(self, round_id: int) -> Optional[int]:
+        record = self._rounds.get(round_id)
+        return None if record is None else record.proximity
+
+    async def get_recent_rounds(self, current_round: int, limit: int) -> List[Tuple[int, int]]:
+        end = bisect.bisect_right(self._round_ids, current_round)
+        return [(r, self._rounds[r].proximity) for r in reversed(self._round_ids[max(0, end - limit):end])]
+
+    def _get_peer_id(self, der: bytes, round_id: int) -> int:
+        digest = hashlib.sha256(der).digest()
+        peer = self._peers.get(digest)
+        if peer is not None:
+            self._peers.move_to_end(digest)
+            return peer[0]
+        peer_id = self._next_peer_id
+        self._next_peer_id += 1
+        self._peers[digest] = (peer_id, round_id)
+        if len(self._peers) > self._peer_limit:
+            self._peers.popitem(last=False)
+        return peer_id
+
+    async def store_rounds(self, batch: List[RoundUpdate]) -> List[int]:
+        peer_ids = []
+        for entry in batch:
+            peer_id = self._get_peer_id(entry.key.der, entry.round)
+            peer_ids.append(peer_id)
+
+            record = self._rounds.get(entry.round)
+            if record is None or record.proximity < entry.proximity:
+                digest = hashlib.sha256(entry.key.der).digest()
+                peer = self._peers.get(digest)
+                if peer is not None and peer[1] < entry.round:
+                    self._peers[digest] = (peer[0], entry.round)
+            if record is None:
+                self._rounds[entry.round] = RoundRecord(entry.proximity, entry.max_hops, peer_id)
+                bisect.insort(self._round_ids, entry.round)
+            elif record.proximity < entry.proximity:
+                self._rounds[entry.round] = RoundRecord(entry.proximity, max(entry.max_hops, record.max_hops), peer_id)
+            else:
+                self._rounds[entry.round] = record._replace(max_hops=max(entry.max_hops, record.max_hops))
+        return peer_ids
+
+    async def get_message(self, round_id: int, fingerprint: str, proof_of_work_bits: int) -> Optional[bytes]:
+        entry = self._messages.get(round_id)
+        if entry is not None and entry[0] == fingerprint and entry[1] >= proof_of_work_bits:
+            return entry[2]
+        return None
+
+    async def prune_messages(
+            self,
+            first_round: int,
+            last_round: int,
+            fingerprint: str,
+            proof_of_work_bits: int
+    ) -> Set[int]:
+        self._messages = {
+            r: entry for r, entry in self._messages.items()
+            if first_round <= r <= last_round and entry[0] == fingerprint and entry[1] >= proof_of_work_bits
+        }
+        return set(self._messages)
+
+    async def store_message(self, round_id: int, fingerprint: str, proof_of_work_bits: int, message: bytes) -> None:
+        self._messages[round_id] = (fingerprint, proof_of_work_bits, message)
+
+    async def compact(self, oldest_round: Optional[int], oldest_peer_round: Optional[int]) -> Tuple[int, int]:
+        rounds = 0
+        if oldest_round is not None:
+            rounds = bisect.bisect_left(self._round_ids, oldest_round)
+            for r in self._round_ids[:rounds]:
+                del self._rounds[r]
+            del self._round_ids[:rounds]
+
+        peers = 0
+        if oldest_peer_round is not None:
+            referenced = {record.peer_id for record in self._rounds.values()}
+            for digest, (peer_id, last_round) in list(self._peers.items()):
+                if last_round < oldest_peer_round and peer_id not in referenced:
+                    del self._peers[digest]
+                    peers += 1
+        return rounds, peers
+
+
+_storage: Optional[Storage] = None
+
+
+def init(conf: config.Configuration) -> Storage:
+    """
+    Initialize the storage backend selected by the configuration
+
+    The database is only initialized if the database backend is used.
+
+    :param conf: package configuration instance for a NSE5 instance
+    :return: the new storage backend, which is also returned by :func:`get_storage`
+    :raises ValueError: for unknown storage backends
+    """
+
+    global _storage
+    if conf.nse.storage == "database":
+        persistence.init(conf.nse.database, sqlite_profile=conf.nse.sqlite_profile)
+        _storage = DatabaseStorage(conf.nse.store_public_keys, conf.nse.key_cache_size)
+    elif conf.nse.storage == "memory":
+        _storage = MemoryStorage(conf.nse.key_cache_size)
+    else:
+        raise ValueError(f"Unknown storage backend {conf.nse.storage!r}")
+    return _storage
+
+
+def get_storage() -> Storage:
+    """
+    Get the storage backend (the database backend is used if :func:`init` wasn't called)
+
+    :return: storage backend
+    """
+
+    global _storage
+    if _storage is None:
+        _storage = DatabaseStorage()
+    return _storage
@@ -60,6 +60,76 @@ def get_cli_parser() -> argparse.ArgumentParser:
     ))
     parser_new.add_argument("-f", "--force", action="store_true", help="allow overwriting existing files")
 
+    parser_bench = commands.add_parser("bench", help="run the micro-benchmark suite and write the results as JSON")
+    parser_bench.add_argument("-o", dest="output", metavar="<file>", help="write the results to a file (not stdout)")
+    parser_bench.add_argument("-b", dest="baseline", metavar="<file>", help="compare the results with a previous run")
+    parser_bench.add_argument(
+        "-t",
+        dest="threshold",
+        type=float,
+        default=0.1,
+        metavar="<ratio>",
+        help="tolerated relative regression compared to the baseline (defaults to 0.1)"
+    )
+    parser_bench.add_argument("-p", dest="private_key", metavar="<file>", help="RSA private key to sign messages")
+    parser_bench.add_argument("-q", "--quick", action="store_true", help="use smaller, less stable workloads")
+
+    parser_gossip_load = add_conf_option(commands.add_parser(
+        "gossip-load",
+        help="act as Gossip API server and send notifications to a NSE instance at a fixed rate"
+    ))
+    parser_gossip_load.add_argument(
+        "-a", dest="address", metavar="<address>", help="listen address (defaults to the first Gossip API address)"
+    )
+    parser_gossip_load.add_argument(
+        "-r", dest="rate", type=float, default=1000.0, metavar="<rate>",
+        help="notifications sent per second (defaults to 1000)"
+    )
+    parser_gossip_load.add_argument(
+        "-n", dest="count", type=int, default=10000, metavar="<count>",
+        help="total number of notifications (defaults to 10000)"
+    )
+    parser_gossip_load.add_argument(
+        "-k", dest="keys", action="append", metavar="<path>",
+        help="RSA private key or directory of keys (*.pem) of simulated peers (may be repeated)"
+    )
+    parser_gossip_load.add_argument(
+        "-g", dest="generate", type=int, default=4, metavar="<count>",
+        help="number of new keys of simulated peers if no keys are given (defaults to 4)"
+    )
+    parser_gossip_load.add_argument(
+        "--duplicates", type=float, default=0.25, metavar="<ratio>", help="fraction of duplicates (defaults to 0.25)"
+    )
+    parser_gossip_load.add_argument(
+        "--invalid", type=float, default=0.1, metavar="<ratio>", help="fraction of invalid messages (defaults to 0.1)"
+    )
+    parser_gossip_load.add_argument("-o", dest="output", metavar="<file>", help="write the report to a file")
+
+    parser_query_load = add_conf_option(commands.add_parser(
+        "query-load",
+        help="send queries to the API of a NSE instance at fixed rates and measure the latencies"
+    ))
+    parser_query_load.add_argument(
+        "-a", dest="address", metavar="<address>", help="API address (defaults to the configured API address)"
+    )
+    parser_query_load.add_argument(
+        "-r", dest="rates", type=float, action="append", metavar="<rate>",
+        help="queries sent per second (may be repeated to run multiple rates in order, defaults to 1000)"
+    )
+    parser_query_load.add_argument(
+        "-d", dest="duration", type=float, default=10.0, metavar="<seconds>",
+        help="duration of every rate (defaults to 10 seconds)"
+    )
+    parser_query_load.add_argument(
+        "-p", dest="connections", type=int, default=0, metavar="<count>",
+        help="pipeline the queries over persistent connections (defaults to 0, a new connection per query)"
+    )
+    parser_query_load.add_argument(
+        "-t", dest="timeout", type=float, default=5.0, metavar="<seconds>",
+        help="timeout of a single query (defaults to 5 seconds)"
+    )
+    parser_query_load.add_argument("-o", dest="output", metavar="<file>", help="write the report to a file")
+
     add_conf_option(commands.add_parser(
         "validate",
         help="validate the configuration file by showing the parsed values incl. defaults "
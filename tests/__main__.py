@@ -8,7 +8,16 @@ from typing import Optional
 from . import cli, correctness, tools
 
 
-TEST_CLASSES = [cli.CLITests, correctness.SingleTests, correctness.ExecutionTests, tools.ToolTests]
+TEST_CLASSES = [
+    cli.CLITests,
+    correctness.SingleTests,
+    correctness.CachedSingleTests,
+    correctness.ExecutionTests,
+    tools.ToolTests,
+    tools.GossipTests,
+    tools.NSEProtocolTests,
+    tools.SchedulerTests
+]
 
 
 class MainProgram(unittest.TestProgram):
@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 import random
 import string
 import unittest
@@ -45,3 +46,28 @@ class CLITests(unittest.TestCase):
                 capture_output=True
             )
         t.join()
+
+    def test_bench(self):
+        key = utils.find_path([
+            os.path.join(".", "private_keys", "private_key00.pem"),
+            os.path.join(".", "tests", "private_keys", "private_key00.pem")
+        ])
+        prefix = f"/tmp/nse_test_{''.join(random.choice(string.ascii_lowercase) for _ in '_' * 12)}"
+        with open(f"{prefix}_baseline.json", "w") as f:
+            json.dump({"results": {"nonce_search": {"attempts_per_second": 1e12}, "foo": {"bar_seconds": 1}}}, f)
+        p = subprocess.run(
+            [
+                sys.executable, "-m", "p2p_nse5", "bench", "-q", "-p", key,
+                "-o", f"{prefix}.json", "-b", f"{prefix}_baseline.json"
+            ],
+            timeout=120,
+            capture_output=True
+        )
+        self.assertEqual(1, p.returncode)
+        self.assertIn(b"REGRESSION: nonce_search.attempts_per_second", p.stderr)
+        with open(f"{prefix}.json") as f:
+            report = json.load(f)
+        self.assertIn("8_bits_seconds", report["results"]["build_message"])
+        self.assertIn("1000_rounds_seconds", report["results"]["estimate_query"])
+        os.remove(f"{prefix}.json")
+        os.remove(f"{prefix}_baseline.json")
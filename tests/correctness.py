@@ -3,8 +3,11 @@ import sys
 import time
 import random
 import string
+import tempfile
 import subprocess
+import configparser
 
+from p2p_nse5 import config
 from p2p_nse5.persistence import init, get_new_session, Peer, Round
 
 from . import utils
@@ -143,6 +146,43 @@ class SingleTests(NSETests):
             self.assertEqual((i[1], 0), utils.query_nse(("127.0.0.1", self.subprocesses[0][0])))
 
 
+class CachedSingleTests(NSETests):
+    @property
+    def config_path(self) -> str:
+        if hasattr(self, "_config_path"):
+            return self._config_path
+        parser = configparser.ConfigParser(default_section=config.DEFAULT_SECTION)
+        with open(super().config_path) as f:
+            parser.read_string(f"[{config.GLOBAL_SECTION}]{os.linesep}{f.read()}")
+        parser["nse"]["estimate_cache"] = "true"
+        fd, self._config_path = tempfile.mkstemp(suffix=".ini")
+        with os.fdopen(fd, "w") as f:
+            parser.write(f)
+        return self._config_path
+
+    def setUp(self) -> None:
+        self._count = 1
+        super().setUp()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        if hasattr(self, "_config_path"):
+            os.remove(self._config_path)
+
+    def test_cached_responses(self):
+        self.assertTrue(config.load([self.config_path]).nse.estimate_cache)
+        # Changes of the database by other programs aren't noticed by the cache
+        self._wait_for_subprocesses()
+        db = self.subprocesses[0][2]
+        self.assertEqual((0, 0), utils.query_nse(("127.0.0.1", self.subprocesses[0][0])))
+        init(db, False)
+        with get_new_session() as session:
+            session.add(Peer(public_key=b"foo", interactions=0))
+            session.commit()
+        SingleTests._add(0, 2, 1)
+        self.assertEqual((0, 0), utils.query_nse(("127.0.0.1", self.subprocesses[0][0])))
+
+
 class ExecutionTests(NSETests):
     def test_execution(self):
         self._wait_for_subprocesses()
@@ -1,10 +1,60 @@
+import os
+import time
+import pstats
+import shutil
+import signal
+import socket
+import stat
+import tempfile
+import threading
+import tracemalloc
 import random
+import string
+import struct
+import asyncio
 import unittest
+import functools
+import unittest.mock
+from typing import Callable
 
+import pydantic
+import sqlalchemy
 import Crypto.PublicKey.RSA
 
+from p2p_nse5 import benchmark, config, entrypoint, gossip, metrics, nse, persistence, profiling, proof_of_work
+from p2p_nse5 import loadtest, scheduler, storage
 from p2p_nse5.utils import get_std_deviation
-from p2p_nse5.protocols import p2p
+from p2p_nse5.protocols import api, p2p
+
+from . import utils
+
+
+def get_private_key_path(index: int = 0) -> str:
+    key_file = f"private_key{index:0>2}.pem"
+    return utils.find_path([
+        os.path.join(".", "private_keys", key_file),
+        os.path.join(".", "tests", "private_keys", key_file)
+    ])
+
+
+def load_private_key(index: int = 0) -> Crypto.PublicKey.RSA.RsaKey:
+    with open(get_private_key_path(index)) as f:
+        return Crypto.PublicKey.RSA.import_key(f.read())
+
+
+def make_config(**nse_options) -> config.Configuration:
+    nse_options.setdefault("api_address", "127.0.0.1:6000")
+    return config.Configuration(
+        hostkey=get_private_key_path(),
+        gossip={"api_address": "127.0.0.1:5000"},
+        nse=nse_options
+    )
+
+
+def init_temporary_database():
+    storage.init(make_config(
+        database=f"sqlite:////tmp/nse_{''.join(random.choice(string.ascii_lowercase) for _ in range(16))}.db"
+    ))
 
 
 class ToolTests(unittest.TestCase):
@@ -42,3 +92,927 @@ class ToolTests(unittest.TestCase):
                 self.assertEqual(protocol_message.public_key.n, rsa_key.n)
                 self.assertEqual(protocol_message.proximity, p)
                 self.assertEqual(protocol_message.round_time, v)
+
+    def test_search_nonce(self):
+        rsa_key = load_private_key()
+        body = p2p.pack_hashed_body(3, 1337, rsa_key.public_key().export_key("DER"))
+        nonce = p2p.search_nonce(body, 12)
+        self.assertIsNotNone(nonce)
+        self.assertEqual(nonce, p2p.search_nonce(body, 12, nonce, nonce + 1))
+        self.assertIsNone(p2p.search_nonce(body, 12, 0, nonce))
+        with self.assertRaises(ValueError):
+            p2p.build_message(rsa_key, 1337, proximity=3, proof_of_work_bits=12, nonce=nonce + 1)
+
+    def test_proof_of_work_engines(self):
+        self.assertRaises(TypeError, proof_of_work.Engine)
+        rsa_key = load_private_key()
+        for engine in [proof_of_work.ThreadEngine(), proof_of_work.ProcessPoolEngine(2)]:
+            engine.chunk_size = 1 << 10
+            try:
+                for bits in [1, 8, 14]:
+                    v = random.randint(1, 2**20)
+                    msg = asyncio.run(engine.build_message(rsa_key, v, proof_of_work_bits=bits))
+                    protocol_message = p2p.unpack_message(msg, proof_of_work_bits=bits)
+                    self.assertEqual(protocol_message.public_key.n, rsa_key.n)
+                    self.assertEqual(protocol_message.round_time, v)
+                with self.assertRaises(ValueError):
+                    asyncio.run(engine.build_message(rsa_key.public_key(), 1337))
+            finally:
+                engine.close()
+
+    def test_recent_rounds(self):
+        init_temporary_database()
+        rounds = random.sample(range(1000), 100)
+        with persistence.get_new_session() as session:
+            session.add(persistence.Peer(public_key=b"foo", interactions=0))
+            for r in rounds:
+                session.add(persistence.Round(round=r, proximity=r % 7, peer_id=1))
+            session.commit()
+            for current_round in [-1, min(rounds), 500, 2000]:
+                expected = sorted([(r, r % 7) for r in rounds if r <= current_round], reverse=True)[:8]
+                self.assertEqual(expected, persistence.get_recent_rounds(session, current_round, 8))
+
+    def test_compaction(self):
+        init_temporary_database()
+        with persistence.get_new_session() as session:
+            session.add(persistence.Peer(id=1, public_key=b"old", interactions=0, last_round=9))
+            session.add(persistence.Peer(id=2, public_key=b"new", interactions=0, last_round=19))
+            session.add(persistence.Peer(id=3, public_key=b"active", interactions=0, last_round=19))
+            session.add(persistence.Peer(id=4, public_key=b"unused", interactions=0))
+            session.add(persistence.Peer(id=5, public_key=b"recent", interactions=0, last_round=17))
+            for r in range(20):
+                session.add(persistence.Round(round=r, proximity=1, peer_id=[1, 2, 3][r // 10 + r % 2]))
+            session.commit()
+
+            self.assertEqual((10, 2), persistence.compact(session, 10, 15))
+            self.assertEqual(list(range(10, 20)), [r for r, in session.query(persistence.Round.round)])
+            self.assertEqual([2, 3, 5], sorted(p for p, in session.query(persistence.Peer.id)))
+            self.assertEqual([2, 3, 5], sorted(p for p, in session.query(persistence.PeerKey.peer_id)))
+            self.assertEqual((0, 0), persistence.compact(session, None, None))
+
+        self.assertTrue(persistence.vacuum("incremental"))
+        self.assertTrue(persistence.vacuum("incremental"))
+        self.assertFalse(persistence.vacuum("none"))
+        with persistence.get_engine().connect() as connection:
+            self.assertEqual(2, connection.exec_driver_sql("PRAGMA auto_vacuum").scalar())
+
+    def test_peer_fingerprint_migration(self):
+        path = f"/tmp/nse_{''.join(random.choice(string.ascii_lowercase) for _ in range(16))}.db"
+        keys = [load_private_key(i).public_key().export_key("DER") for i in range(3)]
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE peers (id INTEGER NOT NULL, public_key BLOB NOT NULL, "
+                "interactions INTEGER NOT NULL, created DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL, "
+                "updated DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL, "
+                "PRIMARY KEY (id), UNIQUE (id), UNIQUE (public_key))"
+            )
+            for i, key in enumerate(keys):
+                connection.execute(
+                    sqlalchemy.text("INSERT INTO peers (id, public_key, interactions) VALUES (:id, :key, 1)"),
+                    {"id": i + 1, "key": key}
+                )
+        engine.dispose()
+
+        storage.init(make_config(database=f"sqlite:///{path}"))
+        try:
+            with persistence.get_new_session() as session:
+                peers = session.query(persistence.Peer).order_by(persistence.Peer.id).all()
+                self.assertEqual([1, 2, 3], [p.id for p in peers])
+                self.assertEqual(keys, [p.public_key for p in peers])
+                self.assertEqual([persistence.get_fingerprint(k) for k in keys], [p.fingerprint for p in peers])
+
+            # Migrated peers are found by their fingerprints and new peers are stored without their keys
+            backend = storage.DatabaseStorage(store_public_keys=False)
+            entries = [p2p.KeyCacheEntry(k, None, None) for k in [keys[1], b"foo"]]
+            update = storage.RoundUpdate
+            peer_ids = asyncio.run(backend.store_rounds([update(1, 1, 1, entries[0]), update(2, 1, 1, entries[1])]))
+            self.assertEqual([2, 4], peer_ids)
+            with persistence.get_new_session() as session:
+                self.assertIsNone(session.query(persistence.Peer).filter_by(id=4).one().public_key)
+            self.assertEqual(persistence.SCHEMA_VERSION, persistence.get_schema_version(persistence.get_engine()))
+            with persistence.get_engine().begin() as connection:
+                self.assertFalse(persistence._migrate_peer_fingerprints(connection))  # noqa
+        finally:
+            init_temporary_database()
+
+    def test_schema_migration(self):
+        path = f"/tmp/nse_{''.join(random.choice(string.ascii_lowercase) for _ in range(16))}.db"
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        self.assertIsNone(persistence.get_schema_version(engine))
+        self.assertEqual(0, persistence.migrate(engine))
+        self.assertEqual(persistence.SCHEMA_VERSION, persistence.get_schema_version(engine))
+
+        # Up-to-date databases are neither reflected nor created again
+        with unittest.mock.patch.object(persistence.Base.metadata, "create_all") as create_all, \
+                unittest.mock.patch.object(persistence, "inspect") as inspect:
+            self.assertEqual(persistence.SCHEMA_VERSION, persistence.migrate(engine))
+            create_all.assert_not_called()
+            inspect.assert_not_called()
+
+        # Indexes of older versions are added in place
+        with engine.begin() as connection:
+            for index in persistence.Round.__table__.indexes:
+                index.drop(connection)
+            connection.execute(persistence.SchemaVersion.__table__.update().values(version=2))
+        self.assertEqual(2, persistence.migrate(engine))
+        indexes = {i["name"] for i in sqlalchemy.inspect(engine).get_indexes("rounds")}
+        self.assertTrue({"ix_rounds_round_proximity", "ix_rounds_peer_id"}.issubset(indexes))
+        with engine.connect() as connection:
+            plan = connection.exec_driver_sql(
+                "EXPLAIN QUERY PLAN SELECT round, proximity FROM rounds WHERE round <= 5 ORDER BY round DESC LIMIT 8"
+            ).all()
+        self.assertIn("COVERING INDEX", " ".join(row[-1] for row in plan))
+
+        with engine.begin() as connection:
+            connection.execute(persistence.SchemaVersion.__table__.update().values(version=1000))
+        self.assertRaises(ValueError, persistence.migrate, engine)
+        engine.dispose()
+
+    def test_sqlite_profiles(self):
+        for name, pragmas in persistence.SQLITE_PROFILES.items():
+            path = f"/tmp/nse_{''.join(random.choice(string.ascii_lowercase) for _ in range(16))}.db"
+            persistence.init(f"sqlite:///{path}", sqlite_profile=name)
+            with persistence.get_engine().connect() as connection:
+                for key, value in pragmas.items():
+                    result = connection.exec_driver_sql(f"PRAGMA {key}").scalar()
+                    expected = {"WAL": "wal", "FULL": 2, "NORMAL": 1, "MEMORY": 2}.get(value, value)
+                    self.assertEqual(expected, result, key)
+        with self.assertRaises(KeyError):
+            persistence.init("sqlite://", sqlite_profile="foo")
+        init_temporary_database()
+
+    def test_storage_backends(self):
+        async def run(backend: storage.Storage):
+            keys = [p2p.KeyCacheEntry(bytes([i]) * 8, None, None) for i in range(3)]
+            update = storage.RoundUpdate
+            fingerprint = "0" * 64
+            return [
+                await backend.store_rounds([update(5, 3, 1, keys[0]), update(7, 1, 2, keys[1])]),
+                await backend.store_rounds([update(5, 2, 4, keys[1]), update(9, 4, 1, keys[2])]),
+                await backend.get_proximity(5),
+                await backend.get_proximity(6),
+                await backend.get_recent_rounds(8, 2),
+                await backend.get_recent_rounds(100, 8),
+                [await backend.store_message(r, fingerprint, 8, bytes([r])) for r in range(10, 13)],
+                await backend.prune_messages(11, 12, fingerprint, 8),
+                await backend.get_message(11, fingerprint, 8),
+                await backend.get_message(11, "1" * 64, 8),
+                await backend.get_message(11, fingerprint, 10),
+                await backend.compact(7, 100),
+                await backend.get_recent_rounds(100, 8),
+                await backend.store_rounds([update(11, 1, 1, keys[0]), update(12, 1, 1, keys[1])])
+            ]
+
+        expected = [
+            [1, 2], [2, 3], 3, None, [(7, 1), (5, 3)], [(9, 4), (7, 1), (5, 3)], [None] * 3, {11, 12},
+            b"\x0b", None, None, (1, 1), [(9, 4), (7, 1)], [4, 2]
+        ]
+        init_temporary_database()
+        self.assertEqual(expected, asyncio.run(run(storage.get_storage())))
+        self.assertEqual(expected, asyncio.run(run(storage.MemoryStorage())))
+        self.assertRaises(TypeError, storage.Storage)
+
+    def test_memory_storage(self):
+        conf = make_config(storage="memory", frequency=3600, proof_of_work_bits=8, api_idle_timeout=0)
+        try:
+            self.assertIsInstance(storage.init(conf), storage.MemoryStorage)
+            start = nse.get_start_time(conf)
+            writer = gossip.RoundWriter(interval=3600)
+            protocol = gossip.Protocol(conf, writer=writer)
+            protocol.transport = _FakeTransport()
+            msg = p2p.build_message(load_private_key(1), start, proof_of_work_bits=8)
+            proximity = p2p.calculate_proximity(load_private_key(1), start)
+
+            async def run():
+                header = struct.pack("!HHHH", 8 + len(msg), api.MessageType.GOSSIP_NOTIFICATION, 1, 1)
+                protocol.data_received(header + msg)
+                await wait_for(lambda: len(protocol.transport.written) == 1)
+                self.assertEqual(1, await writer.flush())
+                self.assertEqual(proximity, await storage.get_storage().get_proximity(nse.get_current_round(conf)))
+                return await nse.query_estimate(conf)
+
+            self.assertEqual((round(nse.get_size_estimate(proximity)), 0), asyncio.run(run()))
+        finally:
+            init_temporary_database()
+
+    def test_message_cache(self):
+        init_temporary_database()
+        conf = make_config(frequency=60, proof_of_work_bits=8, precompute_rounds=2)
+        cache = nse.MessageCache(conf)
+        engine = proof_of_work.ThreadEngine()
+        self.assertEqual(3, asyncio.run(cache.fill(engine, 100)))
+        self.assertEqual(0, asyncio.run(cache.fill(engine, 100)))
+        protocol_message = p2p.unpack_message(asyncio.run(cache.get(101)), proof_of_work_bits=8)
+        self.assertEqual(protocol_message.round_time, 101 * 60)
+        self.assertEqual(protocol_message.public_key.n, conf.public_key.n)
+        self.assertIsNone(asyncio.run(cache.get(103)))
+        self.assertEqual(2, asyncio.run(cache.fill(engine, 102)))
+        self.assertIsNone(asyncio.run(cache.get(101)))
+        self.assertIsNotNone(asyncio.run(cache.get(104)))
+        conf.nse.proof_of_work_bits = 10
+        self.assertIsNone(asyncio.run(cache.get(104)))
+        self.assertEqual(3, asyncio.run(cache.fill(engine, 102)))
+
+    def test_key_cache(self):
+        cache = p2p.KeyCache(2)
+        keys = [load_private_key(i).public_key() for i in range(3)]
+        msg = p2p.build_message(load_private_key(0), 1337, proof_of_work_bits=4)
+        protocol_message = p2p.unpack_message(msg, proof_of_work_bits=4, keys=cache)
+        self.assertIs(protocol_message.key, cache.get(keys[0].export_key("DER")))
+        self.assertIs(protocol_message.key, p2p.unpack_message(msg, proof_of_work_bits=4, keys=cache).key)
+        for k in keys:
+            self.assertEqual(k.n, cache.get(k.export_key("DER")).public_key.n)
+        self.assertEqual(2, len(cache))
+        with self.assertRaises(ValueError):
+            cache.get(b"foo")
+
+    def test_proximity(self):
+        keys = [load_private_key(i) for i in range(4)]
+        values = [0, 1, 255, 256, 1337, 2**64 - 1, b"", b"foo", *[random.randint(0, 2**40) for _ in range(64)]]
+        for k in keys:
+            for v in values:
+                self.assertEqual(benchmark._legacy_calculate_proximity(k, v), p2p.calculate_proximity(k, v))  # noqa
+        proximities = p2p.calculate_proximities(keys, values)
+        self.assertEqual([[p2p.calculate_proximity(k, v) for v in values] for k in keys], proximities)
+        self.assertEqual([], p2p.calculate_proximities([], values))
+        self.assertEqual([[]], p2p.calculate_proximities(keys[:1], []))
+
+        # Building messages reuses the cached modulus prefix of the private key
+        p2p.calculate_proximity(keys[0], 1337)
+        cached = len(p2p._modulus_prefixes)  # noqa
+        p2p.build_message(keys[0], 1337, proof_of_work_bits=1)
+        asyncio.run(proof_of_work.ThreadEngine().build_message(keys[0], 1337, proof_of_work_bits=1))
+        self.assertEqual(cached, len(p2p._modulus_prefixes))  # noqa
+        with self.assertRaises(TypeError):
+            p2p.calculate_proximity(keys[0], "foo")
+
+    def test_benchmark_compare(self):
+        baseline = {"foo": {"bar_per_second": 100, "baz_seconds": 1.0, "old_seconds": 1.0}}
+        results = {"foo": {"bar_per_second": 95, "baz_seconds": 1.05, "new_seconds": 1.0}, "qux": {"a_seconds": 1}}
+        self.assertEqual([], benchmark.compare(results, baseline))
+        results["foo"] = {"bar_per_second": 50, "baz_seconds": 0.5}
+        regressions = benchmark.compare(results, baseline)
+        self.assertEqual([("foo", "bar_per_second", 100, 50)], regressions)
+        self.assertAlmostEqual(1.0, regressions[0].change)
+        results["foo"] = {"bar_per_second": 200, "baz_seconds": 1.5}
+        self.assertEqual(["baz_seconds"], [r.metric for r in benchmark.compare(results, baseline, 0.25)])
+        self.assertEqual([], benchmark.compare(results, baseline, 0.5))
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        self.assertRaises(TypeError, metrics.Metric, registry, "foo", "bar")
+        counter = registry.counter("foo_total", "Foo", ("reason",))
+        histogram = registry.histogram("bar_seconds", "Bar", (0.1, 1.0))
+        counter.inc("a")
+        histogram.observe(0.5)
+        with histogram.time():
+            pass
+        self.assertEqual((0, 0), (counter.get("a"), histogram.count))
+
+        registry.enabled = True
+        counter.inc("a")
+        counter.inc("b", amount=2)
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value)
+        with histogram.time():
+            pass
+        self.assertIs(counter, registry.counter("foo_total", "Foo", ("reason",)))
+        self.assertRaises(ValueError, registry.histogram, "foo_total", "Foo")
+        self.assertRaises(ValueError, registry.histogram, "baz_seconds", "Baz", (1.0, 0.1))
+        self.assertEqual([
+            "# HELP bar_seconds Bar",
+            "# TYPE bar_seconds histogram",
+            'bar_seconds_bucket{le="0.1"} 3',
+            'bar_seconds_bucket{le="1.0"} 4',
+            'bar_seconds_bucket{le="+Inf"} 5',
+            f"bar_seconds_sum {histogram.sum!r}",
+            "bar_seconds_count 5",
+            "# HELP foo_total Foo",
+            "# TYPE foo_total counter",
+            'foo_total{reason="a"} 1',
+            'foo_total{reason="b"} 2'
+        ], registry.expose().splitlines())
+
+        async def get(path: str, address: str) -> bytes:
+            reader, writer = await asyncio.open_unix_connection(address)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        async def run():
+            address = f"/tmp/nse_{''.join(random.choice(string.ascii_lowercase) for _ in range(16))}.sock"
+            server = await metrics.serve(metrics.UNIX_PREFIX + address, registry)
+            try:
+                response = await get("/metrics", address)
+                self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+                self.assertTrue(response.endswith(registry.expose().encode()))
+                self.assertTrue((await get("/foo", address)).startswith(b"HTTP/1.0 404"))
+            finally:
+                server.close()
+                os.remove(address)
+
+            # Only giving a port binds the endpoint to localhost
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                port = s.getsockname()[1]
+            server = await metrics.serve(str(port), registry)
+            try:
+                self.assertEqual([("127.0.0.1", port)], [s.getsockname() for s in server.sockets])
+            finally:
+                server.close()
+
+        asyncio.run(run())
+
+        # Rejected notifications are counted by their reason in the global registry
+        metrics.registry.enabled = True
+        try:
+            protocol = gossip.Protocol(make_config())
+            protocol.transport = _FakeTransport()
+            rejected = metrics.registry.get("nse_gossip_rejected_total")
+            before = rejected.get("malformed")
+            asyncio.run(protocol._process(1, b"foo", 0))  # noqa
+            self.assertEqual(before + 1, rejected.get("malformed"))
+            self.assertIn('nse_gossip_rejected_total{reason="malformed"}', metrics.registry.expose())
+        finally:
+            metrics.registry.enabled = False
+        self.assertRaises(pydantic.ValidationError, make_config, metrics_address="unix:")
+        self.assertRaises(pydantic.ValidationError, make_config, metrics_address="8.8.8.8:9105")
+        self.assertEqual("9105", make_config(metrics_address="9105").nse.metrics_address)
+        self.assertEqual("127.0.0.1:9105", metrics.get_address("9105"))
+        self.assertEqual("[::1]:9105", metrics.get_address("[::1]:9105"))
+
+    def test_profiling(self):
+        directory = tempfile.mkdtemp()
+        conf = make_config(admin_socket=os.path.join(directory, "admin.sock"), profile_directory=directory)
+        profiler = profiling.Profiler(conf)
+
+        async def run():
+            # Stale sockets are replaced
+            with socket.socket(socket.AF_UNIX) as s:
+                s.bind(conf.nse.admin_socket)
+            # The socket is bound with the restricted mode instead of changing it afterwards
+            umask = os.umask(0o022)
+            with unittest.mock.patch.object(profiling.os, "chmod") as chmod:
+                await profiler.start()
+            chmod.assert_not_called()
+            self.assertEqual(0o022, os.umask(umask))
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(conf.nse.admin_socket).st_mode))
+            reader, writer = await asyncio.open_unix_connection(conf.nse.admin_socket)
+
+            async def execute(command: str) -> str:
+                writer.write(command.encode() + b"\n")
+                return (await reader.readline()).decode().strip()
+
+            # The event loop keeps running while the CPU profiler is enabled
+            ticks = 0
+            answer = asyncio.ensure_future(execute("profile 0.2"))
+            while not answer.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+            self.assertGreater(ticks, 5)
+            status, path = answer.result().split(" ", 1)
+            self.assertEqual("ok", status)
+            self.assertIn("_handle_client", str(pstats.Stats(path).stats))
+
+            status, path = (await execute("memory")).split(" ", 1)
+            self.assertEqual("ok", status)
+            self.assertEqual("ok", (await execute("memory")).split(" ", 1)[0])
+            status, path = (await execute("tasks")).split(" ", 1)
+            with open(path) as f:
+                self.assertIn("_handle_client", f.read())
+            self.assertTrue((await execute("profile 0")).startswith("error"))
+            self.assertTrue((await execute("foo")).startswith("error"))
+            writer.close()
+
+            files = len(os.listdir(directory))
+            os.kill(os.getpid(), signal.SIGUSR2)
+            await wait_for(lambda: len(os.listdir(directory)) == files + 2)
+            profiler.close()
+            self.assertFalse(os.path.exists(conf.nse.admin_socket))
+
+        try:
+            asyncio.run(run())
+        finally:
+            tracemalloc.stop()
+            shutil.rmtree(directory)
+
+    def test_message_framer(self):
+        messages = [struct.pack("!HH", 4 + n, api.MessageType.NSE_QUERY) + os.urandom(n) for n in [0, 1, 2000, 65531]]
+        stream = b"".join(messages * 3)
+        for capacity in [4, 4096]:
+            for chunk in [1, 3, 1000, len(stream)]:
+                framer = api.MessageFramer(capacity)
+                received = []
+                for i in range(0, len(stream), chunk):
+                    received.extend(bytes(m) for m in framer.feed(stream[i:i + chunk]))
+                self.assertEqual(messages * 3, received)
+                self.assertEqual(0, len(framer))
+                self.assertLessEqual(len(framer._buffer), api.MAX_MESSAGE_SIZE)  # noqa
+
+        framer = api.MessageFramer()
+        self.assertEqual([], list(framer.feed(b"\x00\x08\x02")))
+        with self.assertRaises(api.InvalidMessage):
+            list(framer.feed(b"\x08\x00\x00\x00\x00\x00\x00\x02\x00"))
+        self.assertEqual(0, len(framer))
+        self.assertEqual([b"\x00\x04\x02\x08"], [bytes(m) for m in framer.feed(b"\x00\x04\x02\x08")])
+
+
+async def wait_for(predicate: Callable[[], bool], timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        await asyncio.sleep(0.001)
+
+
+class _FakeTransport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data: bytes):
+        self.written.append(data)
+
+    def get_extra_info(self, name: str, default=None):
+        return ("127.0.0.1", 40000) if name == "peername" else default
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def can_write_eof(self) -> bool:
+        return True
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class GossipTests(unittest.TestCase):
+    def setUp(self) -> None:
+        init_temporary_database()
+        self.conf = make_config(frequency=3600, proof_of_work_bits=8)
+        self.writer = gossip.RoundWriter(interval=3600)
+        self.protocol = gossip.Protocol(self.conf, writer=self.writer)
+        self.protocol.transport = _FakeTransport()
+        self.message_id = 0
+
+    def _pack(self, payload: bytes) -> bytes:
+        self.message_id += 1
+        return struct.pack("!HHHH", 8 + len(payload), api.MessageType.GOSSIP_NOTIFICATION, self.message_id, 1) + payload
+
+    async def _notify(self, payload: bytes) -> bool:
+        written = len(self.protocol.transport.written)
+        self.protocol.data_received(self._pack(payload))
+        await wait_for(lambda: len(self.protocol.transport.written) > written)
+        size, msg_type, message_id, valid = struct.unpack("!HHHH", self.protocol.transport.written[-1])
+        self.assertEqual(msg_type, api.MessageType.GOSSIP_VALIDATION)
+        self.assertEqual(message_id, self.message_id)
+        return bool(valid)
+
+    def test_staged_validation(self):
+        start = nse.get_start_time(self.conf)
+        keys = sorted(
+            [load_private_key(i) for i in range(4)],
+            key=lambda k: p2p.calculate_proximity(k, start)
+        )
+        messages = [p2p.build_message(k, start, proof_of_work_bits=8) for k in keys]
+
+        tampered = messages[-1][:-1] + bytes([messages[-1][-1] ^ 1])
+        relayed = messages[-1][:1] + struct.pack("!H", 3) + messages[-1][3:]
+
+        async def run():
+            self.assertFalse(await self._notify(b"foo"))
+            self.assertFalse(await self._notify(p2p.build_message(keys[0], start - 3600, proof_of_work_bits=8)))
+            self.assertEqual(0, unpack.call_count)
+            self.assertFalse(await self._notify(tampered))
+            self.assertFalse(await self._notify(tampered))
+            self.assertEqual(1, unpack.call_count)
+            self.assertTrue(await self._notify(messages[-1]))
+            self.assertFalse(await self._notify(messages[0]))
+            self.assertFalse(await self._notify(relayed))
+            self.assertEqual(2, unpack.call_count)
+            self.assertEqual(1, await self.writer.flush())
+
+        with unittest.mock.patch.object(p2p, "unpack_message", wraps=p2p.unpack_message) as unpack:
+            asyncio.run(run())
+
+        with persistence.get_new_session() as session:
+            model = session.query(persistence.Round).filter_by(round=nse.get_current_round(self.conf)).one()
+            self.assertEqual(model.proximity, p2p.calculate_proximity(keys[-1], start))
+
+    def test_coalesced_and_split_notifications(self):
+        start = nse.get_start_time(self.conf)
+        messages = [p2p.build_message(load_private_key(i), start, proof_of_work_bits=8) for i in range(3)]
+        stream = b"".join(self._pack(m) for m in messages)
+        written = self.protocol.transport.written
+
+        async def run():
+            self.protocol.data_received(stream[:100])
+            await asyncio.sleep(0.05)
+            self.assertEqual([], written)
+            self.protocol.data_received(stream[100:len(stream) - 10])
+            await wait_for(lambda: len(written) == 2)
+            self.protocol.data_received(stream[len(stream) - 10:])
+            await wait_for(lambda: len(written) == 3)
+
+        asyncio.run(run())
+        self.assertEqual([1, 2, 3], sorted(struct.unpack("!HHHH", w)[2] for w in written))
+
+    def test_write_behind(self):
+        start = nse.get_start_time(self.conf)
+        current_round = nse.get_current_round(self.conf)
+        keys = sorted(map(load_private_key, range(8)), key=lambda k: p2p.calculate_proximity(k, start))
+        worst, best = p2p.calculate_proximity(keys[0], start), p2p.calculate_proximity(keys[-1], start)
+        flushed = []
+        self.writer = gossip.RoundWriter(interval=3600, batch_size=2, on_flush=lambda: flushed.append(True))
+        self.protocol = gossip.Protocol(self.conf, writer=self.writer)
+        self.protocol.transport = _FakeTransport()
+
+        def select():
+            with persistence.get_new_session() as session:
+                return [(m.round, m.proximity, m.max_hops) for m in session.query(persistence.Round).order_by("round")]
+
+        async def run():
+            self.assertTrue(await self._notify(p2p.build_message(keys[0], start, proof_of_work_bits=8)))
+            self.assertEqual(best > worst, await self._notify(p2p.build_message(keys[-1], start, proof_of_work_bits=8)))
+            self.assertEqual(1, len(self.writer))
+            self.assertEqual([], select())
+            self.assertTrue(await self._notify(p2p.build_message(keys[0], start + 3600, proof_of_work_bits=8)))
+            await wait_for(lambda: len(flushed) == 1)
+            self.assertEqual(0, len(self.writer))
+            self.assertEqual([
+                (current_round, best, 0),
+                (current_round + 1, p2p.calculate_proximity(keys[0], start + 3600), 0)
+            ], select())
+            self.assertIn(keys[0].public_key().export_key("DER"), storage.get_storage()._peer_ids)  # noqa
+
+            # Stored rounds are only replaced by better ones, but the hop count is still updated
+            key = p2p.key_cache.get(keys[0].public_key().export_key("DER"))
+            self.writer.add(current_round, 0, 5, key)
+            self.assertEqual(1, await self.writer.flush())
+            self.assertEqual((current_round, best, 5), select()[0])
+
+        asyncio.run(run())
+
+    def test_connection_pool(self):
+        received = {0: bytearray(), 1: bytearray()}
+        streams = {}
+        notify = api.pack_gossip_notify(self.conf.nse.data_type)
+
+        async def serve(index: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            streams[index] = writer
+            while data := await reader.read(1024):
+                received[index].extend(data)
+
+        async def start_server(index: int, port: int = 0) -> asyncio.AbstractServer:
+            return await asyncio.start_server(functools.partial(serve, index), "127.0.0.1", port)
+
+        async def run():
+            servers = [await start_server(i) for i in range(2)]
+            ports = [server.sockets[0].getsockname()[1] for server in servers]
+            conf = config.Configuration(
+                hostkey=get_private_key_path(),
+                gossip={"api_address": f"127.0.0.1:{ports[0]}, 127.0.0.1:{ports[1]}", "reconnect_max_delay": 0.2},
+                nse={"api_address": "127.0.0.1:6000"}
+            )
+            pool = gossip.ConnectionPool(conf, lambda reconnect: gossip.Protocol(conf, reconnect))
+            await pool.start()
+            self.assertEqual(pool.endpoints, pool.healthy)
+            self.assertTrue(pool.announce(b"foo"))
+            await wait_for(lambda: received[0] == notify + b"foo")
+            await wait_for(lambda: received[1] == notify)
+
+            # Announcements fail over to the next endpoint while the first one is re-connected
+            servers[0].close()
+            streams[0].close()
+            await wait_for(lambda: not pool.endpoints[0].healthy)
+            self.assertTrue(pool.announce(b"bar"))
+            await wait_for(lambda: received[1] == notify + b"bar")
+            await wait_for(lambda: pool.endpoints[0].failures > 1)
+            received[0].clear()
+            servers[0] = await start_server(0, ports[0])
+            await wait_for(lambda: pool.endpoints[0].healthy)
+            self.assertEqual(0, pool.endpoints[0].failures)
+
+            conf.gossip.announce_mode = "fanout"
+            self.assertTrue(pool.announce(b"baz"))
+            await wait_for(lambda: received[0] == notify + b"baz" and received[1] == notify + b"barbaz")
+            self.assertEqual([2, 2], [e.announcements for e in pool.endpoints])
+
+            pool.close()
+            await wait_for(lambda: not pool.healthy)
+            self.assertFalse(pool.announce(b"foo"))
+            for server in servers:
+                server.close()
+            self.assertTrue(all(0.1 <= pool.get_delay(f) <= 0.2 for f in range(1, 100)))
+
+            # The startup fails if no endpoint is reachable at all
+            pool = gossip.ConnectionPool(conf, lambda reconnect: gossip.Protocol(conf, reconnect))
+            with self.assertRaises(OSError):
+                await pool.start()
+
+        with self.assertLogs("gossip", "WARNING"):
+            asyncio.run(run())
+        self.assertRaises(pydantic.ValidationError, config.GossipConfiguration, api_address="127.0.0.1:1,127.0.0.1:1")
+        self.assertRaises(pydantic.ValidationError, config.GossipConfiguration, api_address="127.0.0.1:1,8.8.8.8:1")
+
+    def test_best_proximity(self):
+        cache = gossip.NotificationCache()
+
+        async def run():
+            with unittest.mock.patch.object(storage.get_storage(), "get_proximity", return_value=None) as get:
+                self.assertIsNone(await cache.get_best_proximity(5))
+                self.assertIsNone(await cache.get_best_proximity(5))
+                get.assert_called_once_with(5)
+                self.assertTrue(cache.offer(5, 3))
+                self.assertEqual(3, await cache.get_best_proximity(5))
+                self.assertFalse(cache.offer(5, 3))
+                get.assert_called_once_with(5)
+
+        asyncio.run(run())
+
+    def test_round_handler_suppression(self):
+        written = []
+        cache = gossip.NotificationCache()
+        handler = nse.RoundHandler(self.conf, written.append, notifications=cache)
+        # The accepted value is still buffered and unknown to the storage
+        self.assertTrue(cache.offer(handler.round_id, handler.own_proximity))
+
+        async def run():
+            with unittest.mock.patch.object(nse.asyncio, "sleep"):
+                return await handler.run()
+
+        self.assertFalse(asyncio.run(run()))
+        self.assertEqual([], written)
+        self.assertIsNone(asyncio.run(storage.get_storage().get_proximity(handler.round_id)))
+
+    def test_notification_verification(self):
+        cache = gossip.NotificationCache()
+        msg = p2p.build_message(load_private_key(0), nse.get_start_time(self.conf), proof_of_work_bits=8)
+        forged = msg[:-1] + bytes([msg[-1] ^ 1])
+        header = p2p.unpack_header(msg)
+        threads = []
+        unpack_message = p2p.unpack_message
+
+        def record(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return unpack_message(*args, **kwargs)
+
+        async def run():
+            with unittest.mock.patch.object(p2p, "unpack_message", record):
+                results = await asyncio.gather(
+                    *[cache.verify(m, header, 8) for m in [msg, msg, forged, msg, forged]], return_exceptions=True
+                )
+                # Cached results are used without verifying the messages again
+                await cache.verify(msg, header, 8)
+                return results
+
+        results = asyncio.run(run())
+        self.assertEqual([header.proximity] * 3, [results[i].proximity for i in (0, 1, 3)])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertIsInstance(results[4], ValueError)
+        # Concurrent duplicates share one verification, which isn't executed by the event loop
+        self.assertEqual(2, len(threads))
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_load_generator(self):
+        start = nse.get_start_time(self.conf)
+        keys = [load_private_key(i) for i in range(4)]
+
+        async def run():
+            messages = await loadtest.build_messages(keys, [start, start + 3600], 8)
+            self.assertEqual(8, len(messages))
+            self.assertTrue(all(p2p.unpack_message(m, proof_of_work_bits=8) for m in messages))
+            outdated = await loadtest.build_messages(keys, [start - 3600], 8)
+            corpus = loadtest.make_corpus(messages, 300, duplicates=0.3, invalid=0.2, seed=42, outdated=outdated)
+            self.assertEqual(corpus, loadtest.make_corpus(
+                messages, 300, duplicates=0.3, invalid=0.2, seed=42, outdated=outdated
+            ))
+            self.assertEqual(messages, [payload for kind, payload in corpus if kind == "valid"])
+            self.assertTrue(all(payload in outdated for kind, payload in corpus if kind == "outdated"))
+            self.assertNotIn("outdated", {kind for kind, _ in loadtest.make_corpus(messages, 300, invalid=0.5)})
+
+            generator = loadtest.GossipLoadGenerator(corpus, 3000, self.conf.nse.data_type, sample_interval=0.01)
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+            await generator.start(f"127.0.0.1:{port}")
+            writer = gossip.RoundWriter(interval=3600)
+            transport, _ = await asyncio.get_running_loop().create_connection(
+                lambda: gossip.Protocol(self.conf, writer=writer), "127.0.0.1", port
+            )
+            report = await generator.run(5)
+            transport.close()
+            return report
+
+        with self.assertLogs("gossip", "WARNING"):
+            report = asyncio.run(run())
+        self.assertEqual(300, report["sent"])
+        self.assertEqual(300, report["validated"])
+        self.assertEqual(0, report["unanswered"])
+        self.assertEqual(300, sum(k["sent"] for k in report["kinds"].values()))
+        # Notifications are validated concurrently, so a duplicate may be accepted instead of its original
+        kinds = report["kinds"]
+        self.assertEqual(report["accepted"], kinds["valid"]["accepted"] + kinds["duplicate"]["accepted"])
+        self.assertTrue(2 <= report["accepted"] <= 8)
+        for kind in loadtest.INVALID_KINDS:
+            self.assertEqual(report["kinds"][kind]["sent"], report["kinds"][kind]["rejected"])
+        latency = report["latency_seconds"]
+        self.assertTrue(0 < latency["p50"] <= latency["p99"] <= latency["p999"] <= latency["max"])
+
+        self.assertEqual(0.0, loadtest.get_percentile([], 0.5))
+        self.assertEqual(3, loadtest.get_percentile([1, 2, 3, 4], 0.75))
+        self.assertEqual(4, loadtest.get_percentile([1, 2, 3, 4], 0.999))
+        self.assertRaises(ValueError, loadtest.make_corpus, messages=[b"foo"], count=1, invalid=1.5)
+
+
+class NSEProtocolTests(unittest.TestCase):
+    def setUp(self) -> None:
+        init_temporary_database()
+
+    @staticmethod
+    def _connect(conf: config.Configuration) -> nse.Protocol:
+        protocol = nse.Protocol(conf)
+        protocol.connection_made(_FakeTransport())
+        return protocol
+
+    def test_pipelined_queries(self):
+        async def run():
+            protocol = self._connect(make_config(api_max_queries=5, api_idle_timeout=0))
+            protocol.data_received(b"\x00\x04\x02\x08" * 3 + b"\x00\x04")
+            await wait_for(lambda: len(protocol.transport.written) == 3)
+            protocol.data_received(b"\x02\x08\x00\x04\x02\x08\x00\x04\x02\x08" + b"\x00\x04\x02\x08" * 2)
+            await wait_for(lambda: protocol.transport.closed)
+            self.assertEqual([api.pack_nse_estimate(0, 0)] * 5, protocol.transport.written)
+
+            protocol = self._connect(make_config(api_max_queries=0, api_idle_timeout=0))
+            protocol.data_received(b"\x00\x04\x02\x08" * 100)
+            await wait_for(lambda: len(protocol.transport.written) == 100)
+            self.assertFalse(protocol.transport.closed)
+
+        asyncio.run(run())
+
+    def test_idle_timeout(self):
+        async def run():
+            protocol = self._connect(make_config(api_idle_timeout=0.1))
+            await asyncio.sleep(0.06)
+            protocol.data_received(b"\x00\x04\x02\x08")
+            await asyncio.sleep(0.06)
+            self.assertFalse(protocol.transport.closed)
+            await asyncio.sleep(0.1)
+            self.assertTrue(protocol.transport.closed)
+
+        asyncio.run(run())
+
+    def test_estimate_cache(self):
+        def add_round(round_id: int, proximity: int):
+            with persistence.get_new_session() as session:
+                session.add(persistence.Round(round=round_id, proximity=proximity, peer_id=1))
+                session.commit()
+
+        async def run():
+            conf = make_config(api_idle_timeout=0, frequency=3600)
+            cache = nse.EstimateCache(conf)
+            protocol = nse.Protocol(conf, cache)
+            protocol.connection_made(_FakeTransport())
+            with persistence.get_new_session() as session:
+                session.add(persistence.Peer(public_key=b"foo", interactions=0))
+                session.commit()
+
+            async def query(n: int):
+                protocol.data_received(b"\x00\x04\x02\x08")
+                await wait_for(lambda: len(protocol.transport.written) == n)
+
+            now = 3600 * 1000 + 1
+            with unittest.mock.patch.object(nse.time, "time", return_value=now):
+                await query(1)
+                add_round(1000, 2)
+                await query(2)
+                cache.invalidate(1000, 2)
+                await query(3)
+            add_round(1001, 2)
+            with unittest.mock.patch.object(nse.time, "time", return_value=now + 3600):
+                await query(4)
+                self.assertIsNotNone(cache.peek())
+            self.assertEqual([
+                api.pack_nse_estimate(0, 0),
+                api.pack_nse_estimate(0, 0),
+                api.pack_nse_estimate(3, 0),
+                api.pack_nse_estimate(6, 0)
+            ], protocol.transport.written)
+
+        asyncio.run(run())
+
+    def test_query_load_generator(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        conf = make_config(api_address=f"127.0.0.1:{port}", api_max_queries=10, api_idle_timeout=0)
+
+        async def run():
+            server = await asyncio.get_running_loop().create_server(lambda: nse.Protocol(conf), "127.0.0.1", port)
+            single = await loadtest.QueryLoadGenerator(f"127.0.0.1:{port}", 0, 5).run(200, 0.5)
+            pipelined = await loadtest.QueryLoadGenerator(f"127.0.0.1:{port}", 4, 5).run(400, 0.5)
+            server.close()
+            await server.wait_closed()
+            failed = await loadtest.QueryLoadGenerator(f"127.0.0.1:{port}", 0, 5).run(100, 0.1)
+            return single, pipelined, failed
+
+        single, pipelined, failed = asyncio.run(run())
+        self.assertEqual(100, single["sent"])
+        self.assertEqual(100, single["answered"])
+        self.assertEqual(0, single["error_rate"])
+        latency = single["latency_seconds"]
+        self.assertTrue(0 < latency["p50"] <= latency["p99"] <= latency["p999"] <= latency["max"] < 5)
+
+        # Connections closed after ten queries are re-opened, queries sent in the meantime may fail
+        self.assertEqual(200, pipelined["sent"])
+        self.assertEqual(200, pipelined["answered"] + pipelined["failed"])
+        self.assertEqual({"closed"}, set(pipelined["errors"]) | {"closed"})
+        self.assertGreaterEqual(pipelined["answered"], 40)
+
+        self.assertEqual(10, failed["sent"])
+        self.assertEqual({"connect": 10}, failed["errors"])
+        self.assertEqual(1, failed["error_rate"])
+
+
+class SchedulerTests(unittest.TestCase):
+    def test_round_hooks(self):
+        fired = []
+
+        def failing_hook(*_):
+            raise ValueError
+
+        async def run():
+            round_scheduler = scheduler.RoundScheduler(1)
+            round_scheduler.subscribe(failing_hook)
+            round_scheduler.subscribe(lambda r, t: fired.append((r, t, time.time())))
+            with self.assertLogs("scheduler", "ERROR"):
+                round_scheduler.start()
+                await wait_for(lambda: len(fired) == 2)
+            self.assertTrue(round_scheduler.running)
+            round_scheduler.stop()
+            self.assertFalse(round_scheduler.running)
+            await asyncio.sleep(1.1)
+
+        asyncio.run(run())
+        self.assertEqual(2, len(fired))
+        self.assertEqual(fired[0][0] + 1, fired[1][0])
+        for round_id, start_time, now in fired:
+            self.assertEqual(round_id, start_time)
+            self.assertGreaterEqual(now, start_time)
+            self.assertLess(now - start_time, 0.1)
+
+    def test_missed_rounds(self):
+        fired = []
+        clock = [3600 * 1000 + 0.5]
+
+        async def run():
+            round_scheduler = scheduler.RoundScheduler(3600)
+            round_scheduler.subscribe(lambda r, t: fired.append((r, t)))
+            with unittest.mock.patch.object(scheduler.time, "time", side_effect=lambda: clock[0]):
+                round_scheduler.start(immediate=True)
+                await asyncio.sleep(0)
+                clock[0] += 3 * 3600
+                with self.assertLogs("scheduler", "WARNING"):
+                    round_scheduler._fire(3600 * 1001)  # noqa
+                self.assertEqual(2, round_scheduler.missed_rounds)
+
+                # Neither early timers nor a clock set back start a round again
+                clock[0] -= 3600
+                with self.assertLogs("scheduler", "WARNING"):
+                    round_scheduler._fire(3600 * 1002)  # noqa
+                clock[0] = 3600 * 1004 - 0.5
+                round_scheduler._fire(3600 * 1004)  # noqa
+            round_scheduler.stop()
+
+        asyncio.run(run())
+        self.assertEqual([(1000, 3600 * 1000), (1003, 3600 * 1003)], fired)
+
+    def test_superseded_rounds(self):
+        init_temporary_database()
+
+        async def run():
+            manager = entrypoint.Manager(make_config(frequency=3600, proof_of_work_bits=8))
+            round_id = nse.get_current_round(3600)
+            manager._start_nse_round(round_id, nse.get_start_time(3600))  # noqa
+            handler, task = manager._round_handlers[round_id]  # noqa
+            manager._on_accept(round_id - 1, 256)  # noqa
+            manager._on_accept(round_id, handler.own_proximity - 1)  # noqa
+            await asyncio.sleep(0.05)
+            self.assertFalse(task.done())
+            self.assertEqual(0, manager.avoided_announcements)
+
+            manager._on_accept(round_id, handler.own_proximity)  # noqa
+            await wait_for(lambda: not manager._round_handlers)  # noqa
+            self.assertTrue(task.cancelled())
+            self.assertEqual(1, manager.avoided_announcements)
+            manager._on_accept(round_id, 256)  # noqa
+            self.assertEqual(1, manager.avoided_announcements)
+            manager._engine.close()  # noqa
+
+        asyncio.run(run())